@@ -2,13 +2,18 @@
 """Demo file showing how to use the miflora library."""
 
 import argparse
+import cProfile
+import functools
 import logging
+import pstats
 import re
 import sys
+from datetime import datetime
 
 from btlewrap import BluepyBackend, GatttoolBackend, PygattBackend, available_backends
 
-from miflora import miflora_scanner
+from miflora import miflora_bench, miflora_btsnoop, miflora_scanner
+from miflora.miflora_gatttool import InteractiveGatttoolBackend
 from miflora.miflora_poller import (
     MI_BATTERY,
     MI_CONDUCTIVITY,
@@ -17,6 +22,7 @@ from miflora.miflora_poller import (
     MI_TEMPERATURE,
     MiFloraPoller,
 )
+from miflora.miflora_replay import ReplayBackend
 
 
 def valid_miflora_mac(
@@ -58,6 +64,8 @@ def _get_backend(args):
     """Extract the backend class from the command line arguments."""
     if args.backend == "gatttool":
         backend = GatttoolBackend
+    elif args.backend == "gatttool-interactive":
+        backend = InteractiveGatttoolBackend
     elif args.backend == "bluepy":
         backend = BluepyBackend
     elif args.backend == "pygatt":
@@ -96,6 +104,42 @@ def clear_history(args):
     poller.clear_history()
 
 
+def decode_capture(args):
+    """Decode the readings in a btsnoop capture."""
+    count = 0
+    for reading in miflora_btsnoop.decode_capture(args.capture, args.mac or None):
+        count += 1
+        if not args.count:
+            print(
+                f"{datetime.fromtimestamp(reading.timestamp)} {reading.mac} "
+                f"{reading.kind} {reading.values}"
+            )
+    print("Decoded {} readings.".format(count))
+
+
+def bench(args):
+    """Time repeated polls or history reads phase by phase."""
+    kwargs = dict()
+    if args.simulate:
+        backend = miflora_bench.SimulatedBackend
+        kwargs = dict(latency=args.latency, connect_latency=args.connect_latency)
+    elif args.replay:
+        backend = functools.partial(ReplayBackend, path=args.replay, speed=args.speed)
+    else:
+        backend = _get_backend(args)
+    mode = miflora_bench.HISTORY if args.history else miflora_bench.POLL
+    print(f"Running {args.count} {mode} runs...")
+    profile = cProfile.Profile() if args.profile else None
+    if profile is not None:
+        profile.enable()
+    times = miflora_bench.run_bench(args.mac, backend, mode, args.count, **kwargs)
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
+    print("\n".join(times.report()))
+
+
 def main():
     """Main function.
 
@@ -103,7 +147,9 @@ def main():
     """
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--backend", choices=["gatttool", "bluepy", "pygatt"], default="gatttool"
+        "--backend",
+        choices=["gatttool", "gatttool-interactive", "bluepy", "pygatt"],
+        default="gatttool",
     )
     parser.add_argument("-v", "--verbose", action="store_const", const=True)
     subparsers = parser.add_subparsers(help="sub-command help")
@@ -126,6 +172,54 @@ def main():
     parser_history.add_argument("mac", type=valid_miflora_mac)
     parser_history.set_defaults(func=clear_history)
 
+    parser_capture = subparsers.add_parser(
+        "decode-capture", help="decode the readings in a btsnoop capture"
+    )
+    parser_capture.add_argument("capture", help="btsnoop file, e.g. from btmon -w")
+    parser_capture.add_argument(
+        "--mac", action="append", help="only decode this sensor, can be repeated"
+    )
+    parser_capture.add_argument(
+        "--count", action="store_true", help="only count the readings"
+    )
+    parser_capture.set_defaults(func=decode_capture)
+
+    parser_bench = subparsers.add_parser(
+        "bench", help="time polls or history reads phase by phase"
+    )
+    parser_bench.add_argument(
+        "mac", type=valid_miflora_mac, nargs="?", default="C4:7C:8D:00:00:00"
+    )
+    parser_bench.add_argument(
+        "--history", action="store_true", help="read the history instead of polling"
+    )
+    parser_bench.add_argument("--count", type=int, default=10, help="number of runs")
+    parser_bench.add_argument(
+        "--profile", metavar="FILE", help="write cProfile statistics to this file"
+    )
+    parser_bench.add_argument(
+        "--simulate", action="store_true", help="use a simulated sensor"
+    )
+    parser_bench.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds per read and write of the simulated sensor",
+    )
+    parser_bench.add_argument(
+        "--connect-latency",
+        type=float,
+        default=0.0,
+        help="seconds to connect to the simulated sensor",
+    )
+    parser_bench.add_argument(
+        "--replay", metavar="FILE", help="play back a recorded session"
+    )
+    parser_bench.add_argument(
+        "--speed", type=float, help="speed up of the playback, default: no delays"
+    )
+    parser_bench.set_defaults(func=bench)
+
     args = parser.parse_args()
 
     if args.verbose:
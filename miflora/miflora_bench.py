@@ -0,0 +1,356 @@
+"""
+Benchmark the polls and history reads of a sensor phase by phase.
+
+When a sensor is slow, the total time of a poll does not tell where it goes.
+The TimingBackend wraps another backend and records the duration of every call
+by phase: connecting, the mode change write to 0x33, the sensor data read from
+0x35, the round trips of the history transfer and so on. The time a poll spends
+outside the backend, mostly decoding, is recorded as the decode phase.
+run_bench repeats polls or history reads and returns the PhaseTimes.
+
+The SimulatedBackend behaves like a Flower Care with configurable latencies, so
+the poller itself can be benchmarked without a sensor. Recorded sessions can be
+played back with the ReplayBackend of miflora_replay.
+
+Example:
+    times = run_bench(mac, SimulatedBackend, mode=HISTORY, count=5)
+    print("\\n".join(times.report()))
+
+or on the command line: `python demo.py bench --simulate --history 5`.
+"""
+
+import struct
+import time
+from collections import defaultdict
+from functools import partial
+from threading import Lock
+
+from btlewrap.base import AbstractBackend, BluetoothBackendException
+
+from .miflora_poller import (
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    MiFloraPoller,
+)
+
+# modes of run_bench
+POLL = "poll"
+HISTORY = "history"
+
+# phases
+CONNECT = "connect"
+MODE_CHANGE = "mode change"
+SENSOR_READ = "sensor read"
+HISTORY_ROUND_TRIP = "history"
+DEVICE_TIME = "device time"
+OTHER = "other"
+DISCONNECT = "disconnect"
+DECODE = "decode"
+TOTAL = "total"
+PHASES = (
+    CONNECT,
+    MODE_CHANGE,
+    SENSOR_READ,
+    HISTORY_ROUND_TRIP,
+    DEVICE_TIME,
+    OTHER,
+    DISCONNECT,
+    DECODE,
+    TOTAL,
+)
+
+# handles read by the poller
+_HANDLE_READ_NAME = 0x03
+_HANDLE_READ_SENSOR_DATA = 0x35
+_HANDLE_READ_VERSION_BATTERY = 0x38
+_HANDLE_HISTORY_READ = 0x3C
+_HANDLE_DEVICE_TIME = 0x41
+# handles written by the poller
+_HANDLE_WRITE_MODE_CHANGE = 0x33
+_HANDLE_HISTORY_CONTROL = 0x3E
+
+_READ_PHASES = {
+    _HANDLE_READ_SENSOR_DATA: SENSOR_READ,
+    _HANDLE_DEVICE_TIME: DEVICE_TIME,
+}
+
+
+class PhaseTimes:
+    """Durations in seconds recorded per phase, thread safe."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.runs = 0
+        self.entries = 0
+        self.elapsed = 0.0
+        # total time spent in the backend
+        self.backend_time = 0.0
+        self._lock = Lock()
+
+    def add(self, phase, duration):
+        """Record the duration of a phase."""
+        with self._lock:
+            self.durations[phase].append(duration)
+            if phase not in (DECODE, TOTAL):
+                self.backend_time += duration
+
+    def percentile(self, phase, percent):
+        """Return a percentile of the durations of a phase or None."""
+        with self._lock:
+            durations = sorted(self.durations.get(phase, ()))
+        if not durations:
+            return None
+        index = int(len(durations) * percent / 100)
+        return durations[min(index, len(durations) - 1)]
+
+    def report(self, percents=(50, 90, 99)):
+        """Return the lines of a table of the percentiles per phase in ms."""
+        header = f"{'phase':<12} {'count':>6}" + "".join(
+            f" {'p' + str(percent):>9}" for percent in percents
+        )
+        lines = [header]
+        for phase in PHASES:
+            count = len(self.durations.get(phase, ()))
+            if not count:
+                continue
+            lines.append(
+                f"{phase:<12} {count:>6}"
+                + "".join(
+                    f" {self.percentile(phase, percent) * 1000:>9.2f}"
+                    for percent in percents
+                )
+            )
+        lines.append(f"{self.runs} runs in {self.elapsed:.3f} s")
+        if self.entries:
+            rate = self.entries / self.elapsed if self.elapsed else float("inf")
+            lines.append(f"{self.entries} history entries, {rate:.1f} entries/s")
+        return lines
+
+
+class TimingBackend(AbstractBackend):
+    """Backend recording the duration of the calls to another backend.
+
+    `backend` is the class of the timed backend, `times` the PhaseTimes to
+    record to. Further keyword arguments are passed to the backend.
+    """
+
+    def __init__(
+        self, adapter="hci0", address_type="public", *, backend, times, **kwargs
+    ):
+        super().__init__(adapter, address_type)
+        self._backend = backend(adapter=adapter, address_type=address_type, **kwargs)
+        self.times = times
+        # duration of the last write to the history control, added to the read
+        self._history_write = 0.0
+        # the fast transfer methods are only offered if the backend has them
+        if hasattr(self._backend, "write_read_batch"):
+            self.write_read_batch = self._write_read_batch
+        if hasattr(self._backend, "write_handle_no_response"):
+            self.write_handle_no_response = self._write_handle_no_response
+
+    def _timed(self, func, *args):
+        """Call the backend, returns the result and the duration."""
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """Check if the timed backend is available."""
+        return self._backend.check_backend()
+
+    def connect(self, mac):
+        """Connect to a device."""
+        result, duration = self._timed(self._backend.connect, mac)
+        self.times.add(CONNECT, duration)
+        return result
+
+    def disconnect(self):
+        """Disconnect from a device."""
+        result, duration = self._timed(self._backend.disconnect)
+        self.times.add(DISCONNECT, duration)
+        return result
+
+    def is_connected(self):
+        """Check if the timed backend is connected."""
+        return self._backend.is_connected()
+
+    def read_handle(self, handle):
+        """Read a handle from the device."""
+        result, duration = self._timed(self._backend.read_handle, handle)
+        if handle == _HANDLE_HISTORY_READ:
+            self.times.add(HISTORY_ROUND_TRIP, self._history_write + duration)
+            self._history_write = 0.0
+        else:
+            self.times.add(_READ_PHASES.get(handle, OTHER), duration)
+        return result
+
+    def write_handle(self, handle, value):
+        """Write a handle of the device."""
+        result, duration = self._timed(self._backend.write_handle, handle, value)
+        self._add_write(handle, duration)
+        return result
+
+    def _write_handle_no_response(self, handle, value):
+        """Write a handle without waiting for the response."""
+        result, duration = self._timed(
+            self._backend.write_handle_no_response, handle, value
+        )
+        self._add_write(handle, duration)
+        return result
+
+    def _add_write(self, handle, duration):
+        """Record the duration of a write."""
+        if handle == _HANDLE_HISTORY_CONTROL:
+            self._history_write = duration
+        elif handle == _HANDLE_WRITE_MODE_CHANGE:
+            self.times.add(MODE_CHANGE, duration)
+        else:
+            self.times.add(OTHER, duration)
+
+    def _write_read_batch(self, write_handle, read_handle, values):
+        """Pass on a batch, every response counts as one round trip."""
+        start = time.perf_counter()
+        for response in self._backend.write_read_batch(
+            write_handle, read_handle, values
+        ):
+            end = time.perf_counter()
+            self.times.add(HISTORY_ROUND_TRIP, end - start)
+            yield response
+            start = time.perf_counter()
+
+
+class SimulatedBackend(AbstractBackend):
+    """Backend simulating a Flower Care with a history.
+
+    `connect_latency` is the time in seconds to connect, `latency` the time of
+    every read and write. `history_entries` is the number of hourly entries in
+    the history of the simulated sensor.
+    """
+
+    def __init__(
+        self,
+        adapter="hci0",
+        address_type="public",
+        *,
+        latency=0.0,
+        connect_latency=0.0,
+        history_entries=100,
+        firmware="3.2.1",
+    ):  # pylint: disable=too-many-arguments
+        super().__init__(adapter, address_type)
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.history_entries = history_entries
+        self.firmware = firmware
+        self._boot = time.time() - 3600 * (history_entries + 1)
+        self._history_command = None
+        self._connected = False
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """The simulation is always available."""
+        return True
+
+    def connect(self, mac):
+        """Simulate connecting to the sensor."""
+        time.sleep(self.connect_latency)
+        self._connected = True
+
+    def disconnect(self):
+        """Simulate disconnecting from the sensor."""
+        self._connected = False
+
+    def is_connected(self):
+        """Check if the simulated sensor is connected."""
+        return self._connected
+
+    def _device_time(self):
+        """Return the seconds since the simulated sensor booted."""
+        return int(time.time() - self._boot)
+
+    def read_handle(self, handle):
+        """Simulate reading a handle."""
+        if not self._connected:
+            raise BluetoothBackendException("Not connected to any device.")
+        time.sleep(self.latency)
+        if handle == _HANDLE_READ_VERSION_BATTERY:
+            return bytes([99, 0x10]) + self.firmware.encode()
+        if handle == _HANDLE_READ_NAME:
+            return b"Flower care"
+        if handle == _HANDLE_READ_SENSOR_DATA:
+            # 23.4 °C, 1200 lux, 35 %, 600 µS/cm
+            return (
+                struct.pack("<hxIBH", 234, 1200, 35, 600) + bytes([2, 0x3C]) + bytes(4)
+            )
+        if handle == _HANDLE_DEVICE_TIME:
+            return self._device_time().to_bytes(4, "little")
+        if handle == _HANDLE_HISTORY_READ:
+            return self._read_history()
+        raise BluetoothBackendException(f"Handle 0x{handle:02x} is not simulated")
+
+    def _read_history(self):
+        """Return the response to the last history command."""
+        command = self._history_command
+        if command is None:
+            raise BluetoothBackendException("No history command was written")
+        if command[0] == 0xA0:
+            return self.history_entries.to_bytes(2, "little") + bytes(14)
+        index = int.from_bytes(command[1:3], "little")
+        if command[0] != 0xA1 or index >= self.history_entries:
+            raise BluetoothBackendException("Invalid history address")
+        # the newest entry comes first
+        device_time = (self._device_time() // 3600 - index) * 3600
+        return struct.pack(
+            "<IhxHBxBH2x", device_time, 200 + index % 50, 1000, 0, 30 + index % 20, 500
+        )
+
+    def write_handle(self, handle, value):
+        """Simulate writing a handle."""
+        if not self._connected:
+            raise BluetoothBackendException("Not connected to any device.")
+        time.sleep(self.latency)
+        if handle == _HANDLE_HISTORY_CONTROL:
+            self._history_command = bytes(value)
+            if self._history_command[:1] == b"\xa2":
+                self.history_entries = 0
+        elif handle != _HANDLE_WRITE_MODE_CHANGE:
+            raise BluetoothBackendException(f"Handle 0x{handle:02x} is not simulated")
+        return True
+
+
+def run_bench(mac, backend, mode=POLL, count=10, times=None, **kwargs):
+    """Poll a sensor or read its history `count` times.
+
+    `backend` is the backend class, further keyword arguments are passed to it.
+    Every poll reads the sensor data and decodes all measurements. Returns the
+    PhaseTimes, which also hold the number of runs, the history entries read and
+    the elapsed time.
+    """
+    times = PhaseTimes() if times is None else times
+    poller = MiFloraPoller(
+        mac, partial(TimingBackend, backend=backend, times=times, **kwargs)
+    )
+    start = time.perf_counter()
+    for _ in range(count):
+        run_start = time.perf_counter()
+        backend_start = times.backend_time
+        if mode == HISTORY:
+            times.entries += len(poller.fetch_history())
+        else:
+            poller.fill_cache()
+            for parameter in (
+                MI_TEMPERATURE,
+                MI_MOISTURE,
+                MI_LIGHT,
+                MI_CONDUCTIVITY,
+                MI_BATTERY,
+            ):
+                poller.parameter_value(parameter)
+        duration = time.perf_counter() - run_start
+        times.add(TOTAL, duration)
+        times.add(DECODE, max(duration - (times.backend_time - backend_start), 0))
+        times.runs += 1
+    times.elapsed = time.perf_counter() - start
+    return times
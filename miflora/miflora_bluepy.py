@@ -0,0 +1,22 @@
+"""
+Bluepy backend with writes without response, see miflora_transfer.
+
+This is a separate module, so that the poller does not depend on bluepy.
+"""
+
+from btlewrap.base import BluetoothBackendException
+from btlewrap.bluepy import BluepyBackend, wrap_exception
+
+
+class PipelinedBluepyBackend(BluepyBackend):
+    """Bluepy backend supporting writes without response."""
+
+    @wrap_exception
+    def write_handle_no_response(self, handle, value):
+        """Write a handle without waiting for the write response.
+
+        You must be connected to do this.
+        """
+        if self._peripheral is None:
+            raise BluetoothBackendException("not connected to backend")
+        return self._peripheral.writeCharacteristic(handle, value, False)
@@ -0,0 +1,383 @@
+"""
+Decode the readings of the sensors from btsnoop captures.
+
+Gateways can log all their Bluetooth traffic with btmon (`btmon -w file`) or
+the Android HCI snoop log. Such captures contain the reads of the sensor data,
+firmware version and battery level, history and device time as ATT read
+responses and the MiBeacon advertisements of the sensors. The functions here
+stream through a capture and decode all of them with the layouts registered in
+miflora_decoder, so a capture of a whole day turns into readings in seconds.
+
+The btsnoop datalinks 1001 (HCI without packet type), 1002 (HCI UART) and 2001
+(Linux monitor, written by btmon) are supported.
+
+Example:
+    for reading in decode_capture("gateway.btsnoop"):
+        print(reading.timestamp, reading.mac, reading.kind, reading.values)
+"""
+
+import logging
+from struct import Struct
+
+from .miflora_decoder import (
+    ADVERTISEMENT_DATA,
+    HISTORY_DATA,
+    MI_BATTERY,
+    MIBEACON_SERVICE_UUID,
+    SENSOR_DATA,
+    decode_mibeacon,
+    get_decoder,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+DATALINK_HCI = 1001
+DATALINK_HCI_UART = 1002
+DATALINK_MONITOR = 2001
+
+# kinds of readings in addition to the kinds of miflora_decoder
+FIRMWARE_DATA = "firmware"
+HISTORY_INFO = "history_info"
+DEVICE_TIME = "device_time"
+
+_FILE_HEADER = Struct(">8sII")
+_RECORD_HEADER = Struct(">IIIIq")
+_MAGIC = b"btsnoop\x00"
+# microseconds between the start of year 0 and the unix epoch
+_EPOCH_OFFSET = 0x00DCDDB30F2F8000
+_CHUNK_SIZE = 1 << 20
+
+_HCI_COMMAND = 0x01
+_HCI_ACL = 0x02
+_HCI_EVENT = 0x04
+# packet types and directions of the opcodes of the monitor datalink
+_MONITOR_OPCODES = {
+    2: (_HCI_COMMAND, False),
+    3: (_HCI_EVENT, True),
+    4: (_HCI_ACL, False),
+    5: (_HCI_ACL, True),
+}
+
+_U16 = Struct("<H")
+_ACL_HEADER = Struct("<HH")
+_L2CAP_HEADER = Struct("<HH")
+_CID_ATT = 0x0004
+
+_EVENT_DISCONNECTION_COMPLETE = 0x05
+_EVENT_LE_META = 0x3E
+_LE_CONNECTION_COMPLETE = 0x01
+_LE_ADVERTISING_REPORT = 0x02
+_LE_ENHANCED_CONNECTION_COMPLETE = 0x0A
+_LE_EXTENDED_ADVERTISING_REPORT = 0x0D
+_AD_SERVICE_DATA_16 = 0x16
+
+_ATT_ERROR_RESPONSE = 0x01
+_ATT_READ_REQUEST = 0x0A
+_ATT_READ_RESPONSE = 0x0B
+_ATT_WRITE_REQUEST = 0x12
+_ATT_WRITE_COMMAND = 0x52
+
+_HANDLE_READ_SENSOR_DATA = 0x35
+_HANDLE_READ_VERSION_BATTERY = 0x38
+_HANDLE_HISTORY_READ = 0x3C
+_HANDLE_HISTORY_CONTROL = 0x3E
+_HANDLE_DEVICE_TIME = 0x41
+_CMD_HISTORY_READ_INIT = 0xA0
+_CMD_HISTORY_ADDRESS = 0xA1
+
+
+def _format_mac(data):
+    """Format a little endian Bluetooth address."""
+    return ":".join(format(c, "02X") for c in reversed(data))
+
+
+class CapturedReading:  # pylint: disable=too-few-public-methods
+    """Reading decoded from a capture.
+
+    `timestamp` is the capture time in seconds since the epoch, `kind` one of
+    SENSOR_DATA, HISTORY_DATA, ADVERTISEMENT_DATA, FIRMWARE_DATA, HISTORY_INFO
+    and DEVICE_TIME and `values` the decoded dictionary. `mac` is None if the
+    connection was opened before the capture started.
+    """
+
+    __slots__ = ("timestamp", "mac", "kind", "values")
+
+    def __init__(self, timestamp, mac, kind, values):
+        self.timestamp = timestamp
+        self.mac = mac
+        self.kind = kind
+        self.values = values
+
+    def __repr__(self):
+        return (
+            f"CapturedReading({self.timestamp!r}, {self.mac!r}, "
+            f"{self.kind!r}, {self.values!r})"
+        )
+
+
+def read_btsnoop(capture):
+    """Yield the HCI packets of a btsnoop capture.
+
+    `capture` is a path or a binary file. Each packet is a tuple of the capture
+    time in seconds since the epoch, the adapter index, the HCI packet type,
+    True for received packets and the packet without its type. Raises a
+    ValueError if the capture is not a btsnoop file of a supported datalink.
+    """
+    if isinstance(capture, (str, bytes)) or hasattr(capture, "__fspath__"):
+        with open(capture, "rb") as capture_file:
+            yield from read_btsnoop(capture_file)
+        return
+    header = capture.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size:
+        raise ValueError("Not a btsnoop capture")
+    magic, _, datalink = _FILE_HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ValueError("Not a btsnoop capture")
+    if datalink not in (DATALINK_HCI, DATALINK_HCI_UART, DATALINK_MONITOR):
+        raise ValueError(f"Unsupported btsnoop datalink {datalink}")
+    data = b""
+    while True:
+        chunk = capture.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        data = data + chunk if data else chunk
+        offset = 0
+        end = len(data)
+        while end - offset >= _RECORD_HEADER.size:
+            _, length, flags, _, timestamp = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            if end - start < length:
+                break
+            offset = start + length
+            packet = _normalize(datalink, flags, data[start:offset])
+            if packet is not None:
+                yield ((timestamp - _EPOCH_OFFSET) / 1e6,) + packet
+        data = data[offset:]
+    if data:
+        _LOGGER.warning("Capture ends with a truncated record")
+
+
+def _normalize(datalink, flags, packet):
+    """Return the adapter, packet type, direction and payload of a record."""
+    if datalink == DATALINK_HCI_UART:
+        if not packet:
+            return None
+        return 0, packet[0], bool(flags & 0x01), packet[1:]
+    if datalink == DATALINK_HCI:
+        received = bool(flags & 0x01)
+        if flags & 0x02:
+            return 0, _HCI_EVENT if received else _HCI_COMMAND, received, packet
+        return 0, _HCI_ACL, received, packet
+    opcode = _MONITOR_OPCODES.get(flags & 0xFFFF)
+    if opcode is None:
+        return None
+    return (flags >> 16,) + opcode + (packet,)
+
+
+class CaptureDecoder:  # pylint: disable=too-few-public-methods
+    """Decode the readings from the HCI packets of a capture.
+
+    The decoder follows the connections and ATT requests of all adapters, so
+    the packets must be fed in the order of the capture.
+    """
+
+    def __init__(self):
+        # MAC address per (adapter, connection handle)
+        self._connections = dict()
+        # incomplete L2CAP frames per (adapter, connection handle, direction)
+        self._fragments = dict()
+        # handle of the pending read request per (adapter, connection handle)
+        self._reads = dict()
+        # last command written to the history control per connection
+        self._history_commands = dict()
+
+    def feed(self, timestamp, adapter, packet_type, received, packet):
+        """Decode one HCI packet, returns a list of readings."""
+        if packet_type == _HCI_ACL:
+            return self._acl(timestamp, adapter, received, packet)
+        if packet_type == _HCI_EVENT:
+            return self._event(timestamp, adapter, packet)
+        return []
+
+    def _event(self, timestamp, adapter, packet):
+        """Handle an HCI event."""
+        if len(packet) < 3:
+            return []
+        code = packet[0]
+        if code == _EVENT_LE_META:
+            subevent = packet[2]
+            if subevent in (_LE_CONNECTION_COMPLETE, _LE_ENHANCED_CONNECTION_COMPLETE):
+                if len(packet) >= 14 and packet[3] == 0:
+                    handle = _U16.unpack_from(packet, 4)[0] & 0x0FFF
+                    self._forget(adapter, handle)
+                    self._connections[(adapter, handle)] = _format_mac(packet[8:14])
+            elif subevent == _LE_ADVERTISING_REPORT:
+                return self._advertising_report(timestamp, packet)
+            elif subevent == _LE_EXTENDED_ADVERTISING_REPORT:
+                return self._extended_advertising_report(timestamp, packet)
+        elif code == _EVENT_DISCONNECTION_COMPLETE and len(packet) >= 6:
+            if packet[2] == 0:
+                handle = _U16.unpack_from(packet, 3)[0] & 0x0FFF
+                self._forget(adapter, handle)
+        return []
+
+    def _forget(self, adapter, handle):
+        """Drop the state of a closed connection."""
+        key = (adapter, handle)
+        self._connections.pop(key, None)
+        self._reads.pop(key, None)
+        self._history_commands.pop(key, None)
+        self._fragments.pop(key + (False,), None)
+        self._fragments.pop(key + (True,), None)
+
+    def _advertising_report(self, timestamp, packet):
+        """Decode the MiBeacons of an LE advertising report."""
+        readings = []
+        offset = 4
+        for _ in range(packet[3]):
+            if len(packet) < offset + 9:
+                break
+            mac = _format_mac(packet[offset + 2 : offset + 8])
+            length = packet[offset + 8]
+            data = packet[offset + 9 : offset + 9 + length]
+            offset += 9 + length
+            rssi = packet[offset] - 256 if len(packet) > offset else None
+            offset += 1
+            readings.extend(self._advertisement(timestamp, mac, data, rssi))
+        return readings
+
+    def _extended_advertising_report(self, timestamp, packet):
+        """Decode the MiBeacons of an LE extended advertising report."""
+        readings = []
+        offset = 4
+        for _ in range(packet[3]):
+            if len(packet) < offset + 24:
+                break
+            mac = _format_mac(packet[offset + 3 : offset + 9])
+            rssi = packet[offset + 13] - 256
+            length = packet[offset + 23]
+            data = packet[offset + 24 : offset + 24 + length]
+            offset += 24 + length
+            readings.extend(self._advertisement(timestamp, mac, data, rssi))
+        return readings
+
+    @staticmethod
+    def _advertisement(timestamp, mac, data, rssi):
+        """Decode the MiBeacon in the advertising data of a device."""
+        offset = 0
+        while offset + 4 <= len(data):
+            length = data[offset]
+            if length == 0:
+                break
+            if (
+                data[offset + 1] == _AD_SERVICE_DATA_16
+                and _U16.unpack_from(data, offset + 2)[0] == MIBEACON_SERVICE_UUID
+                and length >= 8
+            ):
+                values = decode_mibeacon(data[offset + 4 : offset + 1 + length])
+                if values is not None:
+                    values["rssi"] = rssi
+                    return [
+                        CapturedReading(
+                            timestamp,
+                            values.get("mac", mac),
+                            ADVERTISEMENT_DATA,
+                            values,
+                        )
+                    ]
+            offset += 1 + length
+        return []
+
+    def _acl(self, timestamp, adapter, received, packet):
+        """Reassemble the L2CAP frames of the ACL data and handle ATT PDUs."""
+        if len(packet) < _ACL_HEADER.size:
+            return []
+        header, length = _ACL_HEADER.unpack_from(packet)
+        handle = header & 0x0FFF
+        payload = packet[_ACL_HEADER.size : _ACL_HEADER.size + length]
+        key = (adapter, handle, received)
+        if (header >> 12) & 0x03 == 0x01:
+            # continuation of a fragmented frame
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                return []
+            fragment.extend(payload)
+            frame = fragment
+        else:
+            self._fragments.pop(key, None)
+            frame = payload
+        if len(frame) < _L2CAP_HEADER.size:
+            return []
+        frame_length, cid = _L2CAP_HEADER.unpack_from(frame)
+        if len(frame) < _L2CAP_HEADER.size + frame_length:
+            if frame is payload:
+                self._fragments[key] = bytearray(payload)
+            return []
+        self._fragments.pop(key, None)
+        if cid != _CID_ATT:
+            return []
+        pdu = bytes(frame[_L2CAP_HEADER.size : _L2CAP_HEADER.size + frame_length])
+        return self._att(timestamp, adapter, handle, pdu)
+
+    def _att(self, timestamp, adapter, handle, pdu):
+        """Handle an ATT PDU of a connection."""
+        if not pdu:
+            return []
+        key = (adapter, handle)
+        opcode = pdu[0]
+        if opcode == _ATT_READ_REQUEST and len(pdu) >= 3:
+            self._reads[key] = _U16.unpack_from(pdu, 1)[0]
+        elif opcode in (_ATT_WRITE_REQUEST, _ATT_WRITE_COMMAND) and len(pdu) >= 4:
+            if _U16.unpack_from(pdu, 1)[0] == _HANDLE_HISTORY_CONTROL:
+                self._history_commands[key] = pdu[3]
+        elif opcode == _ATT_ERROR_RESPONSE:
+            self._reads.pop(key, None)
+        elif opcode == _ATT_READ_RESPONSE:
+            attribute = self._reads.pop(key, None)
+            reading = self._read_response(key, attribute, pdu[1:])
+            if reading is not None:
+                kind, values = reading
+                return [
+                    CapturedReading(timestamp, self._connections.get(key), kind, values)
+                ]
+        return []
+
+    def _read_response(self, key, attribute, value):
+        """Decode the value read from an attribute, returns the kind and values."""
+        if attribute == _HANDLE_READ_SENSOR_DATA:
+            decoder = get_decoder(SENSOR_DATA, len(value))
+            if decoder is not None:
+                values = decoder.decode(value)
+                values["model"] = decoder.model
+                return SENSOR_DATA, values
+        elif attribute == _HANDLE_READ_VERSION_BATTERY and len(value) >= 2:
+            return FIRMWARE_DATA, {
+                MI_BATTERY: value[0],
+                "firmware": "".join(map(chr, value[2:])),
+            }
+        elif attribute == _HANDLE_HISTORY_READ:
+            command = self._history_commands.get(key)
+            if command == _CMD_HISTORY_READ_INIT and len(value) >= 2:
+                return HISTORY_INFO, {"history_length": _U16.unpack_from(value)[0]}
+            if command == _CMD_HISTORY_ADDRESS:
+                decoder = get_decoder(HISTORY_DATA, len(value))
+                if decoder is not None:
+                    return HISTORY_DATA, decoder.decode(value)
+        elif attribute == _HANDLE_DEVICE_TIME and len(value) >= 4:
+            return DEVICE_TIME, {"device_time": int.from_bytes(value[:4], "little")}
+        return None
+
+
+def decode_capture(capture, macs=None):
+    """Yield the readings in a btsnoop capture.
+
+    `capture` is a path or a binary file. With `macs`, only the readings of
+    these sensors are returned.
+    """
+    if macs is not None:
+        macs = {mac.upper() for mac in macs}
+    decoder = CaptureDecoder()
+    for packet in read_btsnoop(capture):
+        for reading in decoder.feed(*packet):
+            if macs is None or reading.mac in macs:
+                yield reading
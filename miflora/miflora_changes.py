@@ -0,0 +1,100 @@
+"""
+Publish only meaningful changes of the readings.
+
+Moisture and conductivity change slowly, so most readings repeat the previous
+values. The ChangeFilter passes a value only if it differs from the last passed
+value of the same sensor by more than the deadband of its measurement, or if
+nothing was passed for `heartbeat` seconds. Bridges to MQTT or a database can
+put it between the poller and the publishing and skip the duplicates.
+
+Example:
+    changes = ChangeFilter({MI_TEMPERATURE: 0.2, MI_MOISTURE: 1})
+    value = poller.parameter_value(MI_MOISTURE)
+    if changes.changed(mac, MI_MOISTURE, value):
+        publish(mac, MI_MOISTURE, value)
+"""
+
+import time
+from threading import Lock
+
+from .miflora_decoder import (
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+)
+
+# changes up to these values are not passed on
+DEFAULT_DEADBANDS = {
+    MI_TEMPERATURE: 0.2,
+    MI_MOISTURE: 1,
+    MI_CONDUCTIVITY: 10,
+    MI_LIGHT: 0,
+    MI_BATTERY: 1,
+}
+# seconds after which a value is passed on even without a change
+DEFAULT_HEARTBEAT = 3600
+
+
+class ChangeFilter:
+    """Pass on only the values that changed by more than their deadband.
+
+    `deadbands` maps the measurements to the largest change that is suppressed,
+    it overrides single entries of DEFAULT_DEADBANDS. Measurements without a
+    deadband are passed on whenever they change. A value is always passed on if
+    the last passed value of its measurement is `heartbeat` seconds old. The
+    filter is thread safe and can be shared by the pollers of many sensors.
+    """
+
+    def __init__(self, deadbands=None, heartbeat=DEFAULT_HEARTBEAT):
+        self.deadbands = dict(DEFAULT_DEADBANDS)
+        if deadbands is not None:
+            self.deadbands.update(deadbands)
+        self.heartbeat = heartbeat
+        # last passed value and its time per (mac, measurement)
+        self._published = dict()
+        self._lock = Lock()
+
+    def _is_change(self, parameter, last, value):
+        """Check if the value differs from the last one by more than the deadband."""
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value != last
+        if isinstance(last, bool) or not isinstance(last, (int, float)):
+            return True
+        return abs(value - last) > self.deadbands.get(parameter, 0)
+
+    def changed(self, mac, parameter, value, timestamp=None):
+        """Check if a value must be passed on and remember it if so."""
+        timestamp = time.time() if timestamp is None else timestamp
+        key = (mac.upper(), parameter)
+        with self._lock:
+            published = self._published.get(key)
+            if (
+                published is not None
+                and timestamp - published[1] < self.heartbeat
+                and not self._is_change(parameter, published[0], value)
+            ):
+                return False
+            self._published[key] = (value, timestamp)
+            return True
+
+    def filter(self, mac, reading, timestamp=None):
+        """Return the values of a reading that must be passed on.
+
+        `reading` is a dictionary of measurements, e.g. as returned by the
+        decoders. The result is empty if nothing changed.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        return {
+            parameter: value
+            for parameter, value in reading.items()
+            if self.changed(mac, parameter, value, timestamp)
+        }
+
+    def forget(self, mac):
+        """Forget the passed values of a sensor, its next values are passed on."""
+        mac = mac.upper()
+        with self._lock:
+            for key in [key for key in self._published if key[0] == mac]:
+                del self._published[key]
@@ -0,0 +1,142 @@
+"""
+Model of the clock of a sensor.
+
+The sensor counts the seconds since it was powered on. The history entries are
+time stamped with this device time. The DeviceClock learns the offset between
+device time and wall time, and the drift of the device clock, from repeated
+samples. This way the wall time of the history entries can be computed without
+reading the device time every time.
+"""
+
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DeviceClock:
+    """Linear model of a device clock.
+
+    wall_time = device_time + offset + drift * (device_time - reference)
+
+    `reference` is the device time of the latest sample. `max_error` is the
+    uncertainty of the model in seconds above which the clock needs a new sample.
+    `default_drift` is the assumed worst case drift of the device clock as long as
+    there are not enough samples to estimate it.
+    """
+
+    def __init__(self, max_error=30.0, max_samples=16, default_drift=1e-4):
+        self.max_error = max_error
+        self.max_samples = max_samples
+        self.default_drift = default_drift
+        # list of (device_time, wall_time, error)
+        self.samples = []
+        self._offset = None
+        self._drift = 0.0
+        self._drift_error = default_drift
+
+    def add_sample(self, device_time, wall_time, error):
+        """Add a measurement of the device time.
+
+        `error` is the uncertainty of the wall time in seconds, usually half of the
+        round trip time of the read. If the device time went backwards, the device
+        rebooted and all previous samples are dropped.
+        """
+        if self.samples and device_time < self.samples[-1][0]:
+            _LOGGER.info("Device time went backwards, the device rebooted.")
+            self.reset()
+        self.samples.append((device_time, wall_time, error))
+        del self.samples[: -self.max_samples]
+        self._fit()
+
+    def reset(self):
+        """Forget all samples."""
+        self.samples = []
+        self._offset = None
+        self._drift = 0.0
+        self._drift_error = self.default_drift
+
+    def _fit(self):
+        """Fit offset and drift to the samples with least squares."""
+        reference = self.samples[-1][0]
+        offsets = [(d - reference, w - d) for d, w, _ in self.samples]
+        mean_x = sum(x for x, _ in offsets) / len(offsets)
+        mean_y = sum(y for _, y in offsets) / len(offsets)
+        var_x = sum((x - mean_x) ** 2 for x, _ in offsets)
+        span = self.samples[-1][0] - self.samples[0][0]
+        if var_x > 0 and span > 0:
+            self._drift = sum((x - mean_x) * (y - mean_y) for x, y in offsets) / var_x
+            sample_error = max(e for _, _, e in self.samples)
+            self._drift_error = min(2 * sample_error / span, self.default_drift)
+        else:
+            self._drift = 0.0
+            self._drift_error = self.default_drift
+        # offset at the reference, which is the device time of the latest sample
+        self._offset = mean_y - self._drift * mean_x
+
+    @property
+    def synced(self):
+        """Check if the clock has at least one sample."""
+        return self._offset is not None
+
+    def wall_time(self, device_time):
+        """Convert a device time to a wall time (seconds since the epoch)."""
+        if not self.synced:
+            raise ValueError("The clock has no samples")
+        reference = self.samples[-1][0]
+        return device_time + self._offset + self._drift * (device_time - reference)
+
+    def device_time(self, wall_time=None):
+        """Predict the device time at a wall time, by default now."""
+        if not self.synced:
+            raise ValueError("The clock has no samples")
+        if wall_time is None:
+            wall_time = time.time()
+        reference = self.samples[-1][0]
+        return reference + (wall_time - self.wall_time(reference)) / (1 + self._drift)
+
+    def uncertainty(self, device_time):
+        """Estimate the uncertainty of the wall time of a device time in seconds."""
+        if not self.synced:
+            return float("inf")
+        reference = self.samples[-1][0]
+        return self.samples[-1][2] + self._drift_error * abs(device_time - reference)
+
+    def needs_sync(self, wall_time=None):
+        """Check if a new sample is needed to keep the uncertainty below max_error."""
+        if not self.synced:
+            return True
+        return self.uncertainty(self.device_time(wall_time)) > self.max_error
+
+    def is_consistent(self, device_time, wall_time=None):
+        """Check if a device time seen now fits the model.
+
+        A device time later than the predicted current device time means that the
+        device rebooted and the model is invalid.
+        """
+        if not self.synced:
+            return False
+        return device_time <= self.device_time(wall_time) + self.max_error
+
+    def is_recent(self, device_time, max_age, wall_time=None):
+        """Check if a device time is at most `max_age` seconds in the past.
+
+        After a reboot the device time starts again near 0, so the times written
+        since then look far in the past according to the old model.
+        """
+        if not self.synced:
+            return False
+        return device_time >= self.device_time(wall_time) - max_age - self.max_error
+
+    def to_dict(self):
+        """Serialize the clock, e.g. for the metadata store."""
+        return {"samples": [list(sample) for sample in self.samples]}
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        """Restore a clock serialized with to_dict."""
+        clock = cls(**kwargs)
+        if data:
+            for sample in data.get("samples", []):
+                clock.add_sample(*sample)
+        return clock
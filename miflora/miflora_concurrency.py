@@ -0,0 +1,414 @@
+"""
+Coordinate the access of many pollers to the Bluetooth adapters.
+
+BlueZ degrades badly when too many connections are attempted at the same time,
+while the adapters themselves can work in parallel. All pollers therefore share
+one AdapterLimiter per adapter, which bounds the number of simultaneous
+connections on that adapter. On top of that, every sensor has one lock shared by
+all pollers of that MAC address, so that the operations on one sensor, e.g. the
+commands of a history transfer, never interleave.
+
+Waiting for a lock or a connection slot is always bounded, so that a hung sensor
+cannot block the other callers forever.
+
+The free slots go to the waiting work with the highest priority first. Live
+reads are interactive, history transfers run in the background and give up
+their slot between batches when interactive work is waiting.
+
+Sensors that are polled often can keep their connection open between the
+operations in a KeepAlivePool, which saves the connection setup and the mode
+change of the next operation.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from btlewrap.base import BluetoothBackendException
+
+from .miflora_deadline import BluetoothTimeoutException
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONNECTION_LIMIT = 1
+# seconds to wait for a lock or a connection slot if the caller has no timeout
+DEFAULT_WAIT_TIMEOUT = 600.0
+# seconds an unused connection is kept open
+DEFAULT_IDLE_TIMEOUT = 30.0
+# maximum number of open unused connections per adapter
+DEFAULT_KEEP_ALIVE_SIZE = 2
+
+# priorities of the work on an adapter, lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+_LIMITERS = dict()
+_DEVICE_LOCKS = dict()
+_REGISTRY_LOCK = Lock()
+
+
+class AdapterLimiter:
+    """Limit the number of simultaneous connections on an adapter.
+
+    The limit can be changed at any time, it applies to the next connection.
+    A slot is only given to a waiter if no waiter with a higher priority exists.
+    """
+
+    def __init__(self, limit=DEFAULT_CONNECTION_LIMIT):
+        if limit < 1:
+            raise ValueError("The connection limit must be at least 1")
+        self._limit = limit
+        self._condition = Condition()
+        # number of waiters per priority
+        self._waiting = dict()
+        self.active = 0
+
+    @property
+    def limit(self):
+        """Maximum number of simultaneous connections."""
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        if limit < 1:
+            raise ValueError("The connection limit must be at least 1")
+        with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    def _higher_priority_waiting(self, priority):
+        """Check if work with a higher priority waits, the condition must be held."""
+        return any(count > 0 for p, count in self._waiting.items() if p < priority)
+
+    def _slot_free(self, priority):
+        """Check if a waiter with this priority may take a slot."""
+        return self.active < self._limit and not self._higher_priority_waiting(priority)
+
+    def acquire(self, timeout=None, priority=PRIORITY_INTERACTIVE):
+        """Wait for a free connection slot, returns False on a timeout."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while not self._slot_free(priority):
+                    remaining = None if end is None else end - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self._waiting[priority] -= 1
+                # waiters with a lower priority may go ahead now
+                self._condition.notify_all()
+
+    @property
+    def free(self):
+        """Number of free connection slots."""
+        with self._condition:
+            return max(self._limit - self.active, 0)
+
+    def should_yield(self, priority):
+        """Check if work with a higher priority waits for a slot."""
+        with self._condition:
+            return self._higher_priority_waiting(priority)
+
+    def release(self):
+        """Free a connection slot."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+
+def get_adapter_limiter(adapter):
+    """Return the connection limiter shared by all pollers of an adapter."""
+    with _REGISTRY_LOCK:
+        if adapter not in _LIMITERS:
+            _LIMITERS[adapter] = AdapterLimiter()
+        return _LIMITERS[adapter]
+
+
+def set_connection_limit(adapter, limit):
+    """Set the maximum number of simultaneous connections on an adapter."""
+    get_adapter_limiter(adapter).limit = limit
+
+
+def get_device_lock(mac):
+    """Return the lock shared by all pollers of a sensor."""
+    if isinstance(mac, str):
+        mac = mac.upper()
+    with _REGISTRY_LOCK:
+        return _DEVICE_LOCKS.setdefault(mac, Lock())
+
+
+class BackendPool:
+    """Backend instances of one adapter, shared by the sensors using it.
+
+    A backend instance handles one connection at a time, so the pool creates a
+    new instance only if all existing ones are busy. `instances` are existing
+    instances to start with.
+    """
+
+    def __init__(self, backend, adapter="hci0", instances=()):
+        self._backend = backend
+        self.adapter = adapter
+        self._idle = list(instances)
+        self._lock = Lock()
+
+    def acquire(self):
+        """Take an idle backend instance or create a new one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        instance = self._backend(adapter=self.adapter, address_type="public")
+        instance.check_backend()
+        return instance
+
+    def release(self, instance):
+        """Return a backend instance to the pool."""
+        with self._lock:
+            self._idle.append(instance)
+
+    def on_adapter(self, adapter):
+        """Return a new pool with the same backend on another adapter."""
+        return BackendPool(self._backend, adapter)
+
+
+class KeepAlivePool:
+    """Connections kept open after their use for the next operation.
+
+    A connection that was used without error is kept open for `idle_timeout`
+    seconds. On every adapter at most `max_size` unused connections are kept,
+    if there are more, the least recently used one is closed. Kept connections
+    do not hold a slot of the adapter limiter, instead the least recently used
+    ones are closed before a new connection is made, so that the open
+    connections of an adapter stay within its limit. The pool is thread safe
+    and should be shared by all pollers.
+    """
+
+    def __init__(
+        self, idle_timeout=DEFAULT_IDLE_TIMEOUT, max_size=DEFAULT_KEEP_ALIVE_SIZE
+    ):
+        self.idle_timeout = idle_timeout
+        self.max_size = max_size
+        # (backend, pool, initialized, expiry) per (pool, mac), oldest first
+        self._connections = OrderedDict()
+        self._condition = Condition()
+        self._reaper = None
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, pool, mac):
+        """Take the open connection to a sensor.
+
+        Returns the backend instance and whether the sensor was initialized in
+        this connection, or None if there is no open connection.
+        """
+        mac = mac.upper()
+        with self._condition:
+            entry = self._connections.pop((pool, mac), None)
+            # a sensor accepts only one connection, close those of other pools
+            others = [key for key in self._connections if key[1] == mac]
+            closed = [self._connections.pop(key) for key in others]
+            if entry is None:
+                self.misses += 1
+        for other in closed:
+            self._close(other)
+        if entry is None:
+            return None
+        backend, _, initialized, _ = entry
+        is_connected = getattr(backend, "is_connected", None)
+        if is_connected is not None and not is_connected():
+            self._close(entry)
+            with self._condition:
+                self.misses += 1
+            return None
+        with self._condition:
+            self.hits += 1
+        return backend, initialized
+
+    def put(self, pool, mac, backend, initialized=False):
+        """Keep a connection to a sensor open after it was used."""
+        key = (pool, mac.upper())
+        expiry = time.monotonic() + self.idle_timeout
+        with self._condition:
+            closed = [self._connections.pop(key)] if key in self._connections else []
+            self._connections[key] = (backend, pool, initialized, expiry)
+            closed += self._evict(pool.adapter, self.max_size)
+            if self._reaper is None and self._connections:
+                self._reaper = Thread(target=self._reap, daemon=True)
+                self._reaper.start()
+            self._condition.notify_all()
+        for entry in closed:
+            self._close(entry)
+
+    def trim(self, adapter, size):
+        """Close the least recently used connections beyond `size` on an adapter."""
+        with self._condition:
+            closed = self._evict(adapter, size)
+        for entry in closed:
+            self._close(entry)
+
+    def _evict(self, adapter, size):
+        """Remove the oldest entries beyond `size`, the condition must be held."""
+        keys = [key for key in self._connections if key[0].adapter == adapter]
+        return [self._connections.pop(key) for key in keys[: max(len(keys) - size, 0)]]
+
+    def __len__(self):
+        with self._condition:
+            return len(self._connections)
+
+    def clear(self):
+        """Close all kept connections."""
+        with self._condition:
+            closed = list(self._connections.values())
+            self._connections.clear()
+            self._condition.notify_all()
+        for entry in closed:
+            self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        """Disconnect a kept connection and return it to its pool."""
+        backend, pool, _, _ = entry
+        try:
+            backend.disconnect()
+        except BluetoothBackendException as error:
+            _LOGGER.debug("Closing a kept connection failed: %s", error)
+        finally:
+            pool.release(backend)
+
+    def _reap(self):
+        """Close the expired connections, runs in a helper thread."""
+        while True:
+            with self._condition:
+                if not self._connections:
+                    self._reaper = None
+                    return
+                now = time.monotonic()
+                expired = [
+                    key for key, entry in self._connections.items() if entry[3] <= now
+                ]
+                closed = [self._connections.pop(key) for key in expired]
+                if not closed:
+                    self._condition.wait(
+                        min(entry[3] for entry in self._connections.values()) - now
+                    )
+            for entry in closed:
+                self._close(entry)
+
+
+class AdapterConnection:
+    """Context manager for a connection holding a slot of the adapter limiter.
+
+    This replaces the connection of btlewrap, which serializes all connections
+    of the process, no matter on which adapter. Waiting for the slot is limited
+    to `timeout` seconds. The backend instance is taken from `pool` for the time
+    of the connection.
+
+    With `keep_alive`, a KeepAlivePool, an open connection to the sensor is
+    reused and the connection is kept open afterwards unless it failed or was
+    discarded. `initialized` tells whether the sensor was already prepared in
+    this connection, e.g. with the mode change. `reused` tells whether the
+    connection was kept open since an earlier operation, so that the sensor
+    may have closed it meanwhile.
+    """
+
+    def __init__(
+        self,
+        pool,
+        mac,
+        limiter,
+        timeout=DEFAULT_WAIT_TIMEOUT,
+        priority=PRIORITY_INTERACTIVE,
+        keep_alive=None,
+    ):  # pylint: disable=too-many-arguments
+        self._pool = pool
+        self._backend = None
+        self._mac = mac
+        self._limiter = limiter
+        self._timeout = timeout
+        self._priority = priority
+        self._lock = Lock()
+        self._holds_slot = False
+        self._abandoned = False
+        self._connected = False
+        self._keep_alive = keep_alive
+        self._reusable = True
+        self.initialized = False
+        self.reused = False
+
+    def __enter__(self):
+        if not self._limiter.acquire(self._timeout, self._priority):
+            raise BluetoothTimeoutException(
+                f"Timed out waiting for a connection slot for sensor {self._mac}"
+            )
+        with self._lock:
+            if self._abandoned:
+                self._limiter.release()
+                raise BluetoothTimeoutException("Connection was abandoned")
+            self._holds_slot = True
+        if self._keep_alive is not None:
+            kept = self._keep_alive.take(self._pool, self._mac)
+            if kept is not None:
+                self._backend, self.initialized = kept
+                self._connected = True
+                self.reused = True
+                return self._backend
+            # the kept connections count against the connection limit
+            self._keep_alive.trim(self._pool.adapter, self._limiter.free)
+        try:
+            self._backend = self._pool.acquire()
+        except:  # noqa: E722
+            self._release_slot()
+            raise
+        try:
+            self._backend.connect(self._mac)
+        except:  # noqa: E722
+            self._pool.release(self._backend)
+            self._release_slot()
+            raise
+        self._connected = True
+        return self._backend
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._connected:
+            self._connected = False
+            if (
+                self._keep_alive is not None
+                and exc_type is None
+                and self._reusable
+                and not self._abandoned
+            ):
+                self._keep_alive.put(
+                    self._pool, self._mac, self._backend, self.initialized
+                )
+                self._release_slot()
+                return
+            try:
+                self._backend.disconnect()
+            finally:
+                self._pool.release(self._backend)
+                self._release_slot()
+
+    def _release_slot(self):
+        """Release the connection slot if it is still held."""
+        with self._lock:
+            if self._holds_slot:
+                self._holds_slot = False
+                self._limiter.release()
+
+    def discard(self):
+        """Close the connection after its use instead of keeping it open."""
+        self._reusable = False
+
+    def abandon(self):
+        """Give up the connection slot while a call of the backend is hung.
+
+        The hung call keeps running, but the other sensors on the adapter can be
+        used again. The connection is still closed when the call has finished.
+        """
+        with self._lock:
+            self._abandoned = True
+        self._release_slot()
@@ -0,0 +1,288 @@
+"""
+Deadlines and cancellation for Bluetooth operations.
+
+The backends have their own internal timeouts, which can be very long (e.g. a
+hanging gatttool). Calls with a deadline are run in a helper thread. If the
+call does not finish in time, the caller gets a BluetoothTimeoutException while
+the helper thread is abandoned. A connection opened by an abandoned call is
+closed as soon as the call finishes.
+
+A thread cannot be killed, so the abandoned call keeps the backend busy until it
+returns. Only its adapter slot is given up, see miflora_concurrency. To really
+stop hung calls, run the backend in a worker process with
+miflora_worker.ProcessBackend, which kills the worker after its call_timeout.
+"""
+
+import logging
+import time
+from threading import Event, Lock, Thread
+from types import GeneratorType
+
+from btlewrap.base import BluetoothBackendException
+
+_LOGGER = logging.getLogger(__name__)
+
+_END = object()
+# seconds between the checks for a cancellation while waiting for a call
+_CANCEL_POLL_INTERVAL = 0.05
+
+
+class BluetoothTimeoutException(BluetoothBackendException):
+    """A Bluetooth operation did not finish before its deadline."""
+
+
+class Timeouts:  # pylint: disable=too-few-public-methods
+    """Time budgets in seconds for Bluetooth operations.
+
+    `connect` limits establishing a connection, `io` every single read or write
+    and `operation` everything done within one connection. None means no limit.
+    """
+
+    def __init__(self, connect=None, io=None, operation=None):
+        self.connect = connect
+        self.io = io  # pylint: disable=invalid-name
+        self.operation = operation
+
+
+class Deadline:
+    """Point in time by which an operation must be finished.
+
+    A deadline can also be cancelled, e.g. from another thread. Then the running
+    call is abandoned and all further checks fail.
+    """
+
+    def __init__(self, timeout=None):
+        self._end = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = Event()
+
+    def remaining(self):
+        """Return the remaining time in seconds or None if there is no limit."""
+        if self._end is None:
+            return None
+        return max(self._end - time.monotonic(), 0.0)
+
+    def cancel(self):
+        """Cancel the operation."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        """Check if the operation was cancelled."""
+        return self._cancelled.is_set()
+
+    def timeout(self, limit=None):
+        """Return the time available for the next step.
+
+        This is the minimum of `limit` and the remaining time. Raises a
+        BluetoothTimeoutException if the deadline has passed or was cancelled.
+        """
+        if self.cancelled:
+            raise BluetoothTimeoutException("Operation was cancelled")
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise BluetoothTimeoutException("Deadline of the operation has passed")
+        if remaining is None:
+            return limit
+        if limit is None:
+            return remaining
+        return min(limit, remaining)
+
+
+def call_with_timeout(func, args=(), timeout=None, cleanup=None, deadline=None):
+    """Call func(*args) and wait at most `timeout` seconds for the result.
+
+    If the call does not finish in time or `deadline` is cancelled meanwhile, a
+    BluetoothTimeoutException is raised. `cleanup()` is called when the
+    abandoned call finishes later. Without a timeout and a deadline, func is
+    called directly.
+    """
+    if timeout is None and deadline is None:
+        return func(*args)
+    finished = Event()
+    state = {"abandoned": False}
+    state_lock = Lock()
+
+    def _run():
+        try:
+            state["result"] = func(*args)
+        except BaseException as error:  # pylint: disable=broad-except
+            state["error"] = error
+        finished.set()
+        with state_lock:
+            abandoned = state["abandoned"]
+        if abandoned and cleanup is not None:
+            _LOGGER.debug("Cleaning up after abandoned call of %s", func)
+            cleanup()
+
+    thread = Thread(target=_run, daemon=True)
+    thread.start()
+    if deadline is None:
+        finished.wait(timeout)
+    else:
+        end = None if timeout is None else time.monotonic() + timeout
+        while not deadline.cancelled:
+            wait = _CANCEL_POLL_INTERVAL
+            if end is not None:
+                wait = min(wait, end - time.monotonic())
+            if wait <= 0 or finished.wait(wait):
+                break
+    with state_lock:
+        if not finished.is_set():
+            state["abandoned"] = True
+            raise BluetoothTimeoutException(
+                f"Call of {getattr(func, '__name__', func)} timed out after {timeout} s"
+                if deadline is None or not deadline.cancelled
+                else f"Call of {getattr(func, '__name__', func)} was cancelled"
+            )
+    if "error" in state:
+        raise state["error"]
+    return state.get("result")
+
+
+class DeadlineConnection:
+    """Connection to a sensor where every call has a deadline.
+
+    This wraps the connection context manager of a BluetoothInterface. Reads,
+    writes and the optional methods of the backend are forwarded with a timeout.
+    After a call timed out, the connection is broken and all further calls fail.
+    It is closed as soon as the abandoned call has finished.
+    """
+
+    def __init__(self, connection, timeouts, deadline=None):
+        self._connection = connection
+        self._backend = None
+        self._timeouts = timeouts
+        self.deadline = Deadline(timeouts.operation) if deadline is None else deadline
+        # only a deadline of the caller can be cancelled while a call is running
+        self._cancellable = deadline
+        self._lock = Lock()
+        self._broken = False
+        self._abandoned_call_finished = False
+        self._exited = False
+
+    def __enter__(self):
+        try:
+            self._backend = call_with_timeout(
+                self._connection.__enter__,
+                timeout=self.deadline.timeout(self._timeouts.connect),
+                cleanup=self._disconnect,
+                deadline=self._cancellable,
+            )
+        except BluetoothTimeoutException:
+            self._abandon()
+            raise
+        return self
+
+    @property
+    def initialized(self):
+        """Whether the sensor was already prepared in the wrapped connection."""
+        return getattr(self._connection, "initialized", False)
+
+    @initialized.setter
+    def initialized(self, value):
+        self._connection.initialized = value
+
+    @property
+    def reused(self):
+        """Whether the wrapped connection was kept open since an earlier operation."""
+        return getattr(self._connection, "reused", False)
+
+    @reused.setter
+    def reused(self, value):
+        self._connection.reused = value
+
+    @property
+    def broken(self):
+        """Whether a call timed out, so that all further calls fail."""
+        return self._broken
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None or self._broken:
+            # a failed connection must not be kept open for reuse
+            discard = getattr(self._connection, "discard", None)
+            if discard is not None:
+                discard()
+        with self._lock:
+            self._exited = True
+            if self._broken and not self._abandoned_call_finished:
+                # the backend is still busy, disconnect when the call finished
+                return
+        self._disconnect()
+
+    def _disconnect(self):
+        """Close the connection. This is safe to call several times."""
+        try:
+            call_with_timeout(
+                self._connection.__exit__,
+                (None, None, None),
+                timeout=self._timeouts.connect,
+            )
+        except BluetoothTimeoutException:
+            _LOGGER.warning("Disconnecting timed out")
+
+    def _abandon(self):
+        """Let the connection give up its resources, e.g. its adapter slot."""
+        abandon = getattr(self._connection, "abandon", None)
+        if abandon is not None:
+            abandon()
+
+    def _on_abandoned_call_finished(self):
+        """Disconnect if the connection was left while the call was running."""
+        with self._lock:
+            self._abandoned_call_finished = True
+            exited = self._exited
+        if exited:
+            self._disconnect()
+
+    def _call(self, func, *args):
+        """Call a method of the backend with the deadline."""
+        if self._broken:
+            raise BluetoothTimeoutException("Connection broken by an earlier timeout")
+        try:
+            return call_with_timeout(
+                func,
+                args,
+                timeout=self.deadline.timeout(self._timeouts.io),
+                cleanup=self._on_abandoned_call_finished,
+                deadline=self._cancellable,
+            )
+        except BluetoothTimeoutException:
+            self._broken = True
+            self._abandon()
+            raise
+
+    def read_handle(self, handle):
+        """Read a handle with a deadline."""
+        return self._call(self._backend.read_handle, handle)
+
+    def write_handle(self, handle, value):
+        """Write a handle with a deadline."""
+        return self._call(self._backend.write_handle, handle, value)
+
+    def _iterate(self, iterator):
+        """Yield the items of a generator, each with a deadline."""
+        while True:
+            item = self._call(next, iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def _call_optional(self, func, *args):
+        """Call an optional method of the backend with the deadline.
+
+        If the method returns a generator, the I/O happens while iterating, so
+        every item gets the deadline.
+        """
+        result = self._call(func, *args)
+        if isinstance(result, GeneratorType):
+            return self._iterate(result)
+        return result
+
+    def __getattr__(self, name):
+        """Forward the optional methods of the backend with a deadline."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attribute = getattr(self._backend, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args: self._call_optional(attribute, *args)
@@ -0,0 +1,225 @@
+"""
+Decode the binary payloads of the Mi Flora family of sensors.
+
+All payload layouts are kept in one registry of precompiled structs. The registry is
+keyed by the kind of payload (live sensor data, history entries or advertisement
+objects) and a key specific to that kind, e.g. the payload length for live data.
+New sensor models can be supported by registering another decoder, without having
+to touch the poller.
+"""
+
+from struct import Struct
+
+MI_TEMPERATURE = "temperature"
+MI_LIGHT = "light"
+MI_MOISTURE = "moisture"
+MI_CONDUCTIVITY = "conductivity"
+MI_BATTERY = "battery"
+
+# kinds of payloads, used as the first part of the registry key
+SENSOR_DATA = "sensor"
+HISTORY_DATA = "history"
+ADVERTISEMENT_DATA = "advertisement"
+
+MODEL_FLOWER_CARE = "Flower Care"
+MODEL_ROPOT = "Ropot"
+
+# product ids used in the MiBeacon advertisements
+MIBEACON_PRODUCT_IDS = {0x0098: MODEL_FLOWER_CARE, 0x015D: MODEL_ROPOT}
+MIBEACON_SERVICE_UUID = 0xFE95
+
+_MIBEACON_HEADER = Struct("<HHB")
+_MIBEACON_OBJECT_HEADER = Struct("<HB")
+_FRAME_ENCRYPTED = 0x08
+_FRAME_HAS_MAC = 0x10
+_FRAME_HAS_CAPABILITY = 0x20
+_FRAME_HAS_OBJECT = 0x40
+
+_DECODERS = dict()
+
+
+class PayloadDecoder:  # pylint: disable=too-few-public-methods
+    """Decoder for one fixed binary layout.
+
+    The layout is compiled into a struct.Struct once. Each unpacked value is stored
+    under the name given in `fields`. `scale` divides values by a constant,
+    `constants` adds fixed values (e.g. for measurements a model does not support)
+    and `convert` is an optional callable that post-processes the raw values before
+    scaling.
+    """
+
+    def __init__(
+        self, model, fmt, fields, scale=None, constants=None, convert=None
+    ):  # pylint: disable=too-many-arguments
+        self.model = model
+        self.struct = Struct(fmt)
+        self.size = self.struct.size
+        self.fields = tuple(fields)
+        self.scale = dict() if scale is None else dict(scale)
+        self.constants = dict() if constants is None else dict(constants)
+        self._convert = convert
+
+    def decode(self, data, offset=0):
+        """Decode the payload starting at `offset`.
+
+        `data` can be any object supporting the buffer protocol. A memoryview is
+        decoded in place without copying.
+        """
+        res = dict(zip(self.fields, self.struct.unpack_from(data, offset)))
+        if self._convert is not None:
+            self._convert(res)
+        for key, divisor in self.scale.items():
+            res[key] = res[key] / divisor
+        res.update(self.constants)
+        return res
+
+
+def register_decoder(kind, key, decoder):
+    """Register a decoder for a kind of payload.
+
+    An existing decoder for the same kind and key is replaced.
+    """
+    _DECODERS[(kind, key)] = decoder
+
+
+def get_decoder(kind, key):
+    """Return the decoder for a kind of payload or None if there is none."""
+    return _DECODERS.get((kind, key))
+
+
+def decode(kind, data, key=None):
+    """Decode a payload with the registered decoder.
+
+    If no key is given, the length of the payload is used. Raises a KeyError if no
+    decoder was registered for this payload.
+    """
+    if key is None:
+        key = len(data)
+    decoder = get_decoder(kind, key)
+    if decoder is None:
+        raise KeyError(f"No decoder for {kind} data with key {key}")
+    return decoder.decode(data)
+
+
+def decode_mibeacon(service_data):
+    """Decode the service data of a MiBeacon advertisement.
+
+    Returns a dictionary with the product id, the model, the frame counter, the
+    mac (if included) and the measurement of the included object. Returns None
+    if the frame is encrypted, has no object or contains an unknown object.
+    """
+    data = memoryview(service_data)
+    frame_control, product_id, frame_counter = _MIBEACON_HEADER.unpack_from(data)
+    offset = _MIBEACON_HEADER.size
+    if frame_control & _FRAME_ENCRYPTED or not frame_control & _FRAME_HAS_OBJECT:
+        return None
+    res = {
+        "product_id": product_id,
+        "model": MIBEACON_PRODUCT_IDS.get(product_id),
+        "frame_counter": frame_counter,
+    }
+    if frame_control & _FRAME_HAS_MAC:
+        res["mac"] = ":".join(
+            format(c, "02X") for c in reversed(data[offset : offset + 6])
+        )
+        offset += 6
+    if frame_control & _FRAME_HAS_CAPABILITY:
+        offset += 1
+    if len(data) < offset + _MIBEACON_OBJECT_HEADER.size:
+        return None
+    object_type, length = _MIBEACON_OBJECT_HEADER.unpack_from(data, offset)
+    offset += _MIBEACON_OBJECT_HEADER.size
+    decoder = get_decoder(ADVERTISEMENT_DATA, object_type)
+    if decoder is None or length < decoder.size or len(data) < offset + decoder.size:
+        return None
+    res.update(decoder.decode(data, offset))
+    return res
+
+
+def _convert_history(res):
+    """Restore temperature and brightness of a history entry."""
+    # negative temperatures are stored in one's complement
+    if res[MI_TEMPERATURE] & 0x8000:
+        res[MI_TEMPERATURE] ^= 0xFFFF
+    # brightness is stored in 3 bytes
+    res[MI_LIGHT] = res.pop("light_low") | res.pop("light_high") << 16
+
+
+def _convert_illuminance(res):
+    """Combine the 3 bytes of the illuminance object."""
+    res[MI_LIGHT] = res.pop("light_low") | res.pop("light_high") << 16
+
+
+# semantics of the data (in little endian encoding):
+# bytes   0-1: temperature in 0.1 °C
+# byte      2: unknown
+# bytes   3-6: brightness in Lux (MiFlora only)
+# byte      7: moisture in %
+# bytes   8-9: conductivity in µS/cm
+# bytes 10-15: unknown
+register_decoder(
+    SENSOR_DATA,
+    16,
+    PayloadDecoder(
+        MODEL_FLOWER_CARE,
+        "<hxIBhxxxxxx",
+        (MI_TEMPERATURE, MI_LIGHT, MI_MOISTURE, MI_CONDUCTIVITY),
+        scale={MI_TEMPERATURE: 10.0},
+    ),
+)
+# the Ropot has no light sensor and returns 24 bytes
+register_decoder(
+    SENSOR_DATA,
+    24,
+    PayloadDecoder(
+        MODEL_ROPOT,
+        "<hxxxxxBhxxxxxxxxxxxxxx",
+        (MI_TEMPERATURE, MI_MOISTURE, MI_CONDUCTIVITY),
+        scale={MI_TEMPERATURE: 10.0},
+        constants={MI_LIGHT: False},
+    ),
+)
+# bytes   0-3: device time in seconds
+# bytes   4-5: temperature in 0.1 °C (one's complement)
+# byte      6: unknown
+# bytes   7-9: brightness in Lux
+# byte     10: unknown
+# byte     11: moisture in %
+# bytes 12-13: conductivity in µS/cm
+# bytes 14-15: unknown
+register_decoder(
+    HISTORY_DATA,
+    16,
+    PayloadDecoder(
+        None,
+        "<IHxHBxBHxx",
+        (
+            "device_time",
+            MI_TEMPERATURE,
+            "light_low",
+            "light_high",
+            MI_MOISTURE,
+            MI_CONDUCTIVITY,
+        ),
+        scale={MI_TEMPERATURE: 10.0},
+        convert=_convert_history,
+    ),
+)
+# objects in MiBeacon advertisements, keyed by object type
+register_decoder(
+    ADVERTISEMENT_DATA,
+    0x1004,
+    PayloadDecoder(None, "<h", (MI_TEMPERATURE,), scale={MI_TEMPERATURE: 10.0}),
+)
+register_decoder(
+    ADVERTISEMENT_DATA,
+    0x1007,
+    PayloadDecoder(
+        None, "<HB", ("light_low", "light_high"), convert=_convert_illuminance
+    ),
+)
+register_decoder(ADVERTISEMENT_DATA, 0x1008, PayloadDecoder(None, "<B", (MI_MOISTURE,)))
+register_decoder(
+    ADVERTISEMENT_DATA, 0x1009, PayloadDecoder(None, "<H", (MI_CONDUCTIVITY,))
+)
+register_decoder(ADVERTISEMENT_DATA, 0x100A, PayloadDecoder(None, "<B", (MI_BATTERY,)))
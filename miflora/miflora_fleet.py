@@ -0,0 +1,129 @@
+"""
+Engine for a fleet of sensors.
+
+Every MiFloraPoller normally has its own backend, cache and metadata. For large
+fleets the FleetEngine shares all of this instead: the state of every sensor is
+a compact record in a FleetState table, the backend instances are pooled per
+adapter and the metadata store is shared. MiFloraPoller objects are created on
+demand as thin views on a record, so the memory per sensor stays small.
+
+Components that create their own pollers for the same sensor can share one
+poller per sensor and adapter with get_poller instead, so that they also share
+its cache and the sensor is only read once per cache timeout.
+
+Example:
+    engine = FleetEngine(BluepyBackend)
+    engine.poller("C4:7C:8D:xx:xx:xx").parameter_value(MI_MOISTURE)
+    engine.readings()
+"""
+
+from threading import Lock
+
+from .miflora_concurrency import BackendPool
+from .miflora_decoder import MI_BATTERY, MI_TEMPERATURE, SENSOR_DATA, get_decoder
+from .miflora_metadata import DeviceMetadataStore
+from .miflora_poller import MiFloraPoller
+from .miflora_state import FleetState
+
+_POLLERS = dict()
+_POLLERS_LOCK = Lock()
+
+
+def get_poller(mac, backend, adapter="hci0", **kwargs):
+    """Return the poller shared by all users of a sensor on an adapter.
+
+    The poller is created with the arguments of the first call, later calls
+    get the same poller regardless of their `backend` and keyword arguments.
+    """
+    key = (mac.upper(), adapter)
+    with _POLLERS_LOCK:
+        poller = _POLLERS.get(key)
+        if poller is None:
+            poller = _POLLERS[key] = MiFloraPoller(
+                mac, backend, adapter=adapter, **kwargs
+            )
+        return poller
+
+
+def clear_pollers():
+    """Forget all shared pollers, the next get_poller creates new ones."""
+    with _POLLERS_LOCK:
+        _POLLERS.clear()
+
+
+class FleetEngine:
+    """Poll many sensors with shared state, backends and metadata.
+
+    The keyword arguments are passed to the MiFloraPoller views.
+    """
+
+    def __init__(
+        self,
+        backend,
+        cache_timeout=600,
+        metadata=None,
+        history_batch_size=16,
+        timeouts=None,
+    ):
+        self.state = FleetState()
+        self.metadata = DeviceMetadataStore() if metadata is None else metadata
+        self._backend = backend
+        self._pools = dict()
+        self._lock = Lock()
+        self._poller_kwargs = dict(
+            cache_timeout=cache_timeout,
+            history_batch_size=history_batch_size,
+            timeouts=timeouts,
+        )
+
+    def _pool(self, adapter):
+        """Return the backend pool of an adapter."""
+        with self._lock:
+            if adapter not in self._pools:
+                self._pools[adapter] = BackendPool(self._backend, adapter)
+            return self._pools[adapter]
+
+    def poller(self, mac, adapter="hci0"):
+        """Return a MiFloraPoller view on the state of a sensor."""
+        return MiFloraPoller(
+            mac,
+            self._pool(adapter),
+            adapter=adapter,
+            metadata=self.metadata,
+            state=self.state.get(mac),
+            **self._poller_kwargs,
+        )
+
+    def refresh(self, mac, adapter="hci0", deadline=None):
+        """Read a sensor unless its cached data is still valid.
+
+        Returns the reading, see `reading`.
+        """
+        self.poller(mac, adapter).parameter_value(MI_TEMPERATURE, deadline=deadline)
+        return self.reading(mac)
+
+    def reading(self, mac):
+        """Decode the cached data of a sensor, without creating a poller.
+
+        Returns a dictionary with the values or None if no data was read yet.
+        """
+        if mac not in self.state:
+            return None
+        state = self.state.get(mac)
+        if state.cache is None:
+            return None
+        decoder = get_decoder(SENSOR_DATA, len(state.cache))
+        if decoder is None:
+            return None
+        values = decoder.decode(state.cache)
+        values[MI_BATTERY] = state.battery
+        return values
+
+    def readings(self):
+        """Return the readings of all sensors with data, indexed by MAC address."""
+        readings = dict()
+        for state in self.state:
+            reading = self.reading(state.mac)
+            if reading is not None:
+                readings[state.mac] = reading
+        return readings
@@ -0,0 +1,199 @@
+"""
+Backend keeping one interactive gatttool session per connection.
+
+The GatttoolBackend of btlewrap starts a new gatttool process for every read and
+write, so reading a history of hundreds of entries spawns hundreds of
+processes and connects as often. The InteractiveGatttoolBackend starts
+`gatttool -I` once per connection and sends all commands over its stdin. The
+history transfer is pipelined: all commands of a batch are sent at once and the
+responses are collected afterwards, see miflora_transfer.
+
+Example:
+    poller = MiFloraPoller(mac, InteractiveGatttoolBackend)
+"""
+
+import logging
+import re
+import shutil
+from queue import Empty, Queue
+from subprocess import PIPE, STDOUT, Popen, TimeoutExpired
+from threading import Thread
+
+from btlewrap.base import AbstractBackend, BluetoothBackendException
+
+_LOGGER = logging.getLogger(__name__)
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+_VALUE = re.compile(r"Characteristic value/descriptor: ((?:[0-9a-fA-F]{2} ?)*)")
+_ERRORS = ("Error", "failed", "Failed", "refused", "Disconnected")
+
+# events parsed from the output of gatttool
+_CONNECTED = "connected"
+_VALUE_READ = "value"
+_WRITTEN = "written"
+_ERROR = "error"
+
+
+def _parse_line(line):
+    """Return the event of a line of gatttool output or None."""
+    line = _ANSI_ESCAPE.sub("", line)
+    match = _VALUE.search(line)
+    if match:
+        return _VALUE_READ, bytes.fromhex(match.group(1).replace(" ", ""))
+    if "Connection successful" in line:
+        return _CONNECTED, None
+    if "written successfully" in line:
+        return _WRITTEN, None
+    if any(error in line for error in _ERRORS):
+        return _ERROR, line.strip()
+    return None
+
+
+class InteractiveGatttoolBackend(AbstractBackend):
+    """Backend using one interactive gatttool process per connection.
+
+    `timeout` is the time in seconds to wait for a response of gatttool. If it
+    passes, the session is killed. `command` is the gatttool executable, a
+    string or a list of arguments.
+    """
+
+    def __init__(
+        self, adapter="hci0", *, address_type="public", timeout=20, command="gatttool"
+    ):
+        super().__init__(adapter, address_type)
+        self.timeout = timeout
+        self._command = [command] if isinstance(command, str) else list(command)
+        self._process = None
+        self._events = None
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """Check if gatttool is available."""
+        return shutil.which(self._command[0]) is not None
+
+    def _read_output(self, process, events):
+        """Parse the output of gatttool into events, runs in a helper thread."""
+        for line in iter(process.stdout.readline, b""):
+            line = line.decode("utf-8", "replace")
+            _LOGGER.debug("gatttool: %s", line.rstrip())
+            event = _parse_line(line)
+            if event is not None:
+                events.put(event)
+        process.stdout.close()
+        events.put((_ERROR, "gatttool exited"))
+
+    def _send(self, *commands):
+        """Send commands to gatttool."""
+        if self._process is None:
+            raise BluetoothBackendException("Not connected to any device.")
+        try:
+            self._process.stdin.write("".join(c + "\n" for c in commands).encode())
+            self._process.stdin.flush()
+        except OSError as error:
+            self._kill()
+            raise BluetoothBackendException("gatttool session lost") from error
+
+    def _expect(self, expected):
+        """Wait for the next event, which must be `expected`."""
+        try:
+            event, value = self._events.get(timeout=self.timeout)
+        except Empty:
+            self._kill()
+            raise BluetoothBackendException(  # pylint: disable=raise-missing-from
+                f"No response from gatttool within {self.timeout} s"
+            )
+        if event == _ERROR:
+            raise BluetoothBackendException(f"gatttool: {value}")
+        if event != expected:
+            self._kill()
+            raise BluetoothBackendException(f"Unexpected gatttool response {event}")
+        return value
+
+    def _kill(self):
+        """Stop the gatttool process."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            self._process = None
+
+    def connect(self, mac):
+        """Start a gatttool session and connect to the device."""
+        self._kill()
+        self._events = Queue()
+        self._process = Popen(  # pylint: disable=consider-using-with
+            self._command
+            + ["-i", self.adapter, "-b", mac, "-t", self.address_type, "-I"],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=STDOUT,
+        )
+        Thread(
+            target=self._read_output, args=(self._process, self._events), daemon=True
+        ).start()
+        self._send("connect")
+        try:
+            self._expect(_CONNECTED)
+        except BluetoothBackendException:
+            self._kill()
+            raise
+
+    def disconnect(self):
+        """Disconnect and end the gatttool session."""
+        if self._process is None:
+            return
+        process = self._process
+        try:
+            self._send("disconnect", "exit")
+            process.wait(self.timeout)
+        except (BluetoothBackendException, TimeoutExpired):
+            pass
+        self._kill()
+
+    def is_connected(self):
+        """Check if a gatttool session is running."""
+        return self._process is not None
+
+    def read_handle(self, handle):
+        """Read a handle of the device."""
+        self._send(f"char-read-hnd 0x{handle:04x}")
+        return self._expect(_VALUE_READ)
+
+    def write_handle(self, handle, value):
+        """Write a handle of the device and wait for the response."""
+        self._send(f"char-write-req 0x{handle:04x} {bytes(value).hex()}")
+        self._expect(_WRITTEN)
+        return True
+
+    def write_read_batch(self, write_handle, read_handle, values):
+        """Write each value and read the response, pipelined.
+
+        All commands are sent at once, the responses are yielded in order.
+        """
+        commands = []
+        for value in values:
+            commands.append(f"char-write-req 0x{write_handle:04x} {bytes(value).hex()}")
+            commands.append(f"char-read-hnd 0x{read_handle:04x}")
+        self._send(*commands)
+        # every command gets exactly one response, also after errors
+        pending = len(commands)
+        try:
+            for _ in values:
+                pending -= 1
+                self._expect(_WRITTEN)
+                pending -= 1
+                yield self._expect(_VALUE_READ)
+        finally:
+            self._drain(pending)
+
+    def _drain(self, count):
+        """Skip the responses to `count` commands, e.g. after an error in a batch."""
+        for _ in range(count):
+            if self._process is None:
+                return
+            try:
+                self._events.get(timeout=self.timeout)
+            except Empty:
+                self._kill()
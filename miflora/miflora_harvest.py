@@ -0,0 +1,209 @@
+"""
+Harvest the history of a fleet of sensors.
+
+The sensors only keep a limited history and downloading it is slow. The
+HistoryHarvester first reads the cheap history info of every sensor, ranks the
+sensors by the number of entries that are pending since the last harvest and
+then downloads the histories of the most at risk sensors first. The time spent
+on the air is bounded by a budget and the work is spread over all adapters.
+"""
+
+import logging
+import time
+from threading import Lock, Thread
+
+from btlewrap.base import BluetoothBackendException
+
+from .miflora_poller import HISTORY_INTERVAL, MiFloraPoller
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class HistoryHarvester:
+    """Download the history of many sensors, the most at risk ones first.
+
+    `airtime_budget` is the total time in seconds one harvest round may spend
+    talking to sensors. The time needed to download a history is estimated with
+    `seconds_per_entry`, which is updated with the measured transfer times.
+    `sink(mac, entries)` is called for every downloaded history. With `clear`,
+    the history is cleared on the device after the sink returned, see
+    MiFloraPoller.fetch_and_clear_history. This keeps the device histories and
+    the downloads short. Additional keyword arguments are passed to the
+    MiFloraPoller objects.
+    """
+
+    def __init__(
+        self,
+        macs,
+        backend,
+        adapters=("hci0",),
+        airtime_budget=600.0,
+        seconds_per_entry=0.5,
+        sink=None,
+        clear=False,
+        **poller_kwargs,
+    ):
+        if clear and sink is None:
+            raise ValueError("Clearing the history requires a sink")
+        self._macs = [mac.upper() for mac in macs]
+        self._backend = backend
+        self._adapters = list(adapters)
+        self.airtime_budget = airtime_budget
+        self.seconds_per_entry = seconds_per_entry
+        self._sink = sink
+        self._clear = clear
+        self._poller_kwargs = poller_kwargs
+        self._pollers = dict()
+        self._lock = Lock()
+        # history length at the last harvest and time of the last harvest per MAC
+        self.harvested_length = dict()
+        self.last_harvest = dict()
+        self.airtime_used = 0.0
+
+    def _poller(self, mac, adapter):
+        """Return the poller for a sensor on an adapter."""
+        with self._lock:
+            key = (mac, adapter)
+            if key not in self._pollers:
+                self._pollers[key] = MiFloraPoller(
+                    mac, self._backend, adapter=adapter, **self._poller_kwargs
+                )
+            return self._pollers[key]
+
+    def pending_entries(self, mac, history_length, now=None):
+        """Estimate the number of entries added since the last harvest.
+
+        The sensor writes one entry per hour. Once its buffer is full, the history
+        length stops growing while old entries are overwritten, so the time since
+        the last harvest is taken into account as well. The estimate is capped by
+        the history length.
+        """
+        harvested = self.harvested_length.get(mac, 0)
+        if history_length < harvested:
+            # the history was cleared or the device was reset
+            grown = history_length
+        else:
+            grown = history_length - harvested
+        last_harvest = self.last_harvest.get(mac)
+        if last_harvest is None:
+            return grown
+        elapsed = int(((now or time.time()) - last_harvest) // HISTORY_INTERVAL)
+        return min(max(grown, elapsed), history_length)
+
+    def rank(self, history_lengths):
+        """Order the sensors by risk of losing data.
+
+        Sensors with more pending entries come first. For the same number of
+        pending entries, the sensor harvested the longest time ago comes first.
+        """
+        return sorted(
+            history_lengths,
+            key=lambda mac: (
+                -self.pending_entries(mac, history_lengths[mac]),
+                self.last_harvest.get(mac, 0.0),
+            ),
+        )
+
+    def harvest(self):
+        """Run one harvest round.
+
+        Returns a dictionary with the downloaded history entries per MAC. Sensors
+        whose download does not fit into the remaining airtime budget are left for
+        the next round.
+        """
+        self.airtime_used = 0.0
+        history_lengths = dict()
+        self._run_workers(list(self._macs), self._read_history_length, history_lengths)
+        ranking = [
+            mac
+            for mac in self.rank(history_lengths)
+            if self.pending_entries(mac, history_lengths[mac]) > 0
+        ]
+        results = dict()
+        self._run_workers(
+            ranking,
+            lambda mac, adapter, res: self._fetch_history(
+                mac, adapter, history_lengths[mac], res
+            ),
+            results,
+        )
+        return results
+
+    def _run_workers(self, macs, func, results):
+        """Process the MACs in order with one worker thread per adapter."""
+
+        def _worker(adapter):
+            while True:
+                with self._lock:
+                    if not macs:
+                        return
+                    mac = macs.pop(0)
+                try:
+                    func(mac, adapter, results)
+                except Exception:  # pylint: disable=broad-except
+                    # one bad sensor or sink must not end the round
+                    _LOGGER.exception("Harvesting %s failed", mac)
+
+        threads = [Thread(target=_worker, args=(a,)) for a in self._adapters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _reserve_airtime(self, seconds):
+        """Reserve airtime from the budget, returns False if it is used up."""
+        with self._lock:
+            if self.airtime_used + seconds > self.airtime_budget:
+                return False
+            self.airtime_used += seconds
+            return True
+
+    def _add_airtime(self, seconds):
+        """Add airtime to the used airtime, e.g. to correct a reservation."""
+        with self._lock:
+            self.airtime_used += seconds
+
+    def _read_history_length(self, mac, adapter, results):
+        """Read the history length of a sensor."""
+        if not self._reserve_airtime(0):
+            return
+        start = time.time()
+        try:
+            results[mac] = self._poller(mac, adapter).history_length()
+        except BluetoothBackendException as error:
+            _LOGGER.warning("Could not read history info of %s: %s", mac, error)
+        finally:
+            self._add_airtime(time.time() - start)
+
+    def _fetch_history(self, mac, adapter, history_length, results):
+        """Download the history of a sensor if the budget allows it."""
+        estimate = history_length * self.seconds_per_entry
+        if not self._reserve_airtime(estimate):
+            _LOGGER.info("Not enough airtime left to harvest %s", mac)
+            return
+        start = time.time()
+        try:
+            poller = self._poller(mac, adapter)
+            if self._clear:
+                entries = poller.fetch_and_clear_history(
+                    lambda entries: self._sink(mac, entries)
+                )
+            else:
+                entries = poller.fetch_history()
+        except BluetoothBackendException as error:
+            _LOGGER.warning("Could not harvest the history of %s: %s", mac, error)
+            return
+        finally:
+            duration = time.time() - start
+            self._add_airtime(duration - estimate)
+        if history_length > 0:
+            with self._lock:
+                # exponential moving average of the measured transfer speed
+                self.seconds_per_entry = (
+                    0.8 * self.seconds_per_entry + 0.2 * duration / history_length
+                )
+        if self._sink is not None and not self._clear:
+            self._sink(mac, entries)
+        self.harvested_length[mac] = 0 if self._clear else history_length
+        self.last_harvest[mac] = time.time()
+        results[mac] = entries
@@ -0,0 +1,208 @@
+"""
+Hedged reads across adapters.
+
+Most reads of a sensor are fast, but now and then connecting on one adapter
+takes 20 seconds or more. Hedging cuts off this tail: if a read on the primary
+adapter has not finished within a percentile of its recent latencies, the same
+read is started on a second adapter. The first result wins and the other read is
+cancelled.
+
+Hedging costs airtime, the cancelled reads still kept an adapter busy. The
+HedgeStats of a Hedging show how often reads were hedged and how much airtime
+was spent on reads whose result was not used.
+"""
+
+import logging
+import time
+from collections import deque
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+from .miflora_deadline import BluetoothTimeoutException, Deadline
+
+_LOGGER = logging.getLogger(__name__)
+
+_HEDGE = 1
+
+
+class HedgeStats:  # pylint: disable=too-few-public-methods
+    """Accounting of the hedged reads.
+
+    `reads` is the number of reads, `hedged` the number of reads for which a
+    second read was started and `hedge_wins` how often the second read won.
+    `airtime` is the total time in seconds of all reads on the adapters and
+    `wasted_airtime` the part of it spent on reads that lost the race.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.airtime = 0.0
+        self.wasted_airtime = 0.0
+
+    @property
+    def overhead(self):
+        """Extra airtime caused by hedging relative to the useful airtime."""
+        useful = self.airtime - self.wasted_airtime
+        if useful <= 0:
+            return 0.0
+        return self.wasted_airtime / useful
+
+
+class Hedging:
+    """Start slow reads a second time on another adapter.
+
+    `adapter` is the adapter for the second read. A read is hedged if it takes
+    longer than the `percentile` of the latencies of the last `window` reads.
+    Until `min_samples` latencies are known, reads are not hedged. A Hedging can
+    be shared by many pollers using the same adapters.
+    """
+
+    def __init__(self, adapter, percentile=95, window=100, min_samples=10):
+        if not 0 < percentile <= 100:
+            raise ValueError("The percentile must be in (0, 100]")
+        self.adapter = adapter
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.stats = HedgeStats()
+        self._latencies = deque(maxlen=window)
+        self._lock = Lock()
+
+    def record(self, latency):
+        """Record the latency of a read in seconds."""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def delay(self):
+        """Return after how many seconds a read is hedged, None if never."""
+        with self._lock:
+            if len(self._latencies) < max(self.min_samples, 1):
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _account(self, airtime, lost=False, hedged=False, hedge_won=False):
+        """Update the statistics, from any thread."""
+        with self._lock:
+            self.stats.airtime += airtime
+            if lost:
+                self.stats.wasted_airtime += airtime
+            if hedged:
+                self.stats.hedged += 1
+            if hedge_won:
+                self.stats.hedge_wins += 1
+
+    def call(self, primary, hedge, deadline=None):
+        """Read with primary(deadline) and, if it is slow, also with hedge(deadline).
+
+        Both functions get their own Deadline, which is cancelled if the other
+        read won. Returns the first result. If both reads fail, the error of the
+        last one is raised. If the primary read fails before the read was hedged,
+        the hedge is started right away.
+        """
+        with self._lock:
+            self.stats.reads += 1
+        delay = self.delay()
+        start = time.monotonic()
+        if delay is None:
+            try:
+                result = primary(deadline)
+            finally:
+                self._account(time.monotonic() - start)
+            self.record(time.monotonic() - start)
+            return result
+        return _HedgedRead(self, deadline).run(primary, hedge, start + delay)
+
+
+class _HedgedRead:  # pylint: disable=too-few-public-methods
+    """State of one hedged read."""
+
+    def __init__(self, hedging, deadline):
+        self._hedging = hedging
+        self._deadline = deadline
+        self._results = Queue()
+        self._deadlines = []
+        self._winner = None
+        self._lock = Lock()
+
+    def _start(self, func):
+        """Run func in a helper thread with its own deadline."""
+        index = len(self._deadlines)
+        deadline = Deadline(
+            None if self._deadline is None else self._deadline.remaining()
+        )
+        self._deadlines.append(deadline)
+
+        def _run():
+            began = time.monotonic()
+            try:
+                result = (True, func(deadline))
+            except Exception as error:  # pylint: disable=broad-except
+                result = (False, error)
+            with self._lock:
+                lost = self._winner is not None and self._winner != index
+            self._hedging._account(  # pylint: disable=protected-access
+                time.monotonic() - began, lost=lost
+            )
+            self._results.put((index,) + result)
+
+        Thread(target=_run, daemon=True).start()
+
+    def _wait(self, hedge_at):
+        """Wait for the next result until the hedge is due or the deadline passed."""
+        timeout = None if self._deadline is None else self._deadline.remaining()
+        if hedge_at is not None:
+            wait = max(hedge_at - time.monotonic(), 0.0)
+            timeout = wait if timeout is None else min(timeout, wait)
+        try:
+            return self._results.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def _cancel(self, winner=None):
+        """Cancel all reads except the winner."""
+        with self._lock:
+            self._winner = winner
+        for index, deadline in enumerate(self._deadlines):
+            if index != winner:
+                deadline.cancel()
+
+    def run(self, primary, hedge, hedge_at):
+        """Run the reads and return the first result."""
+        start = time.monotonic()
+        self._start(primary)
+        pending = 1
+        error = None
+        while True:
+            result = self._wait(hedge_at)
+            if result is None:
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    _LOGGER.debug("Hedging a read after %.3f s", hedge_at - start)
+                    hedge_at = None
+                    self._start(hedge)
+                    pending += 1
+                    continue
+                self._cancel()
+                raise BluetoothTimeoutException(
+                    "Deadline of the hedged read has passed"
+                )
+            index, success, value = result
+            pending -= 1
+            if success:
+                self._cancel(index)
+                self._hedging.record(time.monotonic() - start)
+                self._hedging._account(  # pylint: disable=protected-access
+                    0.0, hedged=len(self._deadlines) > 1, hedge_won=index == _HEDGE
+                )
+                return value
+            error = value
+            if hedge_at is not None:
+                # the primary read failed, try the other adapter right away
+                hedge_at = time.monotonic()
+            elif pending == 0:
+                self._hedging._account(  # pylint: disable=protected-access
+                    0.0, hedged=True
+                )
+                raise error
@@ -0,0 +1,245 @@
+"""
+Columnar export of the sensor history.
+
+MiFloraPoller.fetch_history returns a HistoryData, a list of HistoryEntry objects
+that also keeps the raw 16 byte entries in one buffer and the wall times in a
+typed array. to_numpy, to_arrow and to_pandas build the columns directly from
+these buffers with vectorized operations, without touching the Python objects
+of the entries. concat_arrow and concat_pandas combine the histories of many
+sensors into one table.
+
+numpy is needed for the export, pyarrow for Arrow tables and pandas for data
+frames. They are imported only when used, install them with
+`pip install miflora[export]`.
+"""
+
+import importlib
+from array import array
+
+from .miflora_decoder import MI_CONDUCTIVITY, MI_LIGHT, MI_MOISTURE, MI_TEMPERATURE
+
+ENTRY_SIZE = 16
+DEVICE_TIME = "device_time"
+WALL_TIME = "wall_time"
+COLUMNS = (
+    DEVICE_TIME,
+    WALL_TIME,
+    MI_TEMPERATURE,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_CONDUCTIVITY,
+)
+
+
+def _require(module):
+    """Import an optional dependency of the export."""
+    try:
+        return importlib.import_module(module)
+    except ImportError as error:
+        raise ImportError(
+            f"{module} is needed to export the history, "
+            f"install it with `pip install miflora[export]`"
+        ) from error
+
+
+class HistoryData(list):
+    """History entries with their raw data in one buffer.
+
+    `raw` holds the raw entries back to back and `wall_times` the wall times of
+    the entries in seconds since the epoch (UTC), NaN if they are unknown. `add`
+    and extending with another HistoryData append to the buffers. After any
+    other change of the list, the buffers are rebuilt from the `raw` and
+    `wall_time` attributes of the entries when they are used next.
+    """
+
+    def __init__(self, entries=()):
+        super().__init__()
+        self._raw = bytearray()
+        self._wall_times = array("d")
+        self._stale = False
+        self.extend(entries)
+
+    @property
+    def raw(self):
+        """The raw entries back to back."""
+        if self._stale:
+            self._rebuild()
+        return self._raw
+
+    @property
+    def wall_times(self):
+        """The wall times of the entries as array of floats."""
+        if self._stale:
+            self._rebuild()
+        return self._wall_times
+
+    def _rebuild(self):
+        """Rebuild the buffers from the entries."""
+        self._raw = bytearray(b"".join(entry.raw for entry in self))
+        self._wall_times = array(
+            "d",
+            (
+                float("nan") if entry.wall_time is None else entry.wall_time.timestamp()
+                for entry in self
+            ),
+        )
+        self._stale = False
+
+    def add(self, entry, raw):
+        """Append an entry with its raw data."""
+        super().append(entry)
+        if not self._stale:
+            self._raw += raw
+            self._wall_times.append(float("nan"))
+
+    def extend(self, entries):
+        """Append entries, the buffers of a HistoryData are copied."""
+        if isinstance(entries, HistoryData) and not self._stale:
+            super().extend(entries)
+            self._raw += entries.raw
+            self._wall_times.extend(entries.wall_times)
+            return
+        entries = list(entries)
+        if entries:
+            super().extend(entries)
+            self._stale = True
+
+    def _check(self):
+        """Make sure the buffers match the entries."""
+        if len(self.raw) != len(self) * ENTRY_SIZE or len(self.wall_times) != len(self):
+            raise ValueError("The raw history data does not match the entries")
+
+    def to_numpy(self):
+        """Return the columns as dictionary of numpy arrays.
+
+        The columns are the names in COLUMNS. The wall time is a float in
+        seconds since the epoch, the temperature in °C.
+        """
+        numpy = _require("numpy")
+        self._check()
+        # layout of the history entries, see miflora_decoder
+        records = numpy.frombuffer(
+            bytes(self.raw),
+            dtype=numpy.dtype(
+                {
+                    "names": [
+                        DEVICE_TIME,
+                        "temperature_raw",
+                        "light_low",
+                        "light_high",
+                        MI_MOISTURE,
+                        MI_CONDUCTIVITY,
+                    ],
+                    "formats": ["<u4", "<u2", "<u2", "u1", "u1", "<u2"],
+                    "offsets": [0, 4, 7, 9, 11, 12],
+                    "itemsize": ENTRY_SIZE,
+                }
+            ),
+        )
+        temperature = records["temperature_raw"]
+        # negative temperatures are stored in one's complement
+        temperature = numpy.where(
+            temperature & 0x8000, temperature ^ 0xFFFF, temperature
+        )
+        return {
+            DEVICE_TIME: records[DEVICE_TIME],
+            # copied, so that the buffer of the wall times can still grow
+            WALL_TIME: numpy.frombuffer(self.wall_times, dtype=numpy.float64).copy(),
+            MI_TEMPERATURE: temperature / 10.0,
+            MI_LIGHT: records["light_low"].astype(numpy.uint32)
+            | records["light_high"].astype(numpy.uint32) << 16,
+            MI_MOISTURE: records[MI_MOISTURE],
+            MI_CONDUCTIVITY: records[MI_CONDUCTIVITY],
+        }
+
+    def to_arrow(self, mac=None):
+        """Return the history as pyarrow Table.
+
+        The wall time is a UTC timestamp. With `mac`, a dictionary encoded column
+        "mac" is added, so that the tables of many sensors can be concatenated.
+        """
+        pyarrow = _require("pyarrow")
+        numpy = _require("numpy")
+        columns = self.to_numpy()
+        arrays = [pyarrow.array(columns[name]) for name in COLUMNS]
+        arrays[1] = pyarrow.array(
+            (columns[WALL_TIME] * 1e6).astype(numpy.int64),
+            type=pyarrow.timestamp("us", tz="UTC"),
+            mask=numpy.isnan(columns[WALL_TIME]),
+        )
+        names = list(COLUMNS)
+        if mac is not None:
+            arrays.insert(
+                0,
+                pyarrow.DictionaryArray.from_arrays(
+                    numpy.zeros(len(self), dtype=numpy.int32), [mac]
+                ),
+            )
+            names.insert(0, "mac")
+        return pyarrow.Table.from_arrays(arrays, names=names)
+
+    def to_pandas(self, mac=None):
+        """Return the history as pandas DataFrame, see to_arrow for the columns."""
+        pandas = _require("pandas")
+        numpy = _require("numpy")
+        columns = self.to_numpy()
+        columns[WALL_TIME] = pandas.to_datetime(columns[WALL_TIME], unit="s", utc=True)
+        frame = pandas.DataFrame(columns, columns=COLUMNS)
+        if mac is not None:
+            frame.insert(
+                0,
+                "mac",
+                pandas.Categorical.from_codes(
+                    numpy.zeros(len(self), dtype=numpy.int8), [mac]
+                ),
+            )
+        return frame
+
+
+def _invalidating(name):
+    """Wrap a method of list that changes the entries, so the buffers are rebuilt."""
+    method = getattr(list, name)
+
+    def _changed(self, *args, **kwargs):
+        # pylint: disable=protected-access
+        self._stale = True
+        return method(self, *args, **kwargs)
+
+    _changed.__name__ = name
+    _changed.__doc__ = method.__doc__
+    return _changed
+
+
+for _name in (
+    "append",
+    "insert",
+    "remove",
+    "pop",
+    "clear",
+    "sort",
+    "reverse",
+    "__setitem__",
+    "__delitem__",
+    "__iadd__",
+    "__imul__",
+):
+    setattr(HistoryData, _name, _invalidating(_name))
+
+
+def concat_arrow(histories):
+    """Combine the histories of many sensors into one pyarrow Table.
+
+    `histories` maps the MAC addresses to their HistoryData. The tables are
+    concatenated without copying the columns.
+    """
+    pyarrow = _require("pyarrow")
+    tables = [history.to_arrow(mac) for mac, history in histories.items()]
+    if not tables:
+        return HistoryData().to_arrow("")
+    # the dictionaries of the mac columns differ, unify them
+    return pyarrow.concat_tables(tables).unify_dictionaries()
+
+
+def concat_pandas(histories):
+    """Combine the histories of many sensors into one pandas DataFrame."""
+    return concat_arrow(histories).to_pandas()
@@ -0,0 +1,146 @@
+"""
+Persistent cache of device metadata.
+
+Firmware version, name, model and battery level of a sensor change rarely, but
+reading them costs a Bluetooth connection. The DeviceMetadataStore keeps these
+values per MAC address, each with its own time to live, and optionally persists
+them in a JSON file so that they survive a restart. It also keeps the model of the
+device clock, see miflora_clock.
+"""
+
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+_LOGGER = logging.getLogger(__name__)
+
+FIRMWARE = "firmware"
+BATTERY = "battery"
+NAME = "name"
+MODEL = "model"
+CLOCK = "clock"
+
+_FILE_FORMAT_VERSION = 1
+
+# time to live of the different values in seconds, None means forever
+DEFAULT_TTLS = {
+    FIRMWARE: 7 * 24 * 3600,
+    BATTERY: 24 * 3600,
+    NAME: 30 * 24 * 3600,
+    MODEL: None,
+    CLOCK: None,
+}
+
+
+def parse_firmware_version(firmware_version):
+    """Convert a firmware version string like "2.6.6" into a comparable tuple.
+
+    Parts that are not numeric are ignored. Returns None for None.
+    """
+    if firmware_version is None:
+        return None
+    parts = []
+    for part in firmware_version.strip("\x00 ").split("."):
+        digits = "".join(c for c in part if c.isdigit())
+        if digits:
+            parts.append(int(digits))
+    return tuple(parts)
+
+
+class DeviceMetadataStore:
+    """Store for the metadata of many devices.
+
+    If `path` is None, the metadata is only kept in memory. Otherwise it is loaded
+    from and saved to a JSON file at this path. `ttls` overrides single entries of
+    DEFAULT_TTLS. The store is thread safe and can be shared by many pollers.
+    """
+
+    def __init__(self, path=None, ttls=None):
+        self._path = path
+        self._ttls = dict(DEFAULT_TTLS)
+        if ttls is not None:
+            self._ttls.update(ttls)
+        self._lock = Lock()
+        self._devices = dict()
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def _key(mac):
+        """Normalize the MAC address."""
+        return str(mac).upper()
+
+    def get(self, mac, key, now=None):
+        """Return a value of a device or None if it is unknown or expired."""
+        with self._lock:
+            entry = self._devices.get(self._key(mac), dict()).get(key)
+        if entry is None:
+            return None
+        value, timestamp = entry
+        ttl = self._ttls.get(key)
+        if ttl is not None and (now or time.time()) - timestamp > ttl:
+            return None
+        return value
+
+    def set(self, mac, key, value, now=None):
+        """Store a value of a device and persist the store."""
+        with self._lock:
+            device = self._devices.setdefault(self._key(mac), dict())
+            device[key] = (value, now or time.time())
+            self._save()
+
+    def invalidate(self, mac, key=None):
+        """Forget one or all values of a device."""
+        with self._lock:
+            device = self._devices.get(self._key(mac))
+            if device is None:
+                return
+            if key is None:
+                device.clear()
+            else:
+                device.pop(key, None)
+            self._save()
+
+    def _load(self):
+        """Load the store from the JSON file."""
+        try:
+            with open(self._path) as metadata_file:
+                content = json.load(metadata_file)
+        except (OSError, ValueError) as error:
+            _LOGGER.warning("Could not load metadata from %s: %s", self._path, error)
+            return
+        if (
+            not isinstance(content, dict)
+            or content.get("version") != _FILE_FORMAT_VERSION
+        ):
+            _LOGGER.warning("Ignoring metadata with unknown format in %s", self._path)
+            return
+        try:
+            devices = {
+                mac: {key: tuple(entry) for key, entry in device.items()}
+                for mac, device in content.get("devices", dict()).items()
+            }
+        except (AttributeError, TypeError) as error:
+            _LOGGER.warning("Ignoring invalid metadata in %s: %s", self._path, error)
+            return
+        self._devices.update(devices)
+
+    def _save(self):
+        """Atomically write the store to the JSON file.
+
+        Errors are only logged, the values are still kept in memory.
+        """
+        if self._path is None:
+            return
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as metadata_file:
+                json.dump(
+                    {"version": _FILE_FORMAT_VERSION, "devices": self._devices},
+                    metadata_file,
+                )
+            os.replace(tmp_path, self._path)
+        except OSError as error:
+            _LOGGER.warning("Could not save metadata to %s: %s", self._path, error)
@@ -4,23 +4,56 @@ Read data from Mi Flora plant sensor.
 
 import logging
 import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from struct import unpack
-from threading import Lock
 
 from btlewrap.base import BluetoothBackendException, BluetoothInterface
 
+from .miflora_clock import DeviceClock
+from .miflora_concurrency import (
+    DEFAULT_WAIT_TIMEOUT,
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    AdapterConnection,
+    BackendPool,
+    get_adapter_limiter,
+    get_device_lock,
+)
+from .miflora_deadline import (
+    BluetoothTimeoutException,
+    DeadlineConnection,
+    Timeouts,
+)
+from .miflora_decoder import (  # noqa: F401, pylint: disable=unused-import
+    HISTORY_DATA,
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    MODEL_ROPOT,
+    SENSOR_DATA,
+    get_decoder,
+)
+from .miflora_history import HistoryData
+from .miflora_metadata import (
+    BATTERY,
+    CLOCK,
+    FIRMWARE,
+    MODEL,
+    NAME,
+    DeviceMetadataStore,
+    parse_firmware_version,
+)
+from .miflora_state import SensorState
+from .miflora_transfer import write_read_pairs
+
 _HANDLE_READ_VERSION_BATTERY = 0x38
 _HANDLE_READ_NAME = 0x03
 _HANDLE_READ_SENSOR_DATA = 0x35
 _HANDLE_WRITE_MODE_CHANGE = 0x33
 _DATA_MODE_CHANGE = bytes([0xA0, 0x1F])
-
-MI_TEMPERATURE = "temperature"
-MI_LIGHT = "light"
-MI_MOISTURE = "moisture"
-MI_CONDUCTIVITY = "conductivity"
-MI_BATTERY = "battery"
+_FIRMWARE_MODE_CHANGE = (2, 6, 6)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -30,6 +63,9 @@ _HANDLE_DEVICE_TIME = 0x41
 _HANDLE_HISTORY_CONTROL = 0x3E
 _HANDLE_HISTORY_READ = 0x3C
 
+# the sensor writes one history entry per hour
+HISTORY_INTERVAL = 3600
+
 _CMD_HISTORY_READ_INIT = b"\xa0\x00\x00"
 _CMD_HISTORY_READ_SUCCESS = b"\xa2\x00\x00"
 _CMD_HISTORY_READ_FAILED = b"\xa3\x00\x00"
@@ -51,24 +87,210 @@ def format_bytes(raw_data):
 class MiFloraPoller:
     """A class to read data from Mi Flora plant sensors."""
 
-    def __init__(self, mac, backend, cache_timeout=600, adapter="hci0"):
+    def __init__(
+        self,
+        mac,
+        backend,
+        cache_timeout=600,
+        adapter="hci0",
+        metadata=None,
+        history_batch_size=16,
+        timeouts=None,
+        state=None,
+        hedge=None,
+        recent=None,
+        data_retries=2,
+        keep_alive=None,
+    ):
         """
         Initialize a Mi Flora Poller for the given MAC address.
+
+        Firmware version, battery level, name and model are kept in the `metadata`
+        store. Share a persistent DeviceMetadataStore between pollers to keep these
+        values across restarts. By default every poller has its own in-memory store.
+
+        The history is transferred in batches of `history_batch_size` entries, see
+        miflora_transfer for how backends can speed up these transfers.
+
+        With `timeouts` (see miflora_deadline.Timeouts), connecting, every read and
+        write and everything done within one connection get a deadline. If it
+        passes, a BluetoothTimeoutException is raised. The Bluetooth operations
+        also accept a miflora_deadline.Deadline, which bounds the whole operation
+        and allows other threads to cancel it.
+
+        All pollers share the connection limit of their adapter and the lock of
+        their sensor, see miflora_concurrency. Live reads have a higher priority
+        than history transfers, which give up their connection between batches
+        while live reads wait for the adapter.
+
+        The data read from the sensor is kept in `state`, a SensorState. A poller
+        is only a view on this state and `backend` can also be a BackendPool shared
+        with other pollers, see miflora_fleet.
+
+        With `hedge`, a miflora_hedge.Hedging, slow reads of the sensor data are
+        started a second time on the adapter of the hedge, the first result wins.
+
+        Every new reading of the sensor data is added to `recent`, an optional
+        miflora_recent.ReadingBuffer with statistics of the recent readings.
+
+        Sensors sometimes return invalid data, which they replace on the next
+        read. Invalid sensor data is read again up to `data_retries` times
+        within the same connection before the read counts as failed.
+
+        With `keep_alive`, a miflora_concurrency.KeepAlivePool shared by the
+        pollers, the connection to the sensor is kept open between operations.
+        Reads in a kept connection skip the connection setup and the mode change.
         """
 
         self._mac = mac
-        self._bt_interface = BluetoothInterface(backend, adapter=adapter)
-        self._cache = None
+        if isinstance(backend, BackendPool):
+            self._bt_interface = None
+            self._pool = backend
+        else:
+            self._bt_interface = BluetoothInterface(backend, adapter=adapter)
+            self._pool = BackendPool(
+                backend,
+                adapter,
+                [self._bt_interface._backend],  # pylint: disable=protected-access
+            )
+        self._state = SensorState(mac) if state is None else state
         self._cache_timeout = timedelta(seconds=cache_timeout)
-        self._last_read = None
-        self._fw_last_read = None
-        self.lock = Lock()
-        self._firmware_version = None
-        self.battery = None
+        self._limiter = get_adapter_limiter(adapter)
+        self.lock = get_device_lock(mac)
+        self._metadata = DeviceMetadataStore() if metadata is None else metadata
+        self._history_batch_size = history_batch_size
+        self._timeouts = timeouts
+        self._hedge = hedge
+        self.recent = recent
+        self.data_retries = data_retries
+        self._keep_alive = keep_alive
+        if hedge is not None:
+            self._hedge_pool = self._pool.on_adapter(hedge.adapter)
+            self._hedge_limiter = get_adapter_limiter(hedge.adapter)
+
+    @property
+    def _cache(self):
+        """Raw sensor data."""
+        return self._state.cache
+
+    @_cache.setter
+    def _cache(self, value):
+        self._state.cache = value
+
+    @property
+    def _last_read(self):
+        """Time of the last successful read as datetime."""
+        if self._state.last_read is None:
+            return None
+        return datetime.fromtimestamp(self._state.last_read)
+
+    @_last_read.setter
+    def _last_read(self, value):
+        self._state.last_read = None if value is None else value.timestamp()
+
+    @property
+    def _firmware_version(self):
+        """Firmware version as read from the sensor."""
+        return self._state.firmware_version
+
+    @_firmware_version.setter
+    def _firmware_version(self, value):
+        self._state.firmware_version = value
+
+    @property
+    def _firmware(self):
+        """Parsed firmware version for comparisons."""
+        return self._state.firmware
+
+    @_firmware.setter
+    def _firmware(self, value):
+        self._state.firmware = value
+
+    @property
+    def battery(self):
+        """Battery level read with the firmware version."""
+        return self._state.battery
+
+    @battery.setter
+    def battery(self, value):
+        self._state.battery = value
+
+    def _connect(self, deadline=None, priority=PRIORITY_INTERACTIVE, hedged=False):
+        """Return a context manager for a connection to the sensor.
+
+        With `hedged`, the connection is made on the adapter of the hedge.
+        """
+        connection = AdapterConnection(
+            self._hedge_pool if hedged else self._pool,
+            self._mac,
+            self._hedge_limiter if hedged else self._limiter,
+            self._wait_timeout(deadline),
+            priority,
+            self._keep_alive,
+        )
+        if self._timeouts is None and deadline is None:
+            return connection
+        return DeadlineConnection(connection, self._timeouts or Timeouts(), deadline)
+
+    def _on_connection(
+        self, operation, deadline=None, priority=PRIORITY_INTERACTIVE, hedged=False
+    ):
+        """Run `operation(context, connection)` in a connection to the sensor.
+
+        A connection kept open since an earlier operation may have been closed by
+        the sensor meanwhile. If the operation fails on such a connection, it is
+        repeated once on a new connection. An operation that must not be repeated
+        after some step sets `reused` of the context to False.
+        Returns the result of the operation.
+        """
+        context = self._connect(deadline, priority, hedged)
+        try:
+            with context as connection:
+                return operation(context, connection)
+        except BluetoothTimeoutException:
+            raise
+        except BluetoothBackendException as error:
+            if not context.reused:
+                raise
+            _LOGGER.debug(
+                "Kept connection to %s failed, reconnecting: %s", self._mac, error
+            )
+        context = self._connect(deadline, priority, hedged)
+        with context as connection:
+            return operation(context, connection)
+
+    def _wait_timeout(self, deadline=None):
+        """Return how long to wait for the lock of the sensor or an adapter slot.
 
-    def name(self):
+        This is the operation timeout if there is one, otherwise the default wait,
+        so that a hung sensor never blocks the callers forever. The wait is also
+        bounded by the deadline.
+        """
+        timeout = DEFAULT_WAIT_TIMEOUT
+        if self._timeouts is not None and self._timeouts.operation is not None:
+            timeout = self._timeouts.operation
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        return timeout
+
+    @contextmanager
+    def _locked(self, deadline=None):
+        """Hold the lock of the sensor, waiting at most for the wait timeout."""
+        if not self.lock.acquire(timeout=self._wait_timeout(deadline)):
+            raise BluetoothTimeoutException(
+                "Timed out waiting for the lock of sensor %s" % self._mac
+            )
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def name(self, deadline=None):
         """Return the name of the sensor."""
-        with self._bt_interface.connect(self._mac) as connection:
+        name = self._metadata.get(self._mac, NAME)
+        if name is not None:
+            return name
+        with self._locked(deadline), self._connect(deadline) as connection:
             name = connection.read_handle(
                 _HANDLE_READ_NAME
             )  # pylint: disable=no-member
@@ -77,13 +299,32 @@ class MiFloraPoller:
             raise BluetoothBackendException(
                 "Could not read data from Mi Flora sensor %s" % self._mac
             )
-        return "".join(chr(n) for n in name)
+        name = "".join(chr(n) for n in name)
+        self._metadata.set(self._mac, NAME, name)
+        return name
+
+    def model(self):
+        """Return the model of the sensor.
+
+        The model is derived from the layout of the sensor data, so the data is
+        read from the sensor if the model is not known yet.
+        """
+        model = self._metadata.get(self._mac, MODEL)
+        if model is None:
+            self.parameter_value(MI_TEMPERATURE)
+            model = self._metadata.get(self._mac, MODEL)
+        return model
 
-    def fill_cache(self):
+    def fill_cache(self, deadline=None):
         """Fill the cache with new data from the sensor."""
+        with self._locked(deadline):
+            self._fill_cache(deadline)
+
+    def _fill_cache(self, deadline=None):
+        """Fill the cache, the lock of the sensor must be held."""
         _LOGGER.debug("Filling cache with new sensor data.")
         try:
-            firmware_version = self.firmware_version()
+            self._read_firmware_version(deadline)
         except BluetoothBackendException:
             # If a sensor doesn't work, wait 5 minutes before retrying
             self._last_read = (
@@ -91,69 +332,135 @@ class MiFloraPoller:
             )
             raise
 
-        with self._bt_interface.connect(self._mac) as connection:
-            if firmware_version >= "2.6.6":
-                # for the newer models a magic number must be written before we can read the current data
-                try:
-                    connection.write_handle(
-                        _HANDLE_WRITE_MODE_CHANGE, _DATA_MODE_CHANGE
-                    )  # pylint: disable=no-member
-                    # If a sensor doesn't work, wait 5 minutes before retrying
-                except BluetoothBackendException:
-                    self._last_read = (
-                        datetime.now() - self._cache_timeout + timedelta(seconds=300)
-                    )
-                    return
-            self._cache = connection.read_handle(
-                _HANDLE_READ_SENSOR_DATA
-            )  # pylint: disable=no-member
-            _LOGGER.debug(
-                "Received result for handle %s: %s",
-                _HANDLE_READ_SENSOR_DATA,
-                format_bytes(self._cache),
+        if self._hedge is None:
+            mode_changed, data = self._read_sensor_data(deadline)
+        else:
+            mode_changed, data = self._hedge.call(
+                self._read_sensor_data,
+                lambda hedge_deadline: self._read_sensor_data(hedge_deadline, True),
+                deadline,
             )
-            self._check_data()
-            if self.cache_available():
-                self._last_read = datetime.now()
-            else:
-                # If a sensor doesn't work, wait 5 minutes before retrying
-                self._last_read = (
-                    datetime.now() - self._cache_timeout + timedelta(seconds=300)
-                )
+        if not mode_changed:
+            # If a sensor doesn't work, wait 5 minutes before retrying
+            self._last_read = (
+                datetime.now() - self._cache_timeout + timedelta(seconds=300)
+            )
+            return
+        self._cache = data
+        _LOGGER.debug(
+            "Received result for handle %s: %s",
+            _HANDLE_READ_SENSOR_DATA,
+            format_bytes(self._cache),
+        )
+        self._check_data()
+        if self.cache_available():
+            self._last_read = datetime.now()
+            self._store_model()
+            if self.recent is not None and self._decoder() is not None:
+                self.recent.add(self._parse_data(), self._state.last_read)
+        else:
+            # If a sensor doesn't work, wait 5 minutes before retrying
+            self._last_read = (
+                datetime.now() - self._cache_timeout + timedelta(seconds=300)
+            )
+
+    def _read_sensor_data(self, deadline=None, hedged=False):
+        """Read the sensor data in one connection.
+
+        Invalid data and failed mode changes are retried up to `data_retries`
+        times without reconnecting. Returns False and None if the mode change
+        failed, otherwise True and the raw data, which is invalid if all
+        retries returned invalid data.
+        """
 
-    def battery_level(self):
+        def _read(context, connection):
+            for attempt in range(self.data_retries + 1):
+                if attempt:
+                    _LOGGER.debug("Reading the sensor data again, attempt %d", attempt)
+                # a kept connection is already in the data mode
+                if self._needs_mode_change() and (attempt or not context.initialized):
+                    # for the newer models a magic number must be written before we can read the current data
+                    try:
+                        connection.write_handle(
+                            _HANDLE_WRITE_MODE_CHANGE, _DATA_MODE_CHANGE
+                        )  # pylint: disable=no-member
+                    except BluetoothBackendException:
+                        if attempt < self.data_retries:
+                            continue
+                        return False, None
+                    context.initialized = True
+                data = connection.read_handle(
+                    _HANDLE_READ_SENSOR_DATA
+                )  # pylint: disable=no-member
+                if self._is_valid_data(data):
+                    break
+                _LOGGER.debug("Received invalid sensor data: %s", format_bytes(data))
+            return True, data
+
+        return self._on_connection(_read, deadline, hedged=hedged)
+
+    def battery_level(self, deadline=None):
         """Return the battery level.
 
         The battery level is updated when reading the firmware version. This
         is done only once every 24h
         """
-        self.firmware_version()
+        self.firmware_version(deadline)
         return self.battery
 
-    def firmware_version(self):
-        """Return the firmware version."""
-        if (self._firmware_version is None) or (
-            datetime.now() - timedelta(hours=24) > self._fw_last_read
-        ):
-            self._fw_last_read = datetime.now()
-            with self._bt_interface.connect(self._mac) as connection:
-                res = connection.read_handle(
+    def firmware_version(self, deadline=None):
+        """Return the firmware version.
+
+        Firmware version and battery level are read together. They are read again
+        when one of them expires in the metadata store.
+        """
+        with self._locked(deadline):
+            return self._read_firmware_version(deadline)
+
+    def _read_firmware_version(self, deadline=None):
+        """Return the firmware version, the lock of the sensor must be held."""
+        firmware_version = self._metadata.get(self._mac, FIRMWARE)
+        battery = self._metadata.get(self._mac, BATTERY)
+        if firmware_version is None or battery is None:
+            res = self._on_connection(
+                lambda _, connection: connection.read_handle(
                     _HANDLE_READ_VERSION_BATTERY
-                )  # pylint: disable=no-member
-                _LOGGER.debug(
-                    "Received result for handle %s: %s",
-                    _HANDLE_READ_VERSION_BATTERY,
-                    format_bytes(res),
-                )
+                ),
+                deadline,
+            )
+            _LOGGER.debug(
+                "Received result for handle %s: %s",
+                _HANDLE_READ_VERSION_BATTERY,
+                format_bytes(res),
+            )
             if res is None:
-                self.battery = 0
-                self._firmware_version = None
+                battery = 0
+                firmware_version = None
             else:
-                self.battery = res[0]
-                self._firmware_version = "".join(map(chr, res[2:]))
-        return self._firmware_version
+                battery = res[0]
+                firmware_version = "".join(map(chr, res[2:]))
+                self._metadata.set(self._mac, FIRMWARE, firmware_version)
+                self._metadata.set(self._mac, BATTERY, battery)
+        self.battery = battery
+        if firmware_version != self._firmware_version:
+            # parse the version only once, so that comparisons are cheap
+            self._firmware_version = firmware_version
+            self._firmware = parse_firmware_version(firmware_version)
+        return firmware_version
+
+    def _needs_mode_change(self):
+        """Check if the mode change command must be sent before reading data."""
+        return self._firmware is not None and self._firmware >= _FIRMWARE_MODE_CHANGE
+
+    def _store_model(self):
+        """Store the model of the sensor derived from the data in the cache."""
+        decoder = self._decoder()
+        if decoder is not None and decoder.model != self._metadata.get(
+            self._mac, MODEL
+        ):
+            self._metadata.set(self._mac, MODEL, decoder.model)
 
-    def parameter_value(self, parameter, read_cached=True):
+    def parameter_value(self, parameter, read_cached=True, deadline=None):
         """Return a value of one of the monitored paramaters.
 
         This method will try to retrieve the data from cache and only
@@ -163,16 +470,16 @@ class MiFloraPoller:
         """
         # Special handling for battery attribute
         if parameter == MI_BATTERY:
-            return self.battery_level()
+            return self.battery_level(deadline)
 
         # Use the lock to make sure the cache isn't updated multiple times
-        with self.lock:
+        with self._locked(deadline):
             if (
                 (read_cached is False)
                 or (self._last_read is None)
                 or (datetime.now() - self._cache_timeout > self._last_read)
             ):
-                self.fill_cache()
+                self._fill_cache(deadline)
             else:
                 _LOGGER.debug(
                     "Using cache (%s < %s)",
@@ -180,11 +487,7 @@ class MiFloraPoller:
                     self._cache_timeout,
                 )
 
-        if self.cache_available() and (len(self._cache) == 16):
-            return self._parse_data()[parameter]
-        if self.cache_available() and (self.is_ropot()):
-            if parameter == MI_LIGHT:
-                return False
+        if self.cache_available() and self._decoder() is not None:
             return self._parse_data()[parameter]
         raise BluetoothBackendException(
             "Could not read data from Mi Flora sensor %s" % self._mac
@@ -197,16 +500,18 @@ class MiFloraPoller:
         """
         if not self.cache_available():
             return
-        if self._cache[7] > 100:  # moisture over 100 procent
-            self.clear_cache()
-            return
-        if self._firmware_version >= "2.6.6":
-            if sum(self._cache[10:]) == 0:
-                self.clear_cache()
-                return
-        if sum(self._cache) == 0:
+        if not self._is_valid_data(self._cache):
             self.clear_cache()
-            return
+
+    def _is_valid_data(self, data):
+        """Check the raw sensor data before it is decoded."""
+        if data is None or len(data) < 8:
+            return False
+        if data[7] > 100:  # moisture over 100 procent
+            return False
+        if self._needs_mode_change() and sum(data[10:]) == 0:
+            return False
+        return sum(data) != 0
 
     def clear_cache(self):
         """Manually force the cache to be cleared."""
@@ -219,97 +524,206 @@ class MiFloraPoller:
 
     def is_ropot(self):
         """Check if the sensor is a ropot."""
-        return len(self._cache) == 24
+        decoder = self._decoder()
+        return decoder is not None and decoder.model == MODEL_ROPOT
 
-    def _parse_data(self):
-        """Parses the byte array returned by the sensor.
-
-        The sensor returns 16 bytes in total. It's unclear what the meaning of these bytes
-        is beyond what is decoded in this method.
-
-        semantics of the data (in little endian encoding):
-        bytes   0-1: temperature in 0.1 °C
-        byte      2: unknown
-        bytes   3-6: brightness in Lux (MiFlora only)
-        byte      7: moisture in %
-        byted   8-9: conductivity in µS/cm
-        bytes 10-15: unknown
+    def _decoder(self):
+        """Return the decoder for the data in the cache.
+
+        The decoder is selected by the length of the payload, see miflora_decoder
+        for the layouts of the different models.
         """
-        data = self._cache
-        res = dict()
-        if self.is_ropot():
-            temp, res[MI_MOISTURE], res[MI_CONDUCTIVITY] = unpack(
-                "<hxxxxxBhxxxxxxxxxxxxxx", data
-            )
-        else:
-            temp, res[MI_LIGHT], res[MI_MOISTURE], res[MI_CONDUCTIVITY] = unpack(
-                "<hxIBhxxxxxx", data
-            )
-        res[MI_TEMPERATURE] = temp / 10.0
-        return res
+        return get_decoder(SENSOR_DATA, len(self._cache))
 
-    def fetch_history(self):
+    def _parse_data(self):
+        """Parses the byte array returned by the sensor."""
+        return self._decoder().decode(self._cache)
+
+    def fetch_history(self, deadline=None, priority=PRIORITY_BACKGROUND):
         """Fetch the historical measurements from the sensor.
 
-        History is updated by the sensor every hour.
+        History is updated by the sensor every hour. The wall time of the entries
+        is computed with the model of the device clock. The device time is only
+        read if the model is not accurate enough or the device rebooted.
+
+        With the default background priority, the transfer gives up its
+        connection between batches while work with a higher priority waits for
+        the adapter, and continues afterwards.
+
+        The entries are returned as miflora_history.HistoryData, which can be
+        exported to numpy, Arrow and pandas.
         """
-        data = []
-        with self._bt_interface.connect(self._mac) as connection:
-            connection.write_handle(
-                _HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_INIT
-            )  # pylint: disable=no-member
-            history_info = connection.read_handle(
-                _HANDLE_HISTORY_READ
-            )  # pylint: disable=no-member
-            _LOGGER.debug("history info raw: %s", format_bytes(history_info))
+        data = HistoryData()
+        entries_read = 0
+        yielded = True
 
-            history_length = int.from_bytes(history_info[0:2], BYTEORDER)
-            _LOGGER.info("Getting %d measurements", history_length)
-            if history_length > 0:
-                for i in range(history_length):
-                    payload = self._cmd_history_address(i)
-                    try:
-                        connection.write_handle(
-                            _HANDLE_HISTORY_CONTROL, payload
-                        )  # pylint: disable=no-member
-                        response = connection.read_handle(
-                            _HANDLE_HISTORY_READ
-                        )  # pylint: disable=no-member
-                        if response in _INVALID_HISTORY_DATA:
-                            msg = f"Got invalid history data: {response}"
-                            _LOGGER.error(msg)
-                        else:
-                            data.append(HistoryEntry(response))
-                    except Exception:  # pylint: disable=broad-except
-                        # find a more narrow exception here
-                        # when reading fails, we're probably at the end of the history
-                        # even when the history_length might suggest something else
-                        _LOGGER.error(
-                            "Could only retrieve %d of %d entries from the history. "
-                            "The rest is not readable",
-                            i,
-                            history_length,
-                        )
-                        # connection.write_handle(_HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_FAILED)
-                        break
-                    _LOGGER.info(
-                        "Progress: reading entry %d of %d", i + 1, history_length
+        def _read_part(_, connection):
+            return self._read_history(connection, entries_read, priority)
+
+        with self._locked(deadline):
+            while yielded:
+                entries, entries_read, _, yielded = self._on_connection(
+                    _read_part, deadline, priority
+                )
+                data.extend(entries)
+        return data
+
+    def fetch_and_clear_history(
+        self, sink, deadline=None, priority=PRIORITY_BACKGROUND
+    ):
+        """Fetch the history, hand it to the sink and clear it on the device.
+
+        `sink(entries)` must store the entries durably before it returns. It is
+        called for every part of the history read without a break. The history on
+        the device is only cleared if all entries announced by the device were
+        read and the sink returned without an exception. If not all entries could
+        be read, the entries read are still handed to the sink, but a
+        BluetoothBackendException is raised and the history is kept on the device.
+        Entries written by the sensor during the transfer are read and handed to
+        the sink in a further call before the history is cleared. The transfer
+        yields to work with a higher priority like fetch_history.
+        Returns the list of entries.
+        """
+        data = HistoryData()
+        start = 0
+        first = True
+
+        def _transfer(context, connection):
+            """Read and hand over the history, returns True once it was cleared."""
+            nonlocal start, first
+            while True:
+                entries, entries_read, history_length, yielded = self._read_history(
+                    connection, start, priority
+                )
+                if first or entries:
+                    # the sink got entries, the transfer must not be repeated
+                    context.reused = False
+                    sink(entries)
+                    data.extend(entries)
+                    first = False
+                if yielded:
+                    start = entries_read
+                    return False
+                if entries_read != history_length:
+                    raise BluetoothBackendException(
+                        "Read %d history entries of sensor %s, but it has "
+                        "%d, the history was not cleared"
+                        % (entries_read, self._mac, history_length)
                     )
+                # clear once no entry was added since the last read
+                if history_length == start:
+                    connection.write_handle(
+                        _HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_SUCCESS
+                    )  # pylint: disable=no-member
+                    _LOGGER.info("Cleared %d history entries", history_length)
+                    return True
+                start = entries_read
+
+        with self._locked(deadline):
+            while not self._on_connection(_transfer, deadline, priority):
+                pass
+        return data
+
+    def _read_history(self, connection, start=0, priority=None):
+        """Read the history within a connection, beginning with entry `start`.
 
-        (device_time, wall_time) = self._fetch_device_time()
-        time_diff = wall_time - device_time
-        for entry in data:
+        Returns the entries, the index up to which entries were read including the
+        invalid ones, the number of entries announced by the device and whether the
+        transfer stopped early to yield to work with a higher priority than
+        `priority`. Without a priority, the transfer never yields.
+        """
+        data = HistoryData()
+        entries_read = start
+        yielded = False
+        history_length = self._read_history_length(connection)
+        _LOGGER.info("Getting %d measurements", max(history_length - start, 0))
+        try:
+            for response in self._history_responses(connection, history_length, start):
+                if response in _INVALID_HISTORY_DATA:
+                    msg = f"Got invalid history data: {response}"
+                    _LOGGER.error(msg)
+                else:
+                    data.add(HistoryEntry(response), response)
+                entries_read += 1
+                _LOGGER.info(
+                    "Progress: reading entry %d of %d", entries_read, history_length
+                )
+                if (
+                    priority is not None
+                    and entries_read < history_length
+                    and (entries_read - start) % self._history_batch_size == 0
+                    and self._limiter.should_yield(priority)
+                ):
+                    _LOGGER.debug("Yielding the adapter after %d entries", entries_read)
+                    yielded = True
+                    break
+        except BluetoothTimeoutException:
+            # the connection is broken, do not return a silently truncated history
+            raise
+        except Exception:  # pylint: disable=broad-except
+            # find a more narrow exception here
+            # when reading fails, we're probably at the end of the history
+            # even when the history_length might suggest something else
+            _LOGGER.error(
+                "Could only retrieve %d of %d entries from the history. "
+                "The rest is not readable",
+                entries_read,
+                history_length,
+            )
+            # connection.write_handle(_HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_FAILED)
+
+        clock = DeviceClock.from_dict(self._metadata.get(self._mac, CLOCK))
+        # a broken connection cannot read the device time
+        if not getattr(connection, "broken", False) and (
+            clock.needs_sync()
+            or not all(clock.is_consistent(entry.device_time) for entry in data)
+            or (
+                # the newest entry is too old, so the device rebooted
+                data
+                and not clock.is_recent(
+                    max(entry.device_time for entry in data), 2 * HISTORY_INTERVAL
+                )
+            )
+        ):
+            self._sync_device_clock(connection, clock)
+
+        # without a sample of the device clock the wall times stay unknown
+        for index, entry in enumerate(data if clock.synced else ()):
+            time_diff = clock.wall_time(entry.device_time) - entry.device_time
             entry.compute_wall_time(time_diff)
+            data.wall_times[index] = entry.device_time + time_diff
+        return data, entries_read, history_length, yielded
 
-        return data
+    def history_length(self, deadline=None):
+        """Return the number of entries in the history of the device.
 
-    def clear_history(self):
+        This only reads the history info, so it is much cheaper than fetch_history.
+        """
+        with self._locked(deadline):
+            return self._on_connection(
+                lambda _, connection: self._read_history_length(connection), deadline
+            )
+
+    @staticmethod
+    def _read_history_length(connection):
+        """Start a history transfer and read the number of entries."""
+        connection.write_handle(
+            _HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_INIT
+        )  # pylint: disable=no-member
+        history_info = connection.read_handle(
+            _HANDLE_HISTORY_READ
+        )  # pylint: disable=no-member
+        _LOGGER.debug("history info raw: %s", format_bytes(history_info))
+        return int.from_bytes(history_info[0:2], BYTEORDER)
+
+    def clear_history(self, deadline=None):
         """Clear the device history.
 
         On the next fetch_history, you will only get new data.
         Note: The data is deleted from the device. There is no way to recover it!
         """
-        with self._bt_interface.connect(self._mac) as connection:
+
+        def _clear(_, connection):
             connection.write_handle(
                 _HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_INIT
             )  # pylint: disable=no-member
@@ -317,33 +731,47 @@ class MiFloraPoller:
                 _HANDLE_HISTORY_CONTROL, _CMD_HISTORY_READ_SUCCESS
             )  # pylint: disable=no-member
 
+        with self._locked(deadline):
+            self._on_connection(_clear, deadline)
+
+    def _history_responses(self, connection, history_length, start=0):
+        """Yield the raw history entries from `start` on, transferred in batches."""
+        for first in range(start, history_length, self._history_batch_size):
+            end = min(first + self._history_batch_size, history_length)
+            yield from write_read_pairs(
+                connection,
+                _HANDLE_HISTORY_CONTROL,
+                _HANDLE_HISTORY_READ,
+                [self._cmd_history_address(i) for i in range(first, end)],
+            )
+
     @staticmethod
     def _cmd_history_address(addr):
         """Calculate this history address"""
         return b"\xa1" + addr.to_bytes(2, BYTEORDER)
 
-    def _fetch_device_time(self):
-        """Fetch device time.
+    def _sync_device_clock(self, connection, clock):
+        """Read the device time and add it as sample to the clock model.
 
-        The device time is in seconds.
+        The device time is in seconds. The wall time is assumed to be in the
+        middle of the read.
         """
         start = time.time()
-        with self._bt_interface.connect(self._mac) as connection:
-            response = connection.read_handle(
-                _HANDLE_DEVICE_TIME
-            )  # pylint: disable=no-member
+        response = connection.read_handle(_HANDLE_DEVICE_TIME)
+        end = time.time()
         _LOGGER.debug("device time raw: %s", response)
-        wall_time = (time.time() + start) / 2
+        wall_time = (end + start) / 2
         device_time = int.from_bytes(response, BYTEORDER)
         _LOGGER.info("device time: %s local time: %s", device_time, wall_time)
-
-        return device_time, wall_time
+        clock.add_sample(device_time, wall_time, (end - start) / 2)
+        self._metadata.set(self._mac, CLOCK, clock.to_dict())
 
 
 class HistoryEntry:  # pylint: disable=too-few-public-methods
     """Entry in the history of the device."""
 
     def __init__(self, byte_array):
+        self.raw = bytes(byte_array)
         self.device_time = None
         self.wall_time = None
         self.temperature = None
@@ -353,19 +781,13 @@ class HistoryEntry:  # pylint: disable=too-few-public-methods
         self._decode_history(byte_array)
 
     def _decode_history(self, byte_array):
-        """Perform byte magic when decoding history data."""
-        # negative numbers are stored in one's complement
-        # pylint: disable=trailing-comma-tuple
-
-        temp_bytes = byte_array[4:6]
-        if temp_bytes[1] & 0x80 > 0:
-            temp_bytes = [temp_bytes[0] ^ 0xFF, temp_bytes[1] ^ 0xFF]
-
-        self.device_time = int.from_bytes(byte_array[:4], BYTEORDER)
-        self.temperature = int.from_bytes(temp_bytes, BYTEORDER) / 10.0
-        self.light = int.from_bytes(byte_array[7:10], BYTEORDER)
-        self.moisture = byte_array[11]
-        self.conductivity = int.from_bytes(byte_array[12:14], BYTEORDER)
+        """Decode the history data with the registered history decoder."""
+        res = get_decoder(HISTORY_DATA, len(byte_array)).decode(byte_array)
+        self.device_time = res["device_time"]
+        self.temperature = res[MI_TEMPERATURE]
+        self.light = res[MI_LIGHT]
+        self.moisture = res[MI_MOISTURE]
+        self.conductivity = res[MI_CONDUCTIVITY]
 
         _LOGGER.debug("Raw data for char 0x3c: %s", format_bytes(byte_array))
         _LOGGER.debug("device time: %d", self.device_time)
@@ -0,0 +1,173 @@
+"""
+Recent readings of a sensor with windowed statistics.
+
+The poller only keeps the latest reading. A ReadingBuffer keeps the readings of
+the last hours in a bounded ring buffer and maintains the minimum, maximum,
+mean, trend and last change of every measurement incrementally. All queries
+are O(1) (amortized) and the memory per sensor is fixed by the capacity.
+
+Example:
+    recent = ReadingBuffer(window=6 * 3600)
+    poller = MiFloraPoller(mac, backend, recent=recent)
+    ...
+    recent.stats(MI_MOISTURE).trend  # change of the moisture per hour
+"""
+
+import time
+from collections import deque
+from threading import Lock
+
+from .miflora_decoder import MI_CONDUCTIVITY, MI_LIGHT, MI_MOISTURE, MI_TEMPERATURE
+
+DEFAULT_METRICS = (MI_TEMPERATURE, MI_LIGHT, MI_MOISTURE, MI_CONDUCTIVITY)
+
+
+class WindowStats:
+    """Statistics of one measurement over a sliding time window.
+
+    Values older than `window` seconds or beyond the last `capacity` values
+    drop out. Minimum and maximum are tracked with monotonic queues, the mean
+    and the trend with running sums, so adding and querying are O(1).
+    """
+
+    def __init__(self, window, capacity, origin=None):
+        self.window = window
+        self.capacity = capacity
+        # times are relative to the origin to keep the running sums precise
+        self._origin = time.time() if origin is None else origin
+        self._values = deque()
+        self._minima = deque()
+        self._maxima = deque()
+        self._count = 0
+        self._sum_t = 0.0
+        self._sum_v = 0.0
+        self._sum_tt = 0.0
+        self._sum_tv = 0.0
+        self.last_change = None
+
+    def add(self, timestamp, value):
+        """Add a value measured at `timestamp` in seconds since the epoch."""
+        t = timestamp - self._origin  # pylint: disable=invalid-name
+        if self._values and value != self._values[-1][2]:
+            self.last_change = (timestamp, value - self._values[-1][2])
+        if len(self._values) >= self.capacity:
+            self._drop()
+        entry = (self._count, t, value)
+        self._count += 1
+        self._values.append(entry)
+        self._sum_t += t
+        self._sum_v += value
+        self._sum_tt += t * t
+        self._sum_tv += t * value
+        while self._minima and self._minima[-1][2] >= value:
+            self._minima.pop()
+        self._minima.append(entry)
+        while self._maxima and self._maxima[-1][2] <= value:
+            self._maxima.pop()
+        self._maxima.append(entry)
+        self.expire(timestamp)
+
+    def _drop(self):
+        """Drop the oldest value."""
+        seq, t, value = self._values.popleft()  # pylint: disable=invalid-name
+        self._sum_t -= t
+        self._sum_v -= value
+        self._sum_tt -= t * t
+        self._sum_tv -= t * value
+        if self._minima[0][0] == seq:
+            self._minima.popleft()
+        if self._maxima[0][0] == seq:
+            self._maxima.popleft()
+        if not self._values:
+            # start again from exact sums
+            self._sum_t = self._sum_v = self._sum_tt = self._sum_tv = 0.0
+
+    def expire(self, now=None):
+        """Drop the values that are older than the window."""
+        start = (time.time() if now is None else now) - self._origin - self.window
+        while self._values and self._values[0][1] < start:
+            self._drop()
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def last(self):
+        """Latest value or None."""
+        return self._values[-1][2] if self._values else None
+
+    @property
+    def minimum(self):
+        """Smallest value in the window or None."""
+        return self._minima[0][2] if self._minima else None
+
+    @property
+    def maximum(self):
+        """Largest value in the window or None."""
+        return self._maxima[0][2] if self._maxima else None
+
+    @property
+    def mean(self):
+        """Mean of the values in the window or None."""
+        if not self._values:
+            return None
+        return self._sum_v / len(self._values)
+
+    @property
+    def trend(self):
+        """Slope of the least squares fit of the values in units per hour.
+
+        Returns None if there are less than two values or they have the same time.
+        """
+        count = len(self._values)
+        if count < 2:
+            return None
+        variance = count * self._sum_tt - self._sum_t * self._sum_t
+        if variance <= 0:
+            return None
+        slope = (count * self._sum_tv - self._sum_t * self._sum_v) / variance
+        return slope * 3600
+
+
+class ReadingBuffer:
+    """Recent parsed readings of one sensor with statistics per measurement.
+
+    The buffer keeps the readings of the last `window` seconds, but at most
+    `capacity` of them. `metrics` are the measurements to keep statistics for.
+    The buffer is thread safe.
+    """
+
+    def __init__(self, window=6 * 3600, capacity=512, metrics=DEFAULT_METRICS):
+        self.window = window
+        origin = time.time()
+        self._stats = {
+            metric: WindowStats(window, capacity, origin) for metric in metrics
+        }
+        self._readings = deque(maxlen=capacity)
+        self._lock = Lock()
+
+    def add(self, reading, timestamp=None):
+        """Add a parsed reading, a dictionary as returned by the decoders.
+
+        Values that are not numbers, e.g. the light of a Ropot, are skipped.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._readings.append((timestamp, reading))
+            for metric, stats in self._stats.items():
+                value = reading.get(metric)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stats.add(timestamp, value)
+
+    def stats(self, metric, now=None):
+        """Return the WindowStats of a measurement for the window ending `now`."""
+        with self._lock:
+            stats = self._stats[metric]
+            stats.expire(now)
+            return stats
+
+    def readings(self, now=None):
+        """Return the readings in the window as list of (timestamp, reading)."""
+        start = (time.time() if now is None else now) - self.window
+        with self._lock:
+            return [entry for entry in self._readings if entry[0] >= start]
@@ -0,0 +1,192 @@
+"""
+Record and replay the Bluetooth traffic of a sensor.
+
+The RecordingBackend wraps another backend and writes every connect, disconnect,
+read and write with its payload, result and timing to a file. The ReplayBackend
+plays such a file back to a MiFloraPoller, in real time, accelerated or as fast
+as possible. This allows to debug and benchmark the poller offline against
+sessions captured in the field.
+
+The file contains one JSON object per line. The first line is a header, each
+following line an event with the keys
+    t: start of the call in seconds since the start of the recording
+    d: duration of the call in seconds
+    o: operation, one of "connect", "disconnect", "read", "write"
+    a: arguments, the MAC address or the handle and the hex encoded value
+    r: hex encoded result of a read
+    e: error message if the call raised an exception
+
+Example:
+    backend = functools.partial(RecordingBackend, backend=BluepyBackend, path="s.rec")
+    poller = MiFloraPoller(mac, backend)
+"""
+
+import json
+import time
+from threading import Lock
+
+from btlewrap.base import AbstractBackend, BluetoothBackendException
+
+_FILE_FORMAT_VERSION = 1
+
+
+def _to_hex(data):
+    """Encode a payload, None is kept."""
+    return None if data is None else bytes(data).hex()
+
+
+def _from_hex(data):
+    """Decode a payload, None is kept."""
+    return None if data is None else bytes.fromhex(data)
+
+
+class RecordingBackend(AbstractBackend):
+    """Backend recording all calls to another backend in a file.
+
+    `backend` is the class of the recorded backend, `path` the file to append
+    the recording to. Further keyword arguments are passed to the backend.
+    """
+
+    def __init__(
+        self, adapter="hci0", address_type="public", *, backend, path, **kwargs
+    ):
+        super().__init__(adapter, address_type)
+        self._backend = backend(adapter=adapter, address_type=address_type, **kwargs)
+        self._file = open(path, "a")  # pylint: disable=consider-using-with
+        self._lock = Lock()
+        self._start = time.time()
+        self._write(
+            {
+                "version": _FILE_FORMAT_VERSION,
+                "backend": backend.__name__,
+                "adapter": adapter,
+                "start": self._start,
+            }
+        )
+
+    def _write(self, record):
+        """Write one line to the recording."""
+        with self._lock:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._file.flush()
+
+    def _record(self, operation, func, args, hex_args):
+        """Call the backend and record the call."""
+        event = {
+            "t": round(time.time() - self._start, 6),
+            "o": operation,
+            "a": hex_args,
+        }
+        start = time.time()
+        try:
+            result = func(*args)
+        except Exception as error:
+            event["e"] = f"{type(error).__name__}: {error}"
+            raise
+        else:
+            if operation == "read":
+                event["r"] = _to_hex(result)
+            return result
+        finally:
+            event["d"] = round(time.time() - start, 6)
+            self._write(event)
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """Check if the recorded backend is available."""
+        return self._backend.check_backend()
+
+    def connect(self, mac):
+        """Connect to a device."""
+        return self._record("connect", self._backend.connect, (mac,), [mac])
+
+    def disconnect(self):
+        """Disconnect from a device."""
+        return self._record("disconnect", self._backend.disconnect, (), [])
+
+    def read_handle(self, handle):
+        """Read a handle from the device."""
+        return self._record("read", self._backend.read_handle, (handle,), [handle])
+
+    def write_handle(self, handle, value):
+        """Write a handle of the device."""
+        return self._record(
+            "write",
+            self._backend.write_handle,
+            (handle, value),
+            [handle, _to_hex(value)],
+        )
+
+    def close(self):
+        """Close the recording."""
+        self._file.close()
+
+
+def load_recording(path):
+    """Load a recording, returns the header and the list of events."""
+    with open(path) as recording:
+        lines = [json.loads(line) for line in recording if line.strip()]
+    if not lines or lines[0].get("version") != _FILE_FORMAT_VERSION:
+        raise ValueError(f"{path} is not a recording")
+    # a file can contain several recordings, they are played back in order
+    return lines[0], [line for line in lines if "o" in line]
+
+
+class ReplayBackend(AbstractBackend):
+    """Backend playing back a recording.
+
+    The calls must come in the same order and with the same arguments as in the
+    recording, otherwise a BluetoothBackendException is raised. `speed` is the
+    speed up of the playback compared to the recording: 1 plays back in real
+    time, 10 ten times faster. With None, the calls return immediately.
+    """
+
+    def __init__(self, adapter="hci0", address_type="public", *, path, speed=None):
+        super().__init__(adapter, address_type)
+        self.header, self._events = load_recording(path)
+        self._position = 0
+        self.speed = speed
+
+    @property
+    def finished(self):
+        """Check if all events were played back."""
+        return self._position >= len(self._events)
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """The replay is always available."""
+        return True
+
+    def _replay(self, operation, args):
+        """Play back the next event, which must match the call."""
+        if self.finished:
+            raise BluetoothBackendException(
+                f"Recording ended before {operation} {args}"
+            )
+        event = self._events[self._position]
+        if event["o"] != operation or event["a"] != args:
+            raise BluetoothBackendException(
+                f"Replay diverged at event {self._position}: expected "
+                f"{event['o']} {event['a']}, got {operation} {args}"
+            )
+        self._position += 1
+        if self.speed:
+            time.sleep(event["d"] / self.speed)
+        if "e" in event:
+            raise BluetoothBackendException(event["e"])
+        return _from_hex(event.get("r"))
+
+    def connect(self, mac):
+        """Replay connecting to a device."""
+        self._replay("connect", [mac])
+
+    def disconnect(self):
+        """Replay disconnecting from a device."""
+        self._replay("disconnect", [])
+
+    def read_handle(self, handle):
+        """Replay reading a handle."""
+        return self._replay("read", [handle])
+
+    def write_handle(self, handle, value):
+        """Replay writing a handle."""
+        self._replay("write", [handle, _to_hex(value)])
+        return True
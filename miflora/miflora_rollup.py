@@ -0,0 +1,322 @@
+"""
+Downsample the stored history with tiered retention.
+
+A sensor writes 24 history entries a day, so a year of history of a fleet is
+large and charts over long ranges have to read all of it. The HistoryRollup
+keeps the raw entries only for a recent window and hourly and daily aggregates
+(count, minimum, maximum and mean of every measurement) for older data. The
+aggregates are updated incrementally while the entries are ingested and expired
+tiers are dropped automatically, so a chart of a year reads about 365 daily
+rows per sensor.
+
+The rollup can be used as sink of the HistoryHarvester:
+
+    rollup = HistoryRollup(path="history")
+    harvester = HistoryHarvester(macs, backend, sink=rollup.ingest)
+    ...
+    resolution, rows = rollup.query(mac, start=time.time() - 365 * 24 * 3600)
+"""
+
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from .miflora_poller import HISTORY_INTERVAL
+from .miflora_recent import DEFAULT_METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+RAW = "raw"
+HOURLY = "hourly"
+DAILY = "daily"
+# resolutions from fine to coarse with the length of their buckets in seconds
+RESOLUTIONS = ((RAW, None), (HOURLY, 3600), (DAILY, 24 * 3600))
+
+# time in seconds each resolution is kept, None means forever
+DEFAULT_RETENTION = {RAW: 2 * 24 * 3600, HOURLY: 30 * 24 * 3600, DAILY: None}
+
+_FILE_FORMAT_VERSION = 1
+
+
+class Aggregate:
+    """Count, minimum, maximum and sum of the values of one measurement."""
+
+    __slots__ = ("count", "minimum", "maximum", "total")
+
+    def __init__(self, count=0, minimum=None, maximum=None, total=0):
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        self.total = total
+
+    def add(self, value):
+        """Add a value."""
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self):
+        """Mean of the values or None."""
+        return self.total / self.count if self.count else None
+
+    def __repr__(self):
+        return (
+            f"Aggregate({self.count!r}, {self.minimum!r}, "
+            f"{self.maximum!r}, {self.total!r})"
+        )
+
+
+class _Sensor:  # pylint: disable=too-few-public-methods
+    """Stored history of one sensor."""
+
+    __slots__ = ("latest", "raw_times", "raw", "buckets")
+
+    def __init__(self):
+        # wall time of the newest ingested entry
+        self.latest = None
+        # sorted wall times and values of the raw entries
+        self.raw_times = []
+        self.raw = []
+        # aggregates per bucket start per resolution, in the order of the times
+        self.buckets = {resolution: dict() for resolution, _ in RESOLUTIONS[1:]}
+
+
+class HistoryRollup:
+    """Raw history entries and their hourly and daily aggregates per sensor.
+
+    `retention` overrides single entries of DEFAULT_RETENTION, `metrics` are
+    the measurements to keep. If `path` is None, the data is only kept in
+    memory. Otherwise every sensor is kept in a JSON file in the directory at
+    this path, which is rewritten when entries of the sensor are added. Buckets
+    are aligned to UTC. The rollup is thread safe.
+    """
+
+    def __init__(self, path=None, retention=None, metrics=DEFAULT_METRICS):
+        self._path = path
+        self.retention = dict(DEFAULT_RETENTION)
+        if retention is not None:
+            self.retention.update(retention)
+        self.metrics = tuple(metrics)
+        self._sensors = dict()
+        self._lock = Lock()
+        if path is not None and os.path.isdir(path):
+            self._load()
+
+    def ingest(self, mac, entries, now=None):
+        """Add history entries of a sensor, e.g. as returned by fetch_history.
+
+        Entries without wall time and entries that are not at least half a
+        history interval newer than the newest ingested entry of the sensor are
+        skipped. Such entries were ingested before, e.g. because the history was
+        read again without clearing it. Their wall times may differ slightly, as
+        the model of the device clock changes with every sync. Expired data is
+        dropped.
+        Returns the number of added entries.
+        """
+        rows = sorted(
+            (
+                (entry.wall_time.timestamp(), entry)
+                for entry in entries
+                if entry.wall_time is not None
+            ),
+            key=lambda row: row[0],
+        )
+        added = 0
+        mac = mac.upper()
+        with self._lock:
+            sensor = self._sensors.setdefault(mac, _Sensor())
+            for timestamp, entry in rows:
+                if (
+                    sensor.latest is not None
+                    and timestamp < sensor.latest + HISTORY_INTERVAL / 2
+                ):
+                    continue
+                values = dict()
+                for metric in self.metrics:
+                    value = getattr(entry, metric, None)
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        values[metric] = value
+                self._add(sensor, timestamp, values)
+                added += 1
+            self._compact([sensor], now)
+            if added:
+                self._save([mac])
+        return added
+
+    @staticmethod
+    def _add(sensor, timestamp, values):
+        """Add one entry to all resolutions."""
+        sensor.latest = timestamp
+        sensor.raw_times.append(timestamp)
+        sensor.raw.append(values)
+        for resolution, length in RESOLUTIONS[1:]:
+            bucket = sensor.buckets[resolution].setdefault(
+                timestamp // length * length, dict()
+            )
+            for metric, value in values.items():
+                bucket.setdefault(metric, Aggregate()).add(value)
+
+    def compact(self, now=None):
+        """Drop the data that is older than the retention of its resolution."""
+        with self._lock:
+            self._compact(self._sensors.values(), now)
+            self._save(list(self._sensors))
+
+    def _compact(self, sensors, now):
+        """Drop expired data of the sensors, the lock must be held."""
+        now = time.time() if now is None else now
+        for sensor in sensors:
+            if self.retention[RAW] is not None:
+                index = bisect_left(sensor.raw_times, now - self.retention[RAW])
+                del sensor.raw_times[:index]
+                del sensor.raw[:index]
+            for resolution, length in RESOLUTIONS[1:]:
+                if self.retention[resolution] is None:
+                    continue
+                # keep the buckets that are partly within the retention
+                start = now - self.retention[resolution] - length
+                buckets = sensor.buckets[resolution]
+                while buckets:
+                    bucket_start = next(iter(buckets))
+                    if bucket_start >= start:
+                        break
+                    del buckets[bucket_start]
+
+    def resolution(self, start, now=None):
+        """Return the finest resolution that still holds data from `start` on."""
+        now = time.time() if now is None else now
+        for resolution, _ in RESOLUTIONS:
+            retention = self.retention[resolution]
+            if retention is None or start >= now - retention:
+                return resolution
+        return DAILY
+
+    def query(self, mac, start, end=None, resolution=None, now=None):
+        """Return the history of a sensor between `start` and `end`.
+
+        Without `resolution`, the finest resolution holding data from `start`
+        on is used. Returns the resolution and a list of (timestamp, values)
+        rows. Raw rows map the measurements to their values, aggregated rows,
+        whose timestamp is the start of the bucket, to an Aggregate.
+        """
+        if resolution is None:
+            resolution = self.resolution(start, now)
+        end = float("inf") if end is None else end
+        with self._lock:
+            sensor = self._sensors.get(mac.upper())
+            if sensor is None:
+                return resolution, []
+            if resolution == RAW:
+                first = bisect_left(sensor.raw_times, start)
+                rows = [
+                    (timestamp, dict(values))
+                    for timestamp, values in zip(
+                        sensor.raw_times[first:], sensor.raw[first:]
+                    )
+                    if timestamp < end
+                ]
+            else:
+                rows = [
+                    (
+                        timestamp,
+                        {
+                            metric: Aggregate(a.count, a.minimum, a.maximum, a.total)
+                            for metric, a in bucket.items()
+                        },
+                    )
+                    for timestamp, bucket in sensor.buckets[resolution].items()
+                    if start <= timestamp < end
+                ]
+        return resolution, rows
+
+    def _file(self, mac):
+        """Return the path of the file of a sensor."""
+        return os.path.join(self._path, mac.replace(":", "") + ".json")
+
+    def _load(self):
+        """Load the files of all sensors."""
+        try:
+            names = sorted(os.listdir(self._path))
+        except OSError as error:
+            _LOGGER.warning("Could not load history from %s: %s", self._path, error)
+            return
+        for name in names:
+            if name.endswith(".json"):
+                self._load_sensor(os.path.join(self._path, name))
+
+    def _load_sensor(self, path):
+        """Load the rollup of one sensor from its JSON file."""
+        try:
+            with open(path) as rollup_file:
+                content = json.load(rollup_file)
+        except (OSError, ValueError) as error:
+            _LOGGER.warning("Could not load history from %s: %s", path, error)
+            return
+        if (
+            not isinstance(content, dict)
+            or content.get("version") != _FILE_FORMAT_VERSION
+        ):
+            _LOGGER.warning("Ignoring history with unknown format in %s", path)
+            return
+        try:
+            sensor = _Sensor()
+            sensor.latest = content["latest"]
+            sensor.raw_times = [row[0] for row in content[RAW]]
+            sensor.raw = [row[1] for row in content[RAW]]
+            for resolution, _ in RESOLUTIONS[1:]:
+                sensor.buckets[resolution] = {
+                    timestamp: {
+                        metric: Aggregate(*aggregate)
+                        for metric, aggregate in bucket.items()
+                    }
+                    for timestamp, bucket in content[resolution]
+                }
+            self._sensors[content["mac"]] = sensor
+        except (KeyError, IndexError, TypeError) as error:
+            _LOGGER.warning("Ignoring invalid history in %s: %s", path, error)
+
+    def _save(self, macs):
+        """Atomically write the files of the sensors.
+
+        Errors are only logged, the data is still kept in memory.
+        """
+        if self._path is None:
+            return
+        try:
+            os.makedirs(self._path, exist_ok=True)
+        except OSError as error:
+            _LOGGER.warning("Could not save history to %s: %s", self._path, error)
+            return
+        for mac in macs:
+            sensor = self._sensors[mac]
+            stored = {
+                "version": _FILE_FORMAT_VERSION,
+                "mac": mac,
+                "latest": sensor.latest,
+                RAW: [list(row) for row in zip(sensor.raw_times, sensor.raw)],
+            }
+            for resolution, _ in RESOLUTIONS[1:]:
+                stored[resolution] = [
+                    [
+                        timestamp,
+                        {
+                            metric: [a.count, a.minimum, a.maximum, a.total]
+                            for metric, a in bucket.items()
+                        },
+                    ]
+                    for timestamp, bucket in sensor.buckets[resolution].items()
+                ]
+            path = self._file(mac)
+            try:
+                with open(path + ".tmp", "w") as rollup_file:
+                    json.dump(stored, rollup_file)
+                os.replace(path + ".tmp", path)
+            except OSError as error:
+                _LOGGER.warning("Could not save history to %s: %s", path, error)
@@ -0,0 +1,247 @@
+"""
+Share the sensors among several gateways.
+
+One gateway can neither reach all sensors of a large installation nor keep up
+with polling them. With several gateways, the ShardCoordinator assigns every
+sensor to the gateway that receives it best, based on the RSSI the gateways
+observe while scanning, without giving a gateway more sensors than its
+capacity. If a gateway stops reporting, its sensors move to the other
+gateways. Readings and history entries received by several gateways, e.g.
+while a sensor moves, are only accepted once.
+
+The coordinator runs in one process, the gateways talk to it over a
+multiprocessing connection:
+
+    # coordinator
+    CoordinatorServer(ShardCoordinator(), ("0.0.0.0", 6000), b"secret").serve_forever()
+
+    # every gateway
+    gateway = GatewayClient(("coordinator", 6000), b"secret", "gateway-1")
+    macs = gateway.report([(mac, rssi), ...])  # the sensors to poll
+    if gateway.accept(mac, entry.device_time):
+        store(entry)
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 50
+# seconds without report after which a gateway is considered dead
+DEFAULT_GATEWAY_TIMEOUT = 300
+# seconds after which an RSSI observation is ignored
+DEFAULT_OBSERVATION_TIMEOUT = 900
+# a sensor only moves to another gateway if it receives it this much better (dB)
+DEFAULT_HYSTERESIS = 5
+# number of accepted keys remembered per sensor for the deduplication
+_SEEN_KEYS = 1024
+
+
+class ShardCoordinator:
+    """Assign the sensors to the gateways by RSSI and capacity.
+
+    `capacities` maps gateway names to the number of sensors they can poll,
+    other gateways get `capacity`. The coordinator is thread safe.
+    """
+
+    def __init__(
+        self,
+        capacity=DEFAULT_CAPACITY,
+        capacities=None,
+        gateway_timeout=DEFAULT_GATEWAY_TIMEOUT,
+        observation_timeout=DEFAULT_OBSERVATION_TIMEOUT,
+        hysteresis=DEFAULT_HYSTERESIS,
+    ):  # pylint: disable=too-many-arguments
+        self.capacity = capacity
+        self.capacities = dict(capacities or dict())
+        self.gateway_timeout = gateway_timeout
+        self.observation_timeout = observation_timeout
+        self.hysteresis = hysteresis
+        # time of the last report per gateway
+        self._gateways = dict()
+        # (rssi, time) per MAC address and gateway
+        self._observations = dict()
+        self._assignments = dict()
+        self._seen = dict()
+        self._lock = Lock()
+
+    def observe(self, gateway, observations, now=None):
+        """Record the (mac, rssi) pairs a gateway received while scanning.
+
+        This also counts as sign of life of the gateway.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._gateways[gateway] = now
+            for mac, rssi in observations:
+                self._observations.setdefault(mac.upper(), dict())[gateway] = (
+                    rssi,
+                    now,
+                )
+
+    def remove(self, gateway):
+        """Forget a gateway, e.g. when its connection was closed."""
+        with self._lock:
+            self._gateways.pop(gateway, None)
+            for observations in self._observations.values():
+                observations.pop(gateway, None)
+
+    def gateways(self, now=None):
+        """Return the names of the gateways that are alive."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._live_gateways(now)
+
+    def _live_gateways(self, now):
+        """Return the gateways alive at `now`, the lock must be held."""
+        return sorted(
+            gateway
+            for gateway, seen in self._gateways.items()
+            if now - seen < self.gateway_timeout
+        )
+
+    def _candidates(self, mac, live, now):
+        """Return the live gateways receiving a sensor, best first."""
+        observations = self._observations.get(mac, dict())
+        candidates = [
+            (rssi, gateway)
+            for gateway, (rssi, seen) in observations.items()
+            if gateway in live and now - seen < self.observation_timeout
+        ]
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        return candidates
+
+    def assign(self, now=None):
+        """Compute the assignment of the sensors to the gateways.
+
+        Returns a dictionary of the gateways and their sorted lists of sensors.
+        Sensors that no live gateway receives are not assigned. A sensor stays
+        with its gateway unless another one receives it `hysteresis` dB better.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            live = set(self._live_gateways(now))
+            load = {gateway: 0 for gateway in live}
+            candidates = {
+                mac: self._candidates(mac, live, now) for mac in self._observations
+            }
+            assignments = dict()
+            # sensors with the fewest options first, they are the hardest to place
+            for mac in sorted(candidates, key=lambda m: (len(candidates[m]), m)):
+                options = [
+                    (rssi, gateway)
+                    for rssi, gateway in candidates[mac]
+                    if load[gateway] < self.capacities.get(gateway, self.capacity)
+                ]
+                if not options:
+                    continue
+                best_rssi, gateway = options[0]
+                current = self._assignments.get(mac)
+                for rssi, option in options:
+                    if option == current and rssi + self.hysteresis > best_rssi:
+                        gateway = current
+                assignments[mac] = gateway
+                load[gateway] += 1
+            self._assignments = assignments
+        result = {gateway: [] for gateway in live}
+        for mac, gateway in sorted(assignments.items()):
+            result[gateway].append(mac)
+        return result
+
+    def accept(self, mac, key):
+        """Check if a reading of a sensor is new.
+
+        `key` identifies the reading, e.g. the device time of a history entry.
+        Returns True only for the first gateway submitting it.
+        """
+        with self._lock:
+            seen = self._seen.setdefault(mac.upper(), OrderedDict())
+            if key in seen:
+                return False
+            seen[key] = True
+            if len(seen) > _SEEN_KEYS:
+                seen.popitem(last=False)
+            return True
+
+
+class CoordinatorServer:
+    """Serve a ShardCoordinator to gateways in other processes.
+
+    `address` and `authkey` are passed to multiprocessing.connection.Listener.
+    Every gateway connection is handled in its own thread. When a connection
+    is closed, the gateway is removed, so its sensors move to other gateways.
+    """
+
+    def __init__(self, coordinator, address, authkey):
+        self.coordinator = coordinator
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+
+    def serve_forever(self):
+        """Accept gateway connections until close is called."""
+        while True:
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                return
+            Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        """Answer the requests of one gateway."""
+        gateway = None
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    break
+                command, gateway, args = request
+                if command == "report":
+                    self.coordinator.observe(gateway, args)
+                    response = self.coordinator.assign().get(gateway, [])
+                elif command == "accept":
+                    response = self.coordinator.accept(*args)
+                else:
+                    response = None
+                connection.send(response)
+        if gateway is not None:
+            _LOGGER.info("Gateway %s disconnected", gateway)
+            self.coordinator.remove(gateway)
+
+    def close(self):
+        """Stop accepting connections."""
+        self._listener.close()
+
+
+class GatewayClient:
+    """Connection of a gateway to the CoordinatorServer."""
+
+    def __init__(self, address, authkey, name):
+        self.name = name
+        self._connection = Client(address, authkey=authkey)
+        self._lock = Lock()
+
+    def _request(self, command, args):
+        """Send a request and wait for the response."""
+        with self._lock:
+            self._connection.send((command, self.name, args))
+            return self._connection.recv()
+
+    def report(self, observations):
+        """Report the (mac, rssi) pairs seen while scanning.
+
+        Returns the list of sensors this gateway should poll.
+        """
+        return self._request("report", list(observations))
+
+    def accept(self, mac, key):
+        """Check if a reading must be stored, see ShardCoordinator.accept."""
+        return self._request("accept", (mac, key))
+
+    def close(self):
+        """Close the connection to the coordinator."""
+        self._connection.close()
@@ -0,0 +1,65 @@
+"""
+Compact state of the sensors of a fleet.
+
+A fleet can have thousands of sensors. Their state is kept in small records with
+__slots__ and plain floats instead of datetime objects, one record per MAC
+address. The MiFloraPoller objects are only views on these records, so they can
+be created on demand and thrown away. See miflora_fleet for the shared engine.
+"""
+
+from threading import Lock
+
+
+class SensorState:  # pylint: disable=too-few-public-methods
+    """State of one sensor.
+
+    `cache` is the raw sensor data and `last_read` the time it was read in
+    seconds since the epoch. `firmware` is the parsed `firmware_version`.
+    """
+
+    __slots__ = ("mac", "cache", "last_read", "firmware_version", "firmware", "battery")
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.cache = None
+        self.last_read = None
+        self.firmware_version = None
+        self.firmware = None
+        self.battery = None
+
+
+class FleetState:
+    """Table of the states of many sensors, indexed by MAC address."""
+
+    def __init__(self):
+        self._states = dict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(mac):
+        """Normalize the MAC address."""
+        return mac.upper() if isinstance(mac, str) else mac
+
+    def get(self, mac):
+        """Return the state of a sensor, a new one if the sensor is unknown."""
+        key = self._key(mac)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = SensorState(key)
+            return state
+
+    def remove(self, mac):
+        """Forget the state of a sensor."""
+        with self._lock:
+            self._states.pop(self._key(mac), None)
+
+    def __contains__(self, mac):
+        return self._key(mac) in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._states.values()))
@@ -0,0 +1,32 @@
+"""
+Fast transfer of write/read pairs, as used for reading the history.
+
+Each history entry is read by writing its address to the history control handle
+and then reading the history read handle. Done naively, every entry costs two
+round trips. Backends can provide one of these optional methods to speed it up:
+
+* `write_read_batch(write_handle, read_handle, values)` writes each value and
+  reads the response for a whole batch and returns the list of responses. The
+  backend is free to pipeline the commands of a batch.
+* `write_handle_no_response(handle, value)` writes a value without waiting for a
+  write response. ATT keeps commands and requests in order, so the following read
+  still returns the right entry, but only one round trip per entry is needed.
+  See miflora_bluepy for a backend supporting it.
+"""
+
+
+def write_read_pairs(connection, write_handle, read_handle, values):
+    """Write each value to write_handle and read read_handle after each write.
+
+    This is a generator yielding the responses one by one, so that a failure of
+    a read does not discard the responses received before. The fastest method
+    supported by the backend is used.
+    """
+    batch = getattr(connection, "write_read_batch", None)
+    if batch is not None:
+        yield from batch(write_handle, read_handle, values)
+        return
+    write = getattr(connection, "write_handle_no_response", connection.write_handle)
+    for value in values:
+        write(write_handle, value)
+        yield connection.read_handle(read_handle)
@@ -0,0 +1,335 @@
+"""
+Compact binary encoding of readings and history entries.
+
+Gateways on metered links should not upload their readings as JSON: a history
+entry takes about 150 bytes as JSON, but most of it repeats the previous entry.
+The WireEncoder writes a versioned binary stream, in which every record only
+holds what changed since the previous record of the same sensor and kind:
+
+- the timestamps as delta of the deltas, 0 for regular intervals,
+- a bitmap of the changed values and
+- the changes of these values as zigzag varints.
+
+Values are stored as fixed point integers, the temperature in 0.1 °C, the
+wall time of history entries as offset to the device time in seconds. An
+hourly history entry with unchanged values takes 3 bytes.
+
+Both sides are streaming: the encoder returns the bytes of every call, the
+WireDecoder accepts the stream in arbitrary chunks. A stream must be decoded
+from its start, call WireEncoder.reset to start a new one, e.g. for every
+upload.
+
+Example:
+    encoder = WireEncoder()
+    upload(encoder.history(mac, poller.fetch_history()))
+
+    decoder = WireDecoder()
+    for record in decoder.feed(chunk):
+        store(record.mac, record.timestamp, record.values)
+"""
+
+from datetime import datetime
+
+from .miflora_decoder import (
+    HISTORY_DATA,
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    SENSOR_DATA,
+)
+from .miflora_history import DEVICE_TIME, WALL_TIME
+
+MAGIC = b"MFW"
+VERSION = 1
+
+# kinds of records, stored in the lowest two bits of the record header
+_DEFINE_MAC = 0
+_KINDS = {SENSOR_DATA: 1, HISTORY_DATA: 2}
+_KIND_NAMES = {code: kind for kind, code in _KINDS.items()}
+
+# values of the records in the order of the bitmap
+READING_FIELDS = (MI_TEMPERATURE, MI_MOISTURE, MI_LIGHT, MI_CONDUCTIVITY, MI_BATTERY)
+HISTORY_FIELDS = (WALL_TIME, MI_TEMPERATURE, MI_MOISTURE, MI_LIGHT, MI_CONDUCTIVITY)
+_FIELDS = {SENSOR_DATA: READING_FIELDS, HISTORY_DATA: HISTORY_FIELDS}
+# factors of the fixed point values
+_SCALES = {MI_TEMPERATURE: 10}
+
+
+def _write_varint(out, value):
+    """Append an unsigned integer as varint."""
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value):
+    """Map a signed integer to an unsigned one, small magnitudes stay small."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    """Reverse _zigzag."""
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+
+class _Incomplete(Exception):
+    """The buffer ends within a record."""
+
+
+class WireRecord:  # pylint: disable=too-few-public-methods
+    """Record decoded from a wire stream.
+
+    `kind` is SENSOR_DATA for readings and HISTORY_DATA for history entries.
+    `timestamp` is the time of a reading in seconds since the epoch or the
+    device time of a history entry. `values` holds the measurements, history
+    entries also the device time and the wall time as datetime.
+    """
+
+    __slots__ = ("mac", "kind", "timestamp", "values")
+
+    def __init__(self, mac, kind, timestamp, values):
+        self.mac = mac
+        self.kind = kind
+        self.timestamp = timestamp
+        self.values = values
+
+    def __repr__(self):
+        return (
+            f"WireRecord({self.mac!r}, {self.kind!r}, "
+            f"{self.timestamp!r}, {self.values!r})"
+        )
+
+
+class _Series:  # pylint: disable=too-few-public-methods
+    """State of the records of one sensor and kind."""
+
+    __slots__ = ("timestamp", "delta", "values")
+
+    def __init__(self, size):
+        self.timestamp = 0
+        self.delta = 0
+        self.values = [None] * size
+
+
+class WireEncoder:
+    """Encode readings and history entries into a wire stream.
+
+    The encoder keeps the last record of every sensor, so one encoder must be
+    used for one stream. The first call returns the header of the stream.
+    """
+
+    def __init__(self):
+        self._macs = dict()
+        self._series = dict()
+        self._started = False
+
+    def reset(self):
+        """Start a new stream, e.g. for the next upload."""
+        self._macs = dict()
+        self._series = dict()
+        self._started = False
+
+    def _start(self, out, mac):
+        """Write the header of the stream and the index of a new sensor."""
+        if not self._started:
+            out += MAGIC
+            out.append(VERSION)
+            self._started = True
+        mac = mac.upper()
+        index = self._macs.get(mac)
+        if index is None:
+            index = self._macs[mac] = len(self._macs)
+            _write_varint(out, index << 2 | _DEFINE_MAC)
+            out += bytes.fromhex(mac.replace(":", ""))
+        return index
+
+    def _record(self, out, index, kind, timestamp, values):
+        """Append one record."""
+        code = _KINDS[kind]
+        series = self._series.get((index, code))
+        if series is None:
+            series = self._series[(index, code)] = _Series(len(values))
+        _write_varint(out, index << 2 | code)
+        mask = 0
+        changes = []
+        for bit, (value, last) in enumerate(zip(values, series.values)):
+            if value != last:
+                mask |= 1 << bit
+                # 0 marks a missing value, changes are shifted by one
+                if value is None:
+                    changes.append(0)
+                else:
+                    changes.append(_zigzag(value - (last or 0)) + 1)
+        out.append(mask)
+        delta = timestamp - series.timestamp
+        _write_varint(out, _zigzag(delta - series.delta))
+        for change in changes:
+            _write_varint(out, change)
+        series.timestamp = timestamp
+        series.delta = delta
+        series.values = values
+
+    @staticmethod
+    def _fixed(field, value):
+        """Convert a value to its fixed point integer."""
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return int(round(value * _SCALES.get(field, 1)))
+
+    def reading(self, mac, reading, timestamp):
+        """Encode a reading, a dictionary as returned by the decoders.
+
+        `timestamp` is rounded to seconds. Measurements that are not in
+        READING_FIELDS or not numbers are not encoded.
+        """
+        out = bytearray()
+        index = self._start(out, mac)
+        values = [self._fixed(field, reading.get(field)) for field in READING_FIELDS]
+        self._record(out, index, SENSOR_DATA, int(round(timestamp)), values)
+        return bytes(out)
+
+    def history(self, mac, entries):
+        """Encode history entries, e.g. as returned by fetch_history.
+
+        The wall times are rounded to seconds.
+        """
+        out = bytearray()
+        index = self._start(out, mac)
+        for entry in entries:
+            offset = None
+            if entry.wall_time is not None:
+                offset = int(round(entry.wall_time.timestamp())) - entry.device_time
+            values = [offset] + [
+                self._fixed(field, getattr(entry, field))
+                for field in HISTORY_FIELDS[1:]
+            ]
+            self._record(out, index, HISTORY_DATA, entry.device_time, values)
+        return bytes(out)
+
+
+class WireDecoder:
+    """Decode a wire stream, which may be fed in chunks of any size."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._started = False
+        self._macs = []
+        self._series = dict()
+
+    def feed(self, data):
+        """Decode the next chunk of the stream, returns the completed records."""
+        self._buffer += data
+        records = []
+        position = 0
+        try:
+            if not self._started:
+                position = self._header()
+            while position < len(self._buffer):
+                position, record = self._record(position)
+                if record is not None:
+                    records.append(record)
+        except _Incomplete:
+            pass
+        del self._buffer[:position]
+        return records
+
+    def close(self):
+        """Check that the stream did not end within a record."""
+        if self._buffer:
+            raise ValueError("The wire stream ends within a record")
+
+    def _header(self):
+        """Check the header of the stream."""
+        size = len(MAGIC) + 1
+        if len(self._buffer) < size:
+            if not MAGIC.startswith(bytes(self._buffer[: len(MAGIC)])):
+                raise ValueError("Not a miflora wire stream")
+            raise _Incomplete()
+        if self._buffer[: len(MAGIC)] != MAGIC:
+            raise ValueError("Not a miflora wire stream")
+        if self._buffer[len(MAGIC)] != VERSION:
+            raise ValueError(
+                f"Unsupported wire format version {self._buffer[len(MAGIC)]}"
+            )
+        self._started = True
+        return size
+
+    def _varint(self, position):
+        """Read a varint, returns the position after it and its value."""
+        value = 0
+        shift = 0
+        buffer = self._buffer
+        while True:
+            if position >= len(buffer):
+                raise _Incomplete()
+            byte = buffer[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return position, value
+            shift += 7
+
+    def _record(self, position):
+        """Decode the record at `position`."""
+        position, header = self._varint(position)
+        index, code = header >> 2, header & 0x03
+        if code == _DEFINE_MAC:
+            if position + 6 > len(self._buffer):
+                raise _Incomplete()
+            if index != len(self._macs):
+                raise ValueError(f"Unexpected sensor index {index}")
+            self._macs.append(
+                ":".join(
+                    format(c, "02X") for c in self._buffer[position : position + 6]
+                )
+            )
+            return position + 6, None
+        if index >= len(self._macs) or code not in _KIND_NAMES:
+            raise ValueError(f"Invalid record header {header}")
+        kind = _KIND_NAMES[code]
+        fields = _FIELDS[kind]
+        if position >= len(self._buffer):
+            raise _Incomplete()
+        mask = self._buffer[position]
+        position, dod = self._varint(position + 1)
+        series = self._series.get((index, code))
+        values = list(series.values) if series else [None] * len(fields)
+        for bit in range(len(fields)):
+            if mask & 1 << bit:
+                position, change = self._varint(position)
+                values[bit] = (
+                    None if change == 0 else (values[bit] or 0) + _unzigzag(change - 1)
+                )
+        # the record is complete, update the state
+        if series is None:
+            series = self._series[(index, code)] = _Series(len(fields))
+        series.delta += _unzigzag(dod)
+        series.timestamp += series.delta
+        series.values = values
+        return position, self._make_record(self._macs[index], kind, series)
+
+    @staticmethod
+    def _make_record(mac, kind, series):
+        """Convert the fixed point values of a record."""
+        values = dict()
+        for field, value in zip(_FIELDS[kind], series.values):
+            if field == WALL_TIME:
+                if value is not None:
+                    value = datetime.fromtimestamp(series.timestamp + value)
+            elif value is not None and field in _SCALES:
+                value = value / _SCALES[field]
+            values[field] = value
+        if kind == HISTORY_DATA:
+            values[DEVICE_TIME] = series.timestamp
+        return WireRecord(mac, kind, series.timestamp, values)
+
+
+def decode(data):
+    """Decode a complete wire stream, returns the list of WireRecords."""
+    decoder = WireDecoder()
+    records = decoder.feed(data)
+    decoder.close()
+    return records
@@ -0,0 +1,291 @@
+"""
+Run the Bluetooth backends in supervised worker processes.
+
+Some backends hang or leak (gatttool subprocesses, the bluepy helper, pygatt).
+The ProcessBackend forwards all calls of a backend to a worker process, one per
+adapter. The worker processes talk to the main process over a pipe with small
+tuples of opcodes and arguments. If a worker does not answer in time or dies,
+it is killed and restarted, so that a fault never takes the whole process down.
+
+Example:
+    poller = MiFloraPoller(mac, functools.partial(ProcessBackend, backend=GatttoolBackend))
+"""
+
+import itertools
+import logging
+import multiprocessing
+from threading import Lock
+
+from btlewrap.base import AbstractBackend, BluetoothBackendException
+
+from .miflora_deadline import BluetoothTimeoutException
+
+_LOGGER = logging.getLogger(__name__)
+
+# opcodes of the IPC protocol
+_OP_OPEN = 0
+_OP_CLOSE = 1
+_OP_CONNECT = 2
+_OP_DISCONNECT = 3
+_OP_READ = 4
+_OP_WRITE = 5
+_OP_CALL = 6
+_OP_SHUTDOWN = 7
+
+_STATUS_OK = 0
+_STATUS_ERROR = 1
+_STATUS_READY = 2
+
+# seconds a new worker process may take to start, e.g. to import the backend
+DEFAULT_START_TIMEOUT = 30.0
+
+# optional methods of the backends that are forwarded if the backend has them
+OPTIONAL_METHODS = ("write_read_batch", "write_handle_no_response")
+
+_WORKERS = dict()
+_WORKERS_LOCK = Lock()
+_SESSION_IDS = itertools.count()
+
+
+# calls of the backend of a session per opcode
+_SESSION_CALLS = {
+    _OP_CONNECT: lambda instance, args: instance.connect(*args),
+    _OP_DISCONNECT: lambda instance, args: instance.disconnect(),
+    _OP_READ: lambda instance, args: instance.read_handle(*args),
+    _OP_WRITE: lambda instance, args: instance.write_handle(*args),
+    _OP_CALL: lambda instance, args: getattr(instance, args[0])(*args[1]),
+}
+
+
+def _worker_main(pipe, backend, adapter, address_type, kwargs):
+    """Main loop of a worker process.
+
+    Every client has its own session with its own instance of the backend.
+    Requests are (session, opcode, args) tuples, answers (status, result) tuples.
+    """
+    sessions = dict()
+    pipe.send((_STATUS_READY, None))
+    while True:
+        try:
+            session, opcode, args = pipe.recv()
+        except (EOFError, OSError):
+            return
+        if opcode == _OP_SHUTDOWN:
+            return
+        try:
+            if opcode == _OP_OPEN:
+                instance = sessions.get(session)
+                if instance is None:
+                    instance = backend(
+                        adapter=adapter, address_type=address_type, **kwargs
+                    )
+                    sessions[session] = instance
+                result = (
+                    instance.check_backend(),
+                    [name for name in OPTIONAL_METHODS if hasattr(instance, name)],
+                )
+            elif opcode == _OP_CLOSE:
+                result = sessions.pop(session, None) is not None
+            else:
+                instance = sessions.get(session)
+                if instance is None:
+                    raise BluetoothBackendException("Session lost by a worker restart")
+                result = _SESSION_CALLS[opcode](instance, args)
+            pipe.send((_STATUS_OK, result))
+        except Exception as error:  # pylint: disable=broad-except
+            pipe.send((_STATUS_ERROR, f"{type(error).__name__}: {error}"))
+
+
+class AdapterWorker:
+    """Supervised worker process performing the backend calls for one adapter.
+
+    Calls are serialized. If a call takes longer than `call_timeout` seconds, the
+    worker is considered wedged and restarted. Starting the worker is not part
+    of the call, it may take up to `start_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        backend,
+        adapter,
+        address_type="public",
+        kwargs=None,
+        call_timeout=60.0,
+        start_method="spawn",
+        start_timeout=DEFAULT_START_TIMEOUT,
+    ):
+        self._args = (backend, adapter, address_type, dict(kwargs or dict()))
+        self.call_timeout = call_timeout
+        self.start_timeout = start_timeout
+        self._context = multiprocessing.get_context(start_method)
+        self._lock = Lock()
+        self._process = None
+        self._pipe = None
+        self.restarts = 0
+
+    def _start(self):
+        """Start the worker process."""
+        self._pipe, child_pipe = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_worker_main, args=(child_pipe,) + self._args, daemon=True
+        )
+        self._process.start()
+        child_pipe.close()
+        try:
+            ready = self._pipe.poll(self.start_timeout) and self._pipe.recv()
+        except (EOFError, OSError):
+            ready = None
+        if not ready or ready[0] != _STATUS_READY:
+            self._kill()
+            raise BluetoothBackendException(
+                f"Bluetooth worker for adapter {self._args[1]} did not start"
+            )
+
+    def _kill(self):
+        """Kill the worker process."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._pipe.close()
+        self._process = None
+        self._pipe = None
+
+    def restart(self):
+        """Kill and restart the worker process."""
+        _LOGGER.warning("Restarting Bluetooth worker for adapter %s", self._args[1])
+        self._kill()
+        self.restarts += 1
+        self._start()
+
+    def call(self, session, opcode, *args):
+        """Send a request to the worker and return the result."""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                if self._process is not None:
+                    self.restarts += 1
+                self._kill()
+                self._start()
+            try:
+                self._pipe.send((session, opcode, args))
+                if not self._pipe.poll(self.call_timeout):
+                    self.restart()
+                    raise BluetoothTimeoutException(
+                        f"Bluetooth worker did not answer within {self.call_timeout} s"
+                    )
+                status, result = self._pipe.recv()
+            except (EOFError, OSError) as error:
+                self.restart()
+                raise BluetoothBackendException("Bluetooth worker died") from error
+        if status == _STATUS_ERROR:
+            raise BluetoothBackendException(result)
+        return result
+
+    def stop(self):
+        """Stop the worker process."""
+        with self._lock:
+            if self._process is not None and self._process.is_alive():
+                try:
+                    self._pipe.send((None, _OP_SHUTDOWN, ()))
+                except OSError:
+                    pass
+                self._process.join(1)
+            self._kill()
+
+
+def get_worker(backend, adapter, address_type="public", kwargs=None, **worker_kwargs):
+    """Return the shared worker for a backend on an adapter."""
+    kwargs = dict(kwargs or dict())
+    key = (backend, adapter, address_type, tuple(sorted(kwargs.items())))
+    with _WORKERS_LOCK:
+        if key not in _WORKERS:
+            _WORKERS[key] = AdapterWorker(
+                backend, adapter, address_type, kwargs, **worker_kwargs
+            )
+        return _WORKERS[key]
+
+
+def stop_workers():
+    """Stop all worker processes."""
+    with _WORKERS_LOCK:
+        workers = list(_WORKERS.values())
+        _WORKERS.clear()
+    for worker in workers:
+        worker.stop()
+
+
+class ProcessBackend(AbstractBackend):
+    """Backend forwarding all calls to a worker process of another backend.
+
+    `backend` is the class of the backend to run in the worker process. Further
+    keyword arguments are passed to that backend.
+    """
+
+    def __init__(
+        self,
+        adapter="hci0",
+        address_type="public",
+        *,
+        backend,
+        call_timeout=60.0,
+        **kwargs,
+    ):
+        super().__init__(adapter, address_type)
+        self._worker = get_worker(
+            backend, adapter, address_type, kwargs, call_timeout=call_timeout
+        )
+        self._session = next(_SESSION_IDS)
+        self._available = None
+        self._optional_methods = ()
+        # restarts of the worker when the session was opened
+        self._restarts = None
+
+    def _open(self):
+        """Open the session in the worker, e.g. after a restart of the worker."""
+        restarts = self._worker.restarts
+        self._available, self._optional_methods = self._worker.call(
+            self._session, _OP_OPEN
+        )
+        self._restarts = restarts
+
+    def _call(self, opcode, *args):
+        """Forward a call to the worker.
+
+        The session is only opened again if the worker was restarted, otherwise
+        the backend instance, and its connection, stays the same after errors.
+        """
+        if self._available is None or self._restarts != self._worker.restarts:
+            self._open()
+        return self._worker.call(self._session, opcode, *args)
+
+    def check_backend(self):  # pylint: disable=arguments-differ
+        """Check if the backend is available in the worker."""
+        self._open()
+        return self._available
+
+    def connect(self, mac):
+        """Connect to a device."""
+        return self._call(_OP_CONNECT, mac)
+
+    def disconnect(self):
+        """Disconnect from a device."""
+        return self._call(_OP_DISCONNECT)
+
+    def read_handle(self, handle):
+        """Read a handle from the device."""
+        return self._call(_OP_READ, handle)
+
+    def write_handle(self, handle, value):
+        """Write a handle of the device."""
+        return self._call(_OP_WRITE, handle, value)
+
+    def __getattr__(self, name):
+        """Forward the optional methods that the backend in the worker supports."""
+        if name.startswith("_") or name not in self._optional_methods:
+            raise AttributeError(name)
+        return lambda *args: self._call(_OP_CALL, name, args)
+
+    def close(self):
+        """Close the session in the worker."""
+        if self._available is not None:
+            self._available = None
+            self._worker.call(self._session, _OP_CLOSE)
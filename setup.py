@@ -53,6 +53,6 @@ setup(
     keywords="plant sensor bluetooth low-energy ble",
     zip_safe=False,
     install_requires=["btlewrap>=0.0.10,<0.2"],
-    extras_require={"testing": ["pytest"]},
+    extras_require={"testing": ["pytest"], "export": ["numpy", "pandas", "pyarrow"]},
     include_package_data=True,
 )
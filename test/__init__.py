@@ -9,6 +9,8 @@ HANDLE_DEVICE_TIME = 0x41
 HANDLE_HISTORY_CONTROL = 0x3E
 HANDLE_HISTORY_READ = 0x3C
 
+CMD_HISTORY_READ_SUCCESS = b"\xa2\x00\x00"
+
 DATA_MODE_CHANGE = bytes([0xA0, 0x1F])
 
 TEST_MAC = "11:22:33:44:55:66"
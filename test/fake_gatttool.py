@@ -0,0 +1,59 @@
+"""Fake of `gatttool -I` for the unit tests.
+
+It emulates a Mi Flora sensor with firmware 3.2.1 and a history of two entries.
+Reading handle 0x99 fails.
+"""
+
+import sys
+
+PROMPT = "\x1b[0;94m[{mac}][LE]>\x1b[0m "
+HANDLES = {
+    0x03: b"Flower care",
+    0x35: bytes.fromhex("d700fe000000002a7900023c00fb349b"),
+    0x38: b"\x64\x10" + b"3.2.1",
+    0x41: b"\xd8I\x15\x00",
+}
+HISTORY = [
+    bytes.fromhex("30421500c10000000000001e87020000"),
+    bytes.fromhex("20341500c10000000000001e8c020000"),
+]
+
+
+def main():
+    """Answer the commands on stdin like gatttool does."""
+    mac = sys.argv[sys.argv.index("-b") + 1]
+    history_command = b""
+    sys.stdout.write(PROMPT.format(mac=mac))
+    sys.stdout.flush()
+    for line in sys.stdin:
+        command = line.split()
+        if not command:
+            continue
+        if command[0] == "exit":
+            return
+        if command[0] == "connect":
+            print(f"Attempting to connect to {mac}")
+            print("Connection successful")
+        elif command[0] == "char-read-hnd":
+            handle = int(command[1], 16)
+            if handle == 0x3C and history_command[:1] == b"\xa0":
+                value = len(HISTORY).to_bytes(2, "little") + bytes(14)
+            elif handle == 0x3C:
+                value = HISTORY[int.from_bytes(history_command[1:3], "little")]
+            elif handle in HANDLES:
+                value = HANDLES[handle]
+            else:
+                print("Characteristic value/descriptor read failed: Invalid handle")
+                value = None
+            if value is not None:
+                print("Characteristic value/descriptor: " + value.hex(" "))
+        elif command[0] == "char-write-req":
+            if int(command[1], 16) == 0x3E:
+                history_command = bytes.fromhex(command[2])
+            print("Characteristic value was written successfully")
+        sys.stdout.write(PROMPT.format(mac=mac))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """Helper functions for unit tests."""
 from struct import unpack
 from test import (
+    CMD_HISTORY_READ_SUCCESS,
     HANDLE_DEVICE_TIME,
     HANDLE_HISTORY_CONTROL,
     HANDLE_HISTORY_READ,
@@ -82,6 +83,9 @@ class MockBackend(AbstractBackend):
         """Writing handles just stores the results in a list."""
         if handle == HANDLE_HISTORY_CONTROL:
             self._history_control = value
+            if value == CMD_HISTORY_READ_SUCCESS:
+                self.history_info = bytes(16)
+                self.history_data = []
         else:
             self.written_handles.append((handle, value))
         return handle in self.expected_write_handles
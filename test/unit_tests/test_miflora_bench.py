@@ -0,0 +1,55 @@
+"""Tests for the miflora_bench module."""
+
+import unittest
+from test import TEST_MAC
+
+from miflora.miflora_bench import (
+    CONNECT,
+    DECODE,
+    HISTORY,
+    HISTORY_ROUND_TRIP,
+    MODE_CHANGE,
+    SENSOR_READ,
+    TOTAL,
+    PhaseTimes,
+    SimulatedBackend,
+    run_bench,
+)
+
+
+class TestBench(unittest.TestCase):
+    """Tests for run_bench and the TimingBackend."""
+
+    def test_poll(self):
+        """Every poll records its phases."""
+        times = run_bench(TEST_MAC, SimulatedBackend, count=3, latency=0.01)
+        self.assertEqual(times.runs, 3)
+        for phase in (MODE_CHANGE, SENSOR_READ, DECODE, TOTAL):
+            self.assertEqual(len(times.durations[phase]), 3)
+        # one more connection to read the firmware
+        self.assertEqual(len(times.durations[CONNECT]), 4)
+        self.assertGreaterEqual(times.percentile(SENSOR_READ, 50), 0.01)
+        self.assertGreaterEqual(times.percentile(TOTAL, 50), 0.02)
+        self.assertLess(times.percentile(DECODE, 99), times.percentile(TOTAL, 50))
+        self.assertTrue(times.report()[1].startswith(CONNECT))
+
+    def test_history(self):
+        """History reads count the entries and their round trips."""
+        times = run_bench(
+            TEST_MAC, SimulatedBackend, mode=HISTORY, count=2, history_entries=20
+        )
+        self.assertEqual(times.entries, 40)
+        # the history info is one more round trip per read
+        self.assertEqual(len(times.durations[HISTORY_ROUND_TRIP]), 42)
+        self.assertNotIn(MODE_CHANGE, times.durations)
+        self.assertIn("40 history entries", times.report()[-1])
+
+    def test_percentile(self):
+        """Percentiles are taken from the sorted durations."""
+        times = PhaseTimes()
+        self.assertIsNone(times.percentile(CONNECT, 50))
+        for duration in range(100, 0, -1):
+            times.add(CONNECT, duration)
+        self.assertEqual(times.percentile(CONNECT, 50), 51)
+        self.assertEqual(times.percentile(CONNECT, 100), 100)
+        self.assertEqual(times.backend_time, 5050)
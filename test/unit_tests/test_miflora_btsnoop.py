@@ -0,0 +1,128 @@
+"""Tests for the miflora_btsnoop module."""
+
+import io
+import unittest
+from struct import pack
+from test import TEST_MAC
+
+from miflora.miflora_btsnoop import (
+    DATALINK_HCI_UART,
+    DATALINK_MONITOR,
+    DEVICE_TIME,
+    FIRMWARE_DATA,
+    HISTORY_INFO,
+    decode_capture,
+    read_btsnoop,
+)
+from miflora.miflora_decoder import (
+    ADVERTISEMENT_DATA,
+    HISTORY_DATA,
+    MI_BATTERY,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    SENSOR_DATA,
+)
+
+# 2021-01-01 00:00:00 UTC in microseconds since year 0
+START = 0x00DCDDB30F2F8000 + 1609459200 * 1000000
+ADDRESS = bytes(reversed(bytes.fromhex(TEST_MAC.replace(":", ""))))
+HANDLE = 0x0040
+
+
+def _capture(datalink, packets):
+    """Build a btsnoop capture from (flags, packet) tuples."""
+    data = b"btsnoop\x00" + pack(">II", 1, datalink)
+    for index, (flags, packet) in enumerate(packets):
+        data += pack(">IIIIq", len(packet), len(packet), flags, 0, START + index)
+        data += packet
+    return data
+
+
+def _connection_complete():
+    """LE connection complete event for the test sensor."""
+    params = bytes([0x01, 0x00]) + pack("<H", HANDLE) + bytes([0x00, 0x00])
+    params += ADDRESS + bytes(5)
+    return bytes([0x3E, len(params)]) + params
+
+
+def _att(pdu, fragment_size=None):
+    """ACL packets with an ATT PDU, optionally fragmented."""
+    frame = pack("<HH", len(pdu), 0x0004) + pdu
+    size = fragment_size or len(frame)
+    packets = []
+    for offset in range(0, len(frame), size):
+        flags = 0x2000 if offset == 0 else 0x1000
+        fragment = frame[offset : offset + size]
+        packets.append(pack("<HH", HANDLE | flags, len(fragment)) + fragment)
+    return packets
+
+
+def _read(handle, value, fragment_size=None):
+    """Read request and fragmented response in the monitor datalink."""
+    packets = [(4, packet) for packet in _att(pack("<BH", 0x0A, handle))]
+    packets += [(5, p) for p in _att(b"\x0b" + value, fragment_size)]
+    return packets
+
+
+def _write(handle, value):
+    """Write request in the monitor datalink."""
+    return [(4, packet) for packet in _att(pack("<BH", 0x12, handle) + value)]
+
+
+class TestBtsnoop(unittest.TestCase):
+    """Tests for decoding btsnoop captures."""
+
+    def test_connection(self):
+        """Decode the ATT reads of a connection in a btmon capture."""
+        packets = [(3, _connection_complete())]
+        packets += _read(0x38, b"\x63\x10" + b"3.2.1")
+        packets += _read(0x35, bytes.fromhex("d700fe000000002a7900000000000000"), 8)
+        packets += _write(0x3E, b"\xa0\x00\x00")
+        packets += _read(0x3C, bytes.fromhex("0200") + bytes(14))
+        packets += _write(0x3E, b"\xa1\x00\x00")
+        packets += _read(0x3C, bytes.fromhex("10000000d700006400000a2a7900fe00"))
+        packets += _read(0x41, pack("<I", 4242))
+        readings = list(decode_capture(io.BytesIO(_capture(DATALINK_MONITOR, packets))))
+        self.assertEqual(
+            [reading.kind for reading in readings],
+            [FIRMWARE_DATA, SENSOR_DATA, HISTORY_INFO, HISTORY_DATA, DEVICE_TIME],
+        )
+        self.assertTrue(all(reading.mac == TEST_MAC for reading in readings))
+        self.assertEqual(readings[0].values, {MI_BATTERY: 0x63, "firmware": "3.2.1"})
+        self.assertEqual(readings[1].values[MI_TEMPERATURE], 21.5)
+        self.assertEqual(readings[1].values[MI_MOISTURE], 42)
+        self.assertEqual(readings[2].values, {"history_length": 2})
+        self.assertEqual(readings[3].values["device_time"], 16)
+        self.assertEqual(readings[3].values[MI_MOISTURE], 42)
+        self.assertEqual(readings[4].values, {"device_time": 4242})
+        self.assertAlmostEqual(readings[0].timestamp, 1609459200, places=3)
+        self.assertEqual(
+            list(
+                decode_capture(
+                    io.BytesIO(_capture(DATALINK_MONITOR, packets)),
+                    ["aa:bb:cc:dd:ee:ff"],
+                )
+            ),
+            [],
+        )
+
+    def test_advertisement(self):
+        """Decode a MiBeacon advertisement in an HCI UART capture."""
+        service_data = bytes.fromhex("5120980000") + ADDRESS + bytes.fromhex("0810012a")
+        ad = bytes([len(service_data) + 3, 0x16, 0x95, 0xFE]) + service_data
+        report = bytes([0x3E, 0, 0x02, 1, 0x00, 0x00]) + ADDRESS + bytes([len(ad)])
+        report += ad + bytes([0xC4])
+        capture = _capture(DATALINK_HCI_UART, [(0x03, b"\x04" + report)])
+        readings = list(decode_capture(io.BytesIO(capture)))
+        self.assertEqual(len(readings), 1)
+        self.assertEqual(readings[0].kind, ADVERTISEMENT_DATA)
+        self.assertEqual(readings[0].mac, TEST_MAC)
+        self.assertEqual(readings[0].values[MI_MOISTURE], 42)
+        self.assertEqual(readings[0].values["rssi"], -60)
+
+    def test_invalid(self):
+        """Files that are not btsnoop captures are rejected."""
+        with self.assertRaises(ValueError):
+            list(read_btsnoop(io.BytesIO(b"not a capture at all")))
+        with self.assertRaises(ValueError):
+            list(read_btsnoop(io.BytesIO(_capture(1234, []))))
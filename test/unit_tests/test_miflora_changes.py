@@ -0,0 +1,39 @@
+"""Tests for the miflora_changes module."""
+
+import unittest
+from test import TEST_MAC
+
+from miflora.miflora_changes import ChangeFilter
+from miflora.miflora_poller import MI_LIGHT, MI_MOISTURE, MI_TEMPERATURE
+
+
+class TestChanges(unittest.TestCase):
+    """Tests for the ChangeFilter class."""
+
+    def test_deadband(self):
+        """Changes within the deadband are suppressed."""
+        changes = ChangeFilter({MI_TEMPERATURE: 0.2}, heartbeat=600)
+        values = [20.0, 20.1, 19.9, 20.3, 20.3, 20.0]
+        passed = [changes.changed(TEST_MAC, MI_TEMPERATURE, v, 0) for v in values]
+        self.assertEqual(passed, [True, False, False, True, False, True])
+        # other sensors have their own values
+        self.assertTrue(changes.changed("AA:BB:CC:DD:EE:FF", MI_TEMPERATURE, 20.0, 0))
+
+    def test_heartbeat(self):
+        """Unchanged values are passed on after the heartbeat."""
+        changes = ChangeFilter(heartbeat=600)
+        self.assertTrue(changes.changed(TEST_MAC, MI_MOISTURE, 30, 0))
+        self.assertFalse(changes.changed(TEST_MAC, MI_MOISTURE, 30, 599))
+        self.assertTrue(changes.changed(TEST_MAC, MI_MOISTURE, 30, 600))
+        self.assertFalse(changes.changed(TEST_MAC, MI_MOISTURE, 30, 1000))
+
+    def test_filter(self):
+        """Only the changed values of a reading are returned."""
+        changes = ChangeFilter({MI_MOISTURE: 1})
+        reading = {MI_MOISTURE: 30, MI_LIGHT: False, MI_TEMPERATURE: 20.0}
+        self.assertEqual(changes.filter(TEST_MAC, reading, 0), reading)
+        self.assertEqual(changes.filter(TEST_MAC, reading, 10), {})
+        reading = {MI_MOISTURE: 32, MI_LIGHT: False, MI_TEMPERATURE: 20.1}
+        self.assertEqual(changes.filter(TEST_MAC, reading, 20), {MI_MOISTURE: 32})
+        changes.forget(TEST_MAC.lower())
+        self.assertEqual(changes.filter(TEST_MAC, reading, 30), reading)
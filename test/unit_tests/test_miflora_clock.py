@@ -0,0 +1,89 @@
+"""Tests for the miflora_clock module."""
+
+import time
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from miflora.miflora_clock import DeviceClock
+from miflora.miflora_metadata import CLOCK, DeviceMetadataStore
+from miflora.miflora_poller import MiFloraPoller
+
+
+class TestMifloraClock(unittest.TestCase):
+    """Tests for the DeviceClock."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def test_offset(self):
+        """A single sample gives the offset."""
+        clock = DeviceClock()
+        self.assertTrue(clock.needs_sync())
+        clock.add_sample(1000, 1e9, 0.5)
+        self.assertAlmostEqual(1e9 - 100, clock.wall_time(900))
+        self.assertAlmostEqual(1100, clock.device_time(1e9 + 100))
+        self.assertFalse(clock.needs_sync(1e9 + 3600))
+        # with the default drift the uncertainty grows by 0.36 s per hour
+        self.assertTrue(clock.needs_sync(1e9 + 100 * 3600))
+
+    def test_drift(self):
+        """The drift is learned from several samples."""
+        clock = DeviceClock()
+        # the device clock is 1 s per day too slow
+        for day in range(5):
+            clock.add_sample(1000 + day * 86399, 1e9 + day * 86400, 0.1)
+        self.assertAlmostEqual(1e9 + 10 * 86400, clock.wall_time(1000 + 10 * 86399))
+        self.assertLess(clock.uncertainty(1000 + 10 * 86399), 1)
+        self.assertFalse(clock.needs_sync(1e9 + 30 * 86400))
+
+    def test_reboot(self):
+        """A reboot of the device resets the model."""
+        clock = DeviceClock()
+        clock.add_sample(100000, 1e9, 0.1)
+        self.assertTrue(clock.is_consistent(99000, 1e9))
+        self.assertFalse(clock.is_consistent(200000, 1e9 + 10))
+        clock.add_sample(50, 1e9 + 20, 0.1)
+        self.assertEqual(1, len(clock.samples))
+
+    def test_serialization(self):
+        """The clock can be restored from a dictionary."""
+        clock = DeviceClock()
+        clock.add_sample(1000, 1e9, 0.5)
+        clock.add_sample(2000, 1e9 + 1000, 0.5)
+        restored = DeviceClock.from_dict(clock.to_dict())
+        self.assertEqual(clock.wall_time(5000), restored.wall_time(5000))
+        self.assertFalse(DeviceClock.from_dict(None).synced)
+
+    def test_history_without_device_time(self):
+        """A second history download does not read the device time again."""
+        poller = MiFloraPoller(TEST_MAC, MockBackend)
+        backend = poller._bt_interface._backend
+        backend.history_info = b"\x01\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+        ]
+        backend.local_time = b"\xd8I\x15\x00"
+        first = poller.fetch_history()[0].wall_time
+        backend.local_time = None
+        self.assertEqual(first, poller.fetch_history()[0].wall_time)
+
+    def test_history_after_reboot(self):
+        """A reboot is detected from history entries that look too old."""
+        store = DeviceMetadataStore()
+        clock = DeviceClock()
+        clock.add_sample(1000000, time.time() - 3600, 0.1)
+        self.assertTrue(clock.is_recent(1003000, 7200))
+        self.assertFalse(clock.is_recent(1800, 7200))
+        store.set(TEST_MAC, CLOCK, clock.to_dict())
+        poller = MiFloraPoller(TEST_MAC, MockBackend, metadata=store)
+        backend = poller._bt_interface._backend
+        backend.history_info = b"\x01\x00" + bytes(14)
+        # entry at device time 1800, the device time is now 2000
+        backend.history_data = [
+            b"\x08\x07\x00\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+        ]
+        backend.local_time = (2000).to_bytes(4, "little")
+        entry = poller.fetch_history()[0]
+        self.assertEqual(1800, entry.device_time)
+        self.assertAlmostEqual(time.time() - 200, entry.wall_time.timestamp(), delta=5)
@@ -0,0 +1,357 @@
+"""Tests for the miflora_concurrency module."""
+
+import time
+import unittest
+from test import HANDLE_HISTORY_READ, TEST_MAC
+from test.helper import MockBackend
+from threading import Event, Lock, Thread
+
+from btlewrap.base import BluetoothBackendException
+
+from miflora.miflora_concurrency import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    AdapterConnection,
+    AdapterLimiter,
+    BackendPool,
+    KeepAlivePool,
+    get_adapter_limiter,
+    get_device_lock,
+    set_connection_limit,
+)
+from miflora.miflora_deadline import BluetoothTimeoutException, Timeouts
+from miflora.miflora_poller import MI_TEMPERATURE, MiFloraPoller
+
+MACS = ["11:22:33:44:55:%02X" % i for i in range(6)]
+
+
+class CountingBackend(MockBackend):
+    """Mock backend counting the simultaneous connections per adapter."""
+
+    active = dict()
+    peak = dict()
+    counter_lock = Lock()
+
+    def connect(self, mac):
+        with self.counter_lock:
+            self.active[self.adapter] = self.active.get(self.adapter, 0) + 1
+            self.peak[self.adapter] = max(
+                self.peak.get(self.adapter, 0), self.active[self.adapter]
+            )
+        time.sleep(0.02)
+
+    def disconnect(self):
+        with self.counter_lock:
+            self.active[self.adapter] -= 1
+
+
+class HangingConnectBackend(MockBackend):
+    """Mock backend where connecting hangs until released."""
+
+    release = Event()
+
+    def connect(self, mac):
+        self.release.wait()
+
+
+class LoggingBackend(MockBackend):
+    """Mock backend logging the connections of all instances."""
+
+    events = []
+    on_history_entry = None
+
+    def connect(self, mac):
+        self.events.append(("connect", mac))
+
+    def read_handle(self, handle):
+        """Call the hook when a history entry is read."""
+        if handle == HANDLE_HISTORY_READ and self._history_control[0] == 0xA1:
+            hook = type(self).on_history_entry
+            if hook is not None:
+                hook()  # pylint: disable=not-callable
+        return super().read_handle(handle)
+
+
+class DisconnectLoggingBackend(LoggingBackend):
+    """Mock backend also logging the disconnects."""
+
+    def disconnect(self):
+        self.events.append(("disconnect", None))
+
+
+class DroppingBackend(DisconnectLoggingBackend):
+    """Mock backend whose connection can be closed by the sensor."""
+
+    def __init__(self, adapter="hci0", *, address_type):
+        super().__init__(adapter, address_type=address_type)
+        self.dropped = False
+
+    def connect(self, mac):
+        self.dropped = False
+        super().connect(mac)
+
+    def read_handle(self, handle):
+        """Fail if the sensor closed the connection."""
+        if self.dropped:
+            raise BluetoothBackendException("Device disconnected")
+        return super().read_handle(handle)
+
+
+class TestMifloraConcurrency(unittest.TestCase):
+    """Tests for the coordination of the pollers."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def setUp(self):
+        CountingBackend.active.clear()
+        CountingBackend.peak.clear()
+
+    def tearDown(self):
+        for adapter in ("hci0", "hci1", "hci7"):
+            set_connection_limit(adapter, 1)
+
+    def _poll_all(self, adapters):
+        """Read all sensors in parallel, one thread per sensor."""
+        threads = []
+        for mac, adapter in zip(MACS, adapters):
+            poller = MiFloraPoller(mac, CountingBackend, adapter=adapter)
+            poller._bt_interface._backend.temperature = 20.0
+            threads.append(
+                Thread(target=poller.parameter_value, args=(MI_TEMPERATURE,))
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_connection_limit(self):
+        """The connections on an adapter are limited, adapters work in parallel."""
+        self._poll_all(["hci0", "hci1"] * 3)
+        self.assertEqual(1, CountingBackend.peak["hci0"])
+        self.assertEqual(1, CountingBackend.peak["hci1"])
+        set_connection_limit("hci7", 2)
+        self._poll_all(["hci7"] * 6)
+        self.assertEqual(2, CountingBackend.peak["hci7"])
+
+    def test_limiter(self):
+        """Waiting for a slot is bounded and releasing a slot wakes up waiters."""
+        limiter = AdapterLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(0.01))
+        limiter.release()
+        self.assertTrue(limiter.acquire(0.01))
+        limiter.limit = 3
+        self.assertTrue(limiter.acquire(0.01))
+        self.assertEqual(3, limiter.active)
+        with self.assertRaises(ValueError):
+            AdapterLimiter(0)
+
+    def test_device_lock(self):
+        """All pollers of a sensor share one lock, whatever the case of the MAC."""
+        first = MiFloraPoller(TEST_MAC.lower(), MockBackend)
+        second = MiFloraPoller(TEST_MAC.upper(), MockBackend, adapter="hci1")
+        self.assertIs(first.lock, second.lock)
+        self.assertIsNot(first.lock, get_device_lock(MACS[0]))
+        self.assertIs(get_device_lock(None), get_device_lock(None))
+        poller = MiFloraPoller(TEST_MAC, MockBackend, timeouts=Timeouts(operation=0.05))
+        with first.lock:
+            with self.assertRaises(BluetoothTimeoutException):
+                poller.history_length()
+            with self.assertRaises(BluetoothTimeoutException):
+                poller.name()
+        self.assertFalse(first.lock.locked())
+
+    def test_slot_wait_timeout(self):
+        """Waiting for a slot of a busy adapter times out."""
+        limiter = get_adapter_limiter("hci7")
+        self.assertTrue(limiter.acquire())
+        try:
+            with self.assertRaises(BluetoothTimeoutException):
+                with AdapterConnection(
+                    BackendPool(MockBackend), TEST_MAC, limiter, 0.01
+                ):
+                    pass
+        finally:
+            limiter.release()
+
+    def test_abandoned_connect(self):
+        """A hung connect does not keep the slot of the adapter."""
+        HangingConnectBackend.release.clear()
+        poller = MiFloraPoller(
+            MACS[0],
+            HangingConnectBackend,
+            adapter="hci7",
+            timeouts=Timeouts(connect=0.05),
+        )
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.history_length()
+        self.assertEqual(0, get_adapter_limiter("hci7").active)
+        other = MiFloraPoller(MACS[1], MockBackend, adapter="hci7")
+        other._bt_interface._backend.set_version(3, 2, 1)
+        self.assertEqual("3.2.1", other.firmware_version())
+        HangingConnectBackend.release.set()
+
+    def test_priority(self):
+        """Waiting interactive work gets the next slot before background work."""
+        limiter = AdapterLimiter()
+        self.assertTrue(limiter.acquire())
+        order = []
+
+        def _wait(name, priority):
+            limiter.acquire(priority=priority)
+            order.append(name)
+            limiter.release()
+
+        background = Thread(target=_wait, args=("background", PRIORITY_BACKGROUND))
+        background.start()
+        time.sleep(0.05)
+        self.assertFalse(limiter.should_yield(PRIORITY_BACKGROUND))
+        interactive = Thread(target=_wait, args=("interactive", PRIORITY_INTERACTIVE))
+        interactive.start()
+        time.sleep(0.05)
+        self.assertTrue(limiter.should_yield(PRIORITY_BACKGROUND))
+        self.assertFalse(limiter.should_yield(PRIORITY_INTERACTIVE))
+        limiter.release()
+        background.join()
+        interactive.join()
+        self.assertEqual(["interactive", "background"], order)
+
+    def test_history_yields(self):
+        """A history transfer yields the adapter to a live read between batches."""
+        LoggingBackend.events = []
+        history = MiFloraPoller(
+            MACS[0], LoggingBackend, adapter="hci7", history_batch_size=2
+        )
+        backend = history._bt_interface._backend
+        backend.history_info = b"\x06\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+        ] * 6
+        backend.local_time = b"\xd8I\x15\x00"
+        live = MiFloraPoller(MACS[1], LoggingBackend, adapter="hci7")
+        limiter = get_adapter_limiter("hci7")
+        threads = []
+
+        def _start_live_read():
+            if not threads:
+                thread = Thread(target=live.parameter_value, args=(MI_TEMPERATURE,))
+                threads.append(thread)
+                thread.start()
+                while not limiter.should_yield(PRIORITY_BACKGROUND):
+                    time.sleep(0.001)
+
+        LoggingBackend.on_history_entry = _start_live_read
+        try:
+            self.assertEqual(6, len(history.fetch_history()))
+        finally:
+            LoggingBackend.on_history_entry = None
+        threads[0].join()
+        macs = [mac for _, mac in LoggingBackend.events]
+        self.assertEqual([MACS[0], MACS[1], MACS[1], MACS[0]], macs)
+
+    def test_keep_alive(self):
+        """Kept connections are reused without mode change and closed when idle."""
+        DisconnectLoggingBackend.events = []
+        keep_alive = KeepAlivePool(idle_timeout=0.2, max_size=1)
+        poller = MiFloraPoller(
+            MACS[0], DisconnectLoggingBackend, adapter="hci7", keep_alive=keep_alive
+        )
+        backend = poller._bt_interface._backend
+        backend.set_version(3, 2, 1)
+        backend.temperature = 20.0
+        for _ in range(3):
+            poller.parameter_value(MI_TEMPERATURE, read_cached=False)
+        self.assertEqual([("connect", MACS[0])], DisconnectLoggingBackend.events)
+        self.assertEqual(1, len(backend.written_handles))
+        self.assertEqual((3, 1), (keep_alive.hits, keep_alive.misses))
+
+        # the kept connection is closed to stay within the connection limit
+        other = MiFloraPoller(
+            MACS[1], DisconnectLoggingBackend, adapter="hci7", keep_alive=keep_alive
+        )
+        other._bt_interface._backend.name = "Flower care"
+        other.name()
+        self.assertEqual(
+            [("disconnect", None), ("connect", MACS[1])],
+            DisconnectLoggingBackend.events[1:],
+        )
+        self.assertEqual(1, len(keep_alive))
+        time.sleep(0.5)
+        self.assertEqual(0, len(keep_alive))
+        self.assertEqual(("disconnect", None), DisconnectLoggingBackend.events[-1])
+
+        poller.parameter_value(MI_TEMPERATURE, read_cached=False)
+        self.assertEqual(2, len(backend.written_handles))
+        keep_alive.clear()
+
+    def test_keep_alive_dropped(self):
+        """An operation failing on a kept connection is repeated on a new one."""
+        DroppingBackend.events = []
+        keep_alive = KeepAlivePool(idle_timeout=10)
+        poller = MiFloraPoller(
+            MACS[0], DroppingBackend, adapter="hci7", keep_alive=keep_alive
+        )
+        backend = poller._bt_interface._backend
+        backend.set_version(3, 2, 1)
+        backend.temperature = 20.0
+        poller.parameter_value(MI_TEMPERATURE, read_cached=False)
+        backend.dropped = True
+        backend.temperature = 21.0
+        self.assertAlmostEqual(
+            21.0, poller.parameter_value(MI_TEMPERATURE, read_cached=False), 1
+        )
+        self.assertEqual(
+            [("connect", MACS[0]), ("disconnect", None), ("connect", MACS[0])],
+            DroppingBackend.events,
+        )
+        # the mode change is written again on the new connection
+        self.assertEqual(2, len(backend.written_handles))
+        backend.history_info = b"\x02\x00" + bytes(14)
+        backend.dropped = True
+        self.assertEqual(2, poller.history_length())
+
+        # a failure on a new connection is not repeated
+        backend.dropped = True
+        keep_alive.clear()
+        backend.connect = lambda mac: None
+        with self.assertRaises(BluetoothBackendException):
+            poller.parameter_value(MI_TEMPERATURE, read_cached=False)
+        keep_alive.clear()
+
+    def test_keep_alive_limit(self):
+        """Kept connections count against the connection limit of the adapter."""
+        keep_alive = KeepAlivePool(idle_timeout=10, max_size=2)
+        for mac in MACS[:3]:
+            poller = MiFloraPoller(
+                mac, CountingBackend, adapter="hci7", keep_alive=keep_alive
+            )
+            poller._bt_interface._backend.name = "Flower care"
+            poller.name()
+        self.assertEqual(1, CountingBackend.peak["hci7"])
+        self.assertEqual(1, len(keep_alive))
+
+        set_connection_limit("hci7", 3)
+        for mac in MACS[:3]:
+            MiFloraPoller(
+                mac, CountingBackend, adapter="hci7", keep_alive=keep_alive
+            ).firmware_version()
+        self.assertEqual(2, len(keep_alive))
+        self.assertLessEqual(CountingBackend.peak["hci7"], 3)
+        keep_alive.clear()
+        self.assertEqual(0, CountingBackend.active["hci7"])
+
+    def test_keep_alive_pools(self):
+        """Kept connections belong to the pool of their backend instance."""
+        keep_alive = KeepAlivePool(idle_timeout=10)
+        first = BackendPool(MockBackend, "hci7")
+        second = BackendPool(MockBackend, "hci7")
+        instance = first.acquire()
+        keep_alive.put(first, MACS[0], instance, True)
+        self.assertIsNone(keep_alive.take(second, MACS[0]))
+        # the connection of the first pool was closed and returned to it
+        self.assertEqual(0, len(keep_alive))
+        self.assertIs(instance, first.acquire())
+        keep_alive.put(first, MACS[0], instance, True)
+        self.assertEqual((instance, True), keep_alive.take(first, MACS[0].lower()))
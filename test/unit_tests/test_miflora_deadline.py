@@ -0,0 +1,150 @@
+"""Tests for the miflora_deadline module."""
+
+import time
+import unittest
+from test import HANDLE_READ_SENSOR_DATA, TEST_MAC
+from test.helper import MockBackend
+from threading import Event, Timer
+
+from miflora.miflora_deadline import (
+    BluetoothTimeoutException,
+    Deadline,
+    Timeouts,
+    call_with_timeout,
+)
+from miflora.miflora_poller import MI_TEMPERATURE, MiFloraPoller
+
+
+class HangingBackend(MockBackend):
+    """Mock backend where reading the sensor data hangs until released."""
+
+    release = Event()
+
+    def read_handle(self, handle):
+        """Hang when reading the sensor data."""
+        if handle == HANDLE_READ_SENSOR_DATA:
+            self.release.wait()
+        return super().read_handle(handle)
+
+
+class HangingBatchBackend(MockBackend):
+    """Mock backend with a batch generator that hangs after the first entries."""
+
+    release = Event()
+    hang_at = 1
+
+    def write_read_batch(self, write_handle, read_handle, values):
+        """Yield the first responses, then hang until released."""
+        for index, value in enumerate(values):
+            if index == self.hang_at:
+                self.release.wait()
+            self.write_handle(write_handle, value)
+            yield self.read_handle(read_handle)
+
+
+class TestMifloraDeadline(unittest.TestCase):
+    """Tests for deadlines of Bluetooth operations."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def test_call_with_timeout(self):
+        """Slow calls raise a timeout, the cleanup is called later."""
+        self.assertEqual(3, call_with_timeout(sum, ([1, 2],), timeout=1))
+        with self.assertRaises(ValueError):
+            call_with_timeout(int, ("x",), timeout=1)
+        cleaned_up = Event()
+        with self.assertRaises(BluetoothTimeoutException):
+            call_with_timeout(time.sleep, (0.2,), timeout=0.01, cleanup=cleaned_up.set)
+        self.assertTrue(cleaned_up.wait(1))
+
+    def test_deadline(self):
+        """The remaining time shrinks and cancelling stops the operation."""
+        deadline = Deadline(10)
+        self.assertLessEqual(deadline.timeout(20), 10)
+        self.assertEqual(1, deadline.timeout(1))
+        self.assertIsNone(Deadline().timeout())
+        deadline.cancel()
+        with self.assertRaises(BluetoothTimeoutException):
+            deadline.timeout()
+        with self.assertRaises(BluetoothTimeoutException):
+            Deadline(0).timeout()
+
+    def test_hanging_read(self):
+        """A hanging read returns a timeout and the connection is closed later."""
+        HangingBackend.release.clear()
+        poller = MiFloraPoller(TEST_MAC, HangingBackend, timeouts=Timeouts(io=0.1))
+        start = time.time()
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.parameter_value(MI_TEMPERATURE)
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(poller.lock.locked())
+        HangingBackend.release.set()
+        # other sensors can be read once the abandoned call finished
+        other = MiFloraPoller(TEST_MAC, MockBackend, timeouts=Timeouts(connect=1))
+        other._bt_interface._backend.temperature = 12.3
+        self.assertAlmostEqual(12.3, other.parameter_value(MI_TEMPERATURE), delta=0.01)
+
+    def test_lock_timeout(self):
+        """Waiting for the lock of the poller is bounded by the operation timeout."""
+        poller = MiFloraPoller(TEST_MAC, MockBackend, timeouts=Timeouts(operation=0.1))
+        with poller.lock:
+            with self.assertRaises(BluetoothTimeoutException):
+                poller.parameter_value(MI_TEMPERATURE)
+
+    def test_cancel(self):
+        """A caller supplied deadline bounds and cancels an operation."""
+        poller = MiFloraPoller(TEST_MAC, MockBackend)
+        poller._bt_interface._backend.set_version(3, 2, 1)
+        self.assertEqual("3.2.1", poller.firmware_version(deadline=Deadline(1)))
+        deadline = Deadline()
+        deadline.cancel()
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.parameter_value(MI_TEMPERATURE, deadline=deadline)
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.history_length(deadline=deadline)
+
+        HangingBackend.release.clear()
+        poller = MiFloraPoller(TEST_MAC, HangingBackend)
+        deadline = Deadline()
+        timer = Timer(0.05, deadline.cancel)
+        timer.start()
+        start = time.time()
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.parameter_value(MI_TEMPERATURE, deadline=deadline)
+        self.assertLess(time.time() - start, 1)
+        HangingBackend.release.set()
+        timer.join()
+
+    def test_hanging_batch(self):
+        """Every entry of a batch generator gets the deadline."""
+        HangingBatchBackend.release.clear()
+        poller = MiFloraPoller(TEST_MAC, HangingBatchBackend, timeouts=Timeouts(io=0.1))
+        backend = poller._bt_interface._backend
+        backend.history_info = b"\x02\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+        ] * 2
+        start = time.time()
+        with self.assertRaises(BluetoothTimeoutException):
+            poller.fetch_history()
+        self.assertLess(time.time() - start, 1)
+        HangingBatchBackend.release.set()
+
+    def test_history_timeout(self):
+        """A timeout within the history is raised instead of a shorter history."""
+        HangingBatchBackend.release.clear()
+        poller = MiFloraPoller(TEST_MAC, HangingBatchBackend, timeouts=Timeouts(io=0.1))
+        backend = poller._bt_interface._backend
+        backend.hang_at = 3
+        backend.history_info = b"\x06\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+        ] * 6
+        stored = []
+        # the clock is not synced, the error is not hidden by reading the time
+        with self.assertRaisesRegex(BluetoothTimeoutException, "timed out after"):
+            poller.fetch_and_clear_history(stored.extend)
+        HangingBatchBackend.release.set()
+        self.assertEqual([], stored)
+        self.assertEqual(6, len(backend.history_data))
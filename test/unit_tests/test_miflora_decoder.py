@@ -0,0 +1,99 @@
+"""Tests for the miflora_decoder module."""
+
+import unittest
+
+from miflora.miflora_decoder import (
+    ADVERTISEMENT_DATA,
+    HISTORY_DATA,
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    MODEL_FLOWER_CARE,
+    MODEL_ROPOT,
+    SENSOR_DATA,
+    PayloadDecoder,
+    decode,
+    decode_mibeacon,
+    get_decoder,
+    register_decoder,
+)
+
+
+class TestMifloraDecoder(unittest.TestCase):
+    """Tests for the decoder registry."""
+
+    def test_sensor_data(self):
+        """Decode live data of a Flower Care."""
+        data = bytes(
+            b"\x25\x01\x00\xf7\x26\x00\x00\x28\x0e\x01\x00\x00\x00\x00\x00\x00"
+        )
+        res = decode(SENSOR_DATA, data)
+        self.assertEqual(29.3, res[MI_TEMPERATURE])
+        self.assertEqual(9975, res[MI_LIGHT])
+        self.assertEqual(40, res[MI_MOISTURE])
+        self.assertEqual(270, res[MI_CONDUCTIVITY])
+        self.assertEqual(MODEL_FLOWER_CARE, get_decoder(SENSOR_DATA, 16).model)
+
+    def test_ropot(self):
+        """Decode live data of a Ropot, which has no light sensor."""
+        data = bytes(b"\xc8\x00\x00\x00\x00\x00\x00\x05\x1e\x00" + bytes(14))
+        res = decode(SENSOR_DATA, data)
+        self.assertEqual(20.0, res[MI_TEMPERATURE])
+        self.assertEqual(5, res[MI_MOISTURE])
+        self.assertEqual(30, res[MI_CONDUCTIVITY])
+        self.assertIs(False, res[MI_LIGHT])
+        self.assertEqual(MODEL_ROPOT, get_decoder(SENSOR_DATA, 24).model)
+
+    def test_memoryview(self):
+        """Decode entries from a memoryview of a larger buffer."""
+        entries = bytes(
+            b"\x30\x42\x15\x00\xc1\x00\x00\x10\x27\x01\x00\x1e\x87\x02\x00\x00"
+            b"\x20\x34\x15\x00\xf5\xff\x00\x00\x00\x00\x00\x1f\x8c\x02\x00\x00"
+        )
+        view = memoryview(entries)
+        decoder = get_decoder(HISTORY_DATA, 16)
+        first = decoder.decode(view)
+        self.assertEqual(1393200, first["device_time"])
+        self.assertEqual(19.3, first[MI_TEMPERATURE])
+        self.assertEqual(75536, first[MI_LIGHT])
+        self.assertEqual(30, first[MI_MOISTURE])
+        self.assertEqual(647, first[MI_CONDUCTIVITY])
+        second = decoder.decode(view, 16)
+        self.assertEqual(1.0, second[MI_TEMPERATURE])
+        self.assertEqual(31, second[MI_MOISTURE])
+
+    def test_register_new_model(self):
+        """A new model can be added without changing the poller."""
+        register_decoder(
+            SENSOR_DATA,
+            4,
+            PayloadDecoder("test model", "<hBB", (MI_TEMPERATURE, MI_MOISTURE, "x")),
+        )
+        self.assertEqual(12, decode(SENSOR_DATA, b"\x01\x00\x0c\x00")[MI_MOISTURE])
+        with self.assertRaises(KeyError):
+            decode(SENSOR_DATA, b"\x01\x00\x0c")
+
+    def test_mibeacon(self):
+        """Decode MiBeacon advertisements."""
+        # frame control with mac and object, product id 0x0098, counter 0x67
+        header = b"\x71\x20\x98\x00\x67\x66\x55\x44\x33\x22\x11\x0d"
+        res = decode_mibeacon(header + b"\x04\x10\x02\xd5\x00")
+        self.assertEqual(MODEL_FLOWER_CARE, res["model"])
+        self.assertEqual("11:22:33:44:55:66", res["mac"])
+        self.assertEqual(0x67, res["frame_counter"])
+        self.assertEqual(21.3, res[MI_TEMPERATURE])
+        res = decode_mibeacon(header + b"\x07\x10\x03\xa0\x86\x01")
+        self.assertEqual(100000, res[MI_LIGHT])
+        res = decode_mibeacon(header + b"\x0a\x10\x01\x5f")
+        self.assertEqual(95, res[MI_BATTERY])
+        self.assertIsNone(decode_mibeacon(header + b"\xff\xff\x01\x00"))
+        # encrypted frames can not be decoded
+        self.assertIsNone(decode_mibeacon(b"\x79\x20\x98\x00\x67\x01\x02\x03"))
+
+    def test_advertisement_registry(self):
+        """Advertisement objects are registered by their type."""
+        self.assertEqual(
+            {MI_MOISTURE: 42}, decode(ADVERTISEMENT_DATA, b"\x2a", key=0x1008)
+        )
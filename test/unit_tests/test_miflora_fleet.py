@@ -0,0 +1,77 @@
+"""Tests for the miflora_fleet module."""
+
+import unittest
+from test.helper import MockBackend
+
+from miflora.miflora_decoder import MI_BATTERY, MI_TEMPERATURE
+from miflora.miflora_fleet import FleetEngine, clear_pollers, get_poller
+from miflora.miflora_state import SensorState
+
+MACS = ["11:22:33:44:55:%02X" % i for i in range(3)]
+
+
+class CreatingBackend(MockBackend):
+    """Mock backend counting its instances."""
+
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        type(self).instances += 1
+        self.set_version(3, 2, 1)
+        self.temperature = 21.5
+        self.battery_level = 80
+
+
+class TestFleet(unittest.TestCase):
+    """Tests for the FleetEngine class."""
+
+    # pylint: disable = protected-access
+
+    def setUp(self):
+        CreatingBackend.instances = 0
+        clear_pollers()
+
+    def test_shared_state(self):
+        """Pollers of the same sensor are views on one record."""
+        engine = FleetEngine(CreatingBackend)
+        engine.poller(MACS[0]).parameter_value(MI_TEMPERATURE)
+        poller = engine.poller(MACS[0].lower())
+        self.assertIsNotNone(poller._cache)
+        self.assertEqual(len(engine.state), 1)
+        self.assertEqual("3.2.1", poller.firmware_version())
+
+    def test_backend_pool(self):
+        """The sensors of an adapter share the backend instances."""
+        engine = FleetEngine(CreatingBackend)
+        for mac in MACS:
+            engine.refresh(mac)
+        self.assertEqual(CreatingBackend.instances, 1)
+        engine.refresh("AA:22:33:44:55:66", adapter="hci1")
+        self.assertEqual(CreatingBackend.instances, 2)
+
+    def test_readings(self):
+        """The readings are decoded from the table."""
+        engine = FleetEngine(CreatingBackend)
+        self.assertIsNone(engine.reading(MACS[0]))
+        for mac in MACS[:2]:
+            engine.refresh(mac)
+        readings = engine.readings()
+        self.assertEqual(sorted(readings), MACS[:2])
+        self.assertEqual(readings[MACS[0]][MI_TEMPERATURE], 21.5)
+        self.assertEqual(readings[MACS[0]][MI_BATTERY], 80)
+
+    def test_compact_state(self):
+        """The records of the sensors have no instance dictionary."""
+        self.assertFalse(hasattr(SensorState(MACS[0]), "__dict__"))
+
+    def test_shared_poller(self):
+        """Users of the same sensor and adapter share one poller and its cache."""
+        first = get_poller(MACS[0], CreatingBackend)
+        self.assertIs(get_poller(MACS[0].lower(), CreatingBackend), first)
+        self.assertIsNot(get_poller(MACS[0], CreatingBackend, adapter="hci1"), first)
+        first.parameter_value(MI_TEMPERATURE)
+        self.assertEqual(get_poller(MACS[0], CreatingBackend).battery, 80)
+        reads = len(first._bt_interface._backend.written_handles)
+        get_poller(MACS[0], CreatingBackend).parameter_value(MI_TEMPERATURE)
+        self.assertEqual(len(first._bt_interface._backend.written_handles), reads)
@@ -0,0 +1,65 @@
+"""Tests for the miflora_gatttool module."""
+
+import functools
+import os
+import sys
+import unittest
+from test import TEST_MAC
+
+from btlewrap.base import BluetoothBackendException
+
+from miflora.miflora_gatttool import InteractiveGatttoolBackend
+from miflora.miflora_poller import MI_MOISTURE, MI_TEMPERATURE, MiFloraPoller
+
+FAKE_GATTTOOL = [
+    sys.executable,
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "fake_gatttool.py"),
+]
+
+
+class CountingGatttoolBackend(InteractiveGatttoolBackend):
+    """Backend counting the gatttool sessions."""
+
+    sessions = 0
+
+    def connect(self, mac):
+        type(self).sessions += 1
+        super().connect(mac)
+
+
+class TestInteractiveGatttool(unittest.TestCase):
+    """Tests for the InteractiveGatttoolBackend class."""
+
+    def setUp(self):
+        CountingGatttoolBackend.sessions = 0
+
+    def test_poll(self):
+        """Read the sensor and its history over interactive sessions."""
+        backend = functools.partial(
+            CountingGatttoolBackend, command=FAKE_GATTTOOL, timeout=5
+        )
+        poller = MiFloraPoller(TEST_MAC, backend)
+        self.assertEqual(poller.firmware_version(), "3.2.1")
+        self.assertEqual(poller.parameter_value(MI_TEMPERATURE), 21.5)
+        self.assertEqual(poller.parameter_value(MI_MOISTURE), 42)
+        history = poller.fetch_history()
+        self.assertEqual([entry.conductivity for entry in history], [647, 652])
+        # one session per connection, not per command
+        self.assertEqual(CountingGatttoolBackend.sessions, 3)
+
+    def test_errors(self):
+        """Failing commands raise and keep the session usable."""
+        backend = InteractiveGatttoolBackend(command=FAKE_GATTTOOL, timeout=5)
+        with self.assertRaises(BluetoothBackendException):
+            backend.read_handle(0x35)
+        backend.connect(TEST_MAC)
+        try:
+            with self.assertRaises(BluetoothBackendException):
+                backend.read_handle(0x99)
+            batch = backend.write_read_batch(0x3E, 0x99, [b"\xa1\x00\x00"] * 3)
+            with self.assertRaises(BluetoothBackendException):
+                list(batch)
+            self.assertEqual(backend.read_handle(0x03), b"Flower care")
+        finally:
+            backend.disconnect()
+        self.assertFalse(backend.is_connected())
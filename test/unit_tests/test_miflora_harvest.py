@@ -0,0 +1,120 @@
+"""Tests for the miflora_harvest module."""
+
+import time
+import unittest
+from test import CMD_HISTORY_READ_SUCCESS
+from test.helper import MockBackend
+
+from miflora.miflora_harvest import HistoryHarvester
+
+HISTORY_ENTRY = b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+
+
+class FleetBackend(MockBackend):
+    """Mock backend with a different history for every MAC."""
+
+    histories = dict()
+
+    def __init__(self, adapter="hci0", *, address_type):
+        super().__init__(adapter, address_type=address_type)
+        self.mac = None
+
+    def connect(self, mac):
+        """Select the history of the sensor."""
+        length = self.histories[mac]
+        self.history_info = length.to_bytes(2, "little") + bytes(14)
+        self.history_data = [HISTORY_ENTRY] * length
+        self.local_time = b"\xd8I\x15\x00"
+        self.mac = mac
+
+    def write_handle(self, handle, value):
+        """Remember when the history was cleared."""
+        if value == CMD_HISTORY_READ_SUCCESS:
+            self.histories[self.mac] = 0
+        return super().write_handle(handle, value)
+
+
+class TestMifloraHarvest(unittest.TestCase):
+    """Tests for the HistoryHarvester."""
+
+    MACS = ["11:22:33:44:55:01", "11:22:33:44:55:02", "11:22:33:44:55:03"]
+
+    def setUp(self):
+        """Create a fleet with histories of different lengths."""
+        FleetBackend.histories = dict(zip(self.MACS, [2, 10, 5]))
+
+    def test_rank(self):
+        """Sensors with more pending entries come first."""
+        harvester = HistoryHarvester(self.MACS, FleetBackend)
+        lengths = dict(FleetBackend.histories)
+        self.assertEqual(
+            [self.MACS[1], self.MACS[2], self.MACS[0]], harvester.rank(lengths)
+        )
+        harvester.harvested_length[self.MACS[1]] = 9
+        self.assertEqual(1, harvester.pending_entries(self.MACS[1], 10))
+        self.assertEqual(3, harvester.pending_entries(self.MACS[1], 3))
+        self.assertEqual(self.MACS[1], harvester.rank(lengths)[-1])
+
+    def test_harvest(self):
+        """All histories are harvested with enough budget and only new data again."""
+        harvested = []
+        harvester = HistoryHarvester(
+            self.MACS,
+            FleetBackend,
+            adapters=["hci0", "hci1"],
+            sink=lambda mac, entries: harvested.append((mac, len(entries))),
+        )
+        results = harvester.harvest()
+        self.assertEqual({2, 10, 5}, {len(entries) for entries in results.values()})
+        self.assertEqual(3, len(harvested))
+        FleetBackend.histories[self.MACS[0]] = 3
+        self.assertEqual([self.MACS[0]], list(harvester.harvest()))
+
+    def test_full_buffer(self):
+        """A full buffer does not grow, but is harvested again as time passes."""
+        harvester = HistoryHarvester(self.MACS, FleetBackend)
+        harvester.harvest()
+        self.assertEqual(0, harvester.pending_entries(self.MACS[1], 10))
+        harvester.last_harvest[self.MACS[1]] = time.time() - 5 * 3600
+        self.assertEqual(5, harvester.pending_entries(self.MACS[1], 10))
+        harvester.last_harvest[self.MACS[0]] = time.time() - 50 * 3600
+        self.assertEqual(2, harvester.pending_entries(self.MACS[0], 2))
+        self.assertEqual({self.MACS[0], self.MACS[1]}, set(harvester.harvest()))
+
+    def test_failing_sink(self):
+        """An exception of the sink does not end the round."""
+        harvested = []
+
+        def _sink(mac, _entries):
+            if mac == self.MACS[1]:
+                raise OSError("disk full")
+            harvested.append(mac)
+
+        harvester = HistoryHarvester(self.MACS, FleetBackend, sink=_sink)
+        harvester.harvest()
+        self.assertEqual({self.MACS[0], self.MACS[2]}, set(harvested))
+        self.assertNotIn(self.MACS[1], harvester.harvested_length)
+
+    def test_harvest_and_clear(self):
+        """Histories are cleared after the harvest."""
+        harvested = []
+        harvester = HistoryHarvester(
+            self.MACS,
+            FleetBackend,
+            sink=lambda mac, entries: harvested.append((mac, len(entries))),
+            clear=True,
+        )
+        self.assertEqual(3, len(harvester.harvest()))
+        self.assertEqual(3, len(harvested))
+        self.assertEqual(0, harvester.harvested_length[self.MACS[0]])
+        with self.assertRaises(ValueError):
+            HistoryHarvester(self.MACS, FleetBackend, clear=True)
+
+    def test_budget(self):
+        """Histories that do not fit into the budget are left for the next round."""
+        harvester = HistoryHarvester(
+            self.MACS, FleetBackend, airtime_budget=4.0, seconds_per_entry=0.5
+        )
+        results = harvester.harvest()
+        self.assertEqual({self.MACS[0], self.MACS[2]}, set(results))
+        self.assertLessEqual(harvester.airtime_used, 4.0)
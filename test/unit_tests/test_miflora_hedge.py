@@ -0,0 +1,96 @@
+"""Tests for the miflora_hedge module."""
+
+import time
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from btlewrap.base import BluetoothBackendException
+
+from miflora.miflora_hedge import Hedging
+from miflora.miflora_metadata import BATTERY, FIRMWARE, DeviceMetadataStore
+from miflora.miflora_poller import MI_TEMPERATURE, MiFloraPoller
+
+
+class SlowAdapterBackend(MockBackend):
+    """Mock backend where connecting is slow on one adapter."""
+
+    slow_adapter = "hedge0"
+    connects = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature = 21.5
+
+    def connect(self, mac):
+        self.connects.append(self.adapter)
+        if self.adapter == self.slow_adapter:
+            time.sleep(0.5)
+
+
+class TestHedging(unittest.TestCase):
+    """Tests for the Hedging class."""
+
+    def setUp(self):
+        SlowAdapterBackend.connects = []
+
+    def test_delay(self):
+        """The hedge delay is a percentile of the recent latencies."""
+        hedging = Hedging("hci1", percentile=90, min_samples=5)
+        self.assertIsNone(hedging.delay())
+        for latency in range(1, 11):
+            hedging.record(latency / 10)
+        self.assertEqual(hedging.delay(), 1.0)
+        hedging.percentile = 50
+        self.assertEqual(hedging.delay(), 0.6)
+        with self.assertRaises(ValueError):
+            Hedging("hci1", percentile=0)
+
+    def test_fast_read(self):
+        """Reads faster than the delay are not hedged."""
+        hedging = Hedging("hci1", min_samples=1)
+        hedging.record(1.0)
+        self.assertEqual(hedging.call(lambda d: 1, lambda d: 2), 1)
+        self.assertEqual(hedging.stats.reads, 1)
+        self.assertEqual(hedging.stats.hedged, 0)
+
+    def test_failing_primary(self):
+        """A failing primary read is hedged right away."""
+        hedging = Hedging("hci1", min_samples=1)
+        hedging.record(10.0)
+
+        def _fail(_):
+            raise BluetoothBackendException("primary failed")
+
+        start = time.monotonic()
+        self.assertEqual(hedging.call(_fail, lambda d: 2), 2)
+        self.assertLess(time.monotonic() - start, 5.0)
+        self.assertEqual(hedging.stats.hedge_wins, 1)
+        with self.assertRaises(BluetoothBackendException):
+            hedging.call(_fail, _fail)
+
+    def test_hedged_poller(self):
+        """A slow connect on the primary adapter is overtaken by the hedge."""
+        hedging = Hedging("hedge1", min_samples=3)
+        for _ in range(3):
+            hedging.record(0.05)
+        metadata = DeviceMetadataStore()
+        metadata.set(TEST_MAC, FIRMWARE, "3.2.1")
+        metadata.set(TEST_MAC, BATTERY, 80)
+        poller = MiFloraPoller(
+            TEST_MAC,
+            SlowAdapterBackend,
+            adapter="hedge0",
+            metadata=metadata,
+            hedge=hedging,
+        )
+        start = time.monotonic()
+        self.assertEqual(poller.parameter_value(MI_TEMPERATURE), 21.5)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(SlowAdapterBackend.connects, ["hedge0", "hedge1"])
+        self.assertEqual(hedging.stats.hedged, 1)
+        self.assertEqual(hedging.stats.hedge_wins, 1)
+        # the cancelled read is accounted as wasted airtime
+        time.sleep(0.2)
+        self.assertGreater(hedging.stats.wasted_airtime, 0.0)
+        self.assertGreater(hedging.stats.overhead, 0.0)
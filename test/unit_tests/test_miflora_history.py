@@ -0,0 +1,99 @@
+"""Tests for the miflora_history module."""
+
+import importlib.util
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from miflora.miflora_history import HistoryData, concat_arrow
+from miflora.miflora_poller import (
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    MiFloraPoller,
+)
+
+HAS_EXPORT = all(
+    importlib.util.find_spec(module) is not None
+    for module in ("numpy", "pandas", "pyarrow")
+)
+
+
+class TestHistory(unittest.TestCase):
+    """Tests for the HistoryData class."""
+
+    # pylint: disable = protected-access
+
+    def _fetch_history(self):
+        """Fetch a history with a negative temperature and a bright entry."""
+        poller = MiFloraPoller(TEST_MAC, MockBackend)
+        backend = poller._bt_interface._backend
+        backend.history_info = b"\x02\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00",
+            b"\x20\x34\x15\x00\xf0\xff\x00\x10\x27\x01\x00\x1f\x8c\x02\x00\x00",
+        ]
+        backend.local_time = b"\xd8I\x15\x00"
+        return poller.fetch_history()
+
+    def test_buffers(self):
+        """The raw entries and wall times are kept next to the entries."""
+        history = self._fetch_history()
+        self.assertIsInstance(history, HistoryData)
+        self.assertEqual(len(history.raw), 32)
+        for wall_time, entry in zip(history.wall_times, history):
+            self.assertAlmostEqual(wall_time, entry.wall_time.timestamp(), places=5)
+        combined = HistoryData()
+        combined.extend(history)
+        combined.extend(history)
+        self.assertEqual(len(combined), 4)
+        self.assertEqual(combined.raw, history.raw * 2)
+
+    def test_list_changes(self):
+        """The buffers follow every change of the list."""
+        history = self._fetch_history()
+        first, second = history.raw[:16], history.raw[16:]
+        combined = HistoryData(list(history))
+        self.assertEqual(combined.raw, history.raw)
+        combined += [history[0]]
+        self.assertEqual(combined.raw, first + second + first)
+        combined.sort(key=lambda entry: entry.device_time)
+        self.assertEqual(combined.raw, second + first + first)
+        del combined[1]
+        combined.insert(0, history[0])
+        combined.append(history[1])
+        self.assertEqual(combined.raw, first + second + first + second)
+        combined.extend(history)
+        self.assertEqual(combined.raw, (first + second) * 3)
+        self.assertEqual(len(combined.wall_times), 6)
+        for wall_time, entry in zip(combined.wall_times, combined):
+            self.assertAlmostEqual(wall_time, entry.wall_time.timestamp(), places=5)
+        combined.add(history[0], first)
+        combined._check()
+
+    @unittest.skipIf(HAS_EXPORT, "numpy, pandas and pyarrow are installed")
+    def test_missing_dependencies(self):
+        """A missing optional dependency is reported with a hint."""
+        with self.assertRaisesRegex(ImportError, "miflora\\[export\\]"):
+            self._fetch_history().to_numpy()
+
+    @unittest.skipUnless(HAS_EXPORT, "numpy, pandas and pyarrow are needed")
+    def test_export(self):
+        """The columns match the decoded entries."""
+        history = self._fetch_history()
+        columns = history.to_numpy()
+        for name in (MI_TEMPERATURE, MI_LIGHT, MI_MOISTURE, MI_CONDUCTIVITY):
+            self.assertEqual(
+                list(columns[name]), [getattr(entry, name) for entry in history]
+            )
+        frame = history.to_pandas(TEST_MAC)
+        self.assertEqual(list(frame[MI_LIGHT]), [0, 75536])
+        self.assertEqual(list(frame["mac"]), [TEST_MAC] * 2)
+        table = concat_arrow({TEST_MAC: history, "AA:BB:CC:DD:EE:FF": history})
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(
+            table.column("mac").to_pylist(), [TEST_MAC] * 2 + ["AA:BB:CC:DD:EE:FF"] * 2
+        )
+        history.reverse()
+        self.assertEqual(list(history.to_numpy()[MI_LIGHT]), [75536, 0])
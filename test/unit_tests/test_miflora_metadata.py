@@ -0,0 +1,81 @@
+"""Tests for the miflora_metadata module."""
+
+import os
+import tempfile
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from miflora.miflora_metadata import (
+    BATTERY,
+    FIRMWARE,
+    MODEL,
+    DeviceMetadataStore,
+    parse_firmware_version,
+)
+from miflora.miflora_poller import MiFloraPoller
+
+
+class TestMifloraMetadata(unittest.TestCase):
+    """Tests for the DeviceMetadataStore."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def test_parse_firmware_version(self):
+        """Firmware versions are compared as tuples."""
+        self.assertEqual((2, 6, 6), parse_firmware_version("2.6.6"))
+        self.assertEqual((3, 2, 1), parse_firmware_version("3.2.1\x00"))
+        self.assertIsNone(parse_firmware_version(None))
+        self.assertGreater(parse_firmware_version("2.10.0"), (2, 6, 6))
+
+    def test_ttl(self):
+        """Values expire after their time to live."""
+        store = DeviceMetadataStore(ttls={BATTERY: 10})
+        store.set(TEST_MAC, BATTERY, 90, now=100)
+        store.set(TEST_MAC, MODEL, "Flower Care", now=100)
+        self.assertEqual(90, store.get(TEST_MAC.lower(), BATTERY, now=105))
+        self.assertIsNone(store.get(TEST_MAC, BATTERY, now=111))
+        self.assertEqual("Flower Care", store.get(TEST_MAC, MODEL, now=10**9))
+        store.invalidate(TEST_MAC, MODEL)
+        self.assertIsNone(store.get(TEST_MAC, MODEL))
+
+    def test_persistence(self):
+        """The store survives a restart."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metadata.json")
+            DeviceMetadataStore(path).set(TEST_MAC, FIRMWARE, "3.2.1")
+            self.assertEqual("3.2.1", DeviceMetadataStore(path).get(TEST_MAC, FIRMWARE))
+
+    def test_storage_errors(self):
+        """Unwritable and invalid files do not raise, the values stay in memory."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = DeviceMetadataStore(os.path.join(tmp_dir, "missing", "m.json"))
+            store.set(TEST_MAC, FIRMWARE, "3.2.1")
+            self.assertEqual("3.2.1", store.get(TEST_MAC, FIRMWARE))
+            path = os.path.join(tmp_dir, "metadata.json")
+            for content in ("[1, 2]", '{"version": 1, "devices": [1]}'):
+                with open(path, "w") as metadata_file:
+                    metadata_file.write(content)
+                self.assertIsNone(DeviceMetadataStore(path).get(TEST_MAC, FIRMWARE))
+
+    def test_poller_uses_store(self):
+        """A new poller does not read static values again."""
+        store = DeviceMetadataStore()
+        poller = MiFloraPoller(TEST_MAC, MockBackend, metadata=store)
+        backend = poller._bt_interface._backend
+        backend.set_version(3, 2, 1)
+        backend.battery_level = 77
+        backend.name = "Flower care"
+        self.assertEqual("3.2.1", poller.firmware_version())
+        self.assertEqual("Flower care", poller.name())
+        self.assertEqual("Flower Care", poller.model())
+
+        poller = MiFloraPoller(TEST_MAC, MockBackend, metadata=store)
+        backend = poller._bt_interface._backend
+        backend.handle_0x38_raw = None
+        backend.handle_0x03_raw = None
+        self.assertEqual("3.2.1", poller.firmware_version())
+        self.assertEqual(77, poller.battery_level())
+        self.assertEqual("Flower care", poller.name())
+        self.assertEqual((3, 2, 1), poller._firmware)
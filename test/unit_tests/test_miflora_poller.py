@@ -115,6 +115,34 @@ class TestMifloraPoller(unittest.TestCase):
         with self.assertRaises(BluetoothBackendException):
             poller.parameter_value(MI_TEMPERATURE)
 
+    def test_invalid_data_retry(self):
+        """Check that invalid data is read again within the connection."""
+        poller = MiFloraPoller(self.TEST_MAC, MockBackend)
+        backend = self._get_backend(poller)
+
+        backend.set_version(2, 7, 6)
+        backend.temperature = 21.5
+        connections = []
+        backend.connect = connections.append
+        read_sensor_data = backend._read_sensor_data
+        responses = [INVALID_DATA]
+        backend._read_sensor_data = lambda: (
+            responses.pop() if responses else read_sensor_data()
+        )
+
+        self.assertAlmostEqual(21.5, poller.parameter_value(MI_TEMPERATURE))
+        # one connection for the firmware and one for the sensor data
+        self.assertEqual(2, len(connections))
+        self.assertEqual(
+            [HANDLE_WRITE_MODE_CHANGE] * 2, [h for h, _ in backend.written_handles]
+        )
+
+        poller.data_retries = 0
+        poller.clear_cache()
+        responses.append(INVALID_DATA)
+        with self.assertRaises(BluetoothBackendException):
+            poller.parameter_value(MI_TEMPERATURE)
+
     def test_name(self):
         """Check reading of the sensor name."""
         poller = MiFloraPoller(self.TEST_MAC, MockBackend)
@@ -263,3 +291,82 @@ class TestMifloraPoller(unittest.TestCase):
     def _get_backend(poller):
         """Get the backend from a MiFloraPoller object."""
         return poller._bt_interface._backend
+
+
+class TestMifloraPollerHistory(unittest.TestCase):
+    """Tests for fetching and clearing the history with the MiFloraPoller."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    TEST_MAC = "11:22:33:44:55:66"
+
+    def test_fetch_and_clear_history(self):
+        """The history is cleared after the sink stored it."""
+        poller = MiFloraPoller(self.TEST_MAC, MockBackend)
+        backend = self._get_backend(poller)
+        backend.history_info = b"\x02\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x87\x02\x00\x00",
+            b"\x20\x34\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x8C\x02\x00\x00",
+        ]
+        backend.local_time = b"\xd8I\x15\x00"
+        stored = []
+        history = poller.fetch_and_clear_history(stored.extend)
+        self.assertEqual(2, len(history))
+        self.assertEqual(history, stored)
+        self.assertEqual(0, poller.history_length())
+
+    def test_fetch_and_clear_history_incomplete(self):
+        """The history is not cleared if entries are missing or the sink fails."""
+        poller = MiFloraPoller(self.TEST_MAC, MockBackend)
+        backend = self._get_backend(poller)
+        backend.history_info = b"\x03\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x87\x02\x00\x00",
+            b"\x20\x34\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x8C\x02\x00\x00",
+        ]
+        backend.local_time = b"\xd8I\x15\x00"
+        stored = []
+        with self.assertRaises(BluetoothBackendException):
+            poller.fetch_and_clear_history(stored.extend)
+        self.assertEqual(2, len(stored))
+        self.assertEqual(3, poller.history_length())
+
+        backend.history_info = b"\x02\x00" + bytes(14)
+
+        def _failing_sink(_):
+            raise IOError("disk full")
+
+        with self.assertRaises(IOError):
+            poller.fetch_and_clear_history(_failing_sink)
+        self.assertEqual(2, poller.history_length())
+
+    def test_fetch_and_clear_history_new_entry(self):
+        """An entry written during the transfer is read before clearing."""
+        poller = MiFloraPoller(self.TEST_MAC, MockBackend)
+        backend = self._get_backend(poller)
+        backend.history_info = b"\x02\x00" + bytes(14)
+        backend.history_data = [
+            b"\x30\x42\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x87\x02\x00\x00",
+            b"\x20\x34\x15\x00\xC1\x00\x00\x00\x00\x00\x00\x1E\x8C\x02\x00\x00",
+        ]
+        backend.local_time = b"\xd8I\x15\x00"
+        batches = []
+
+        def _sink(entries):
+            if not batches:
+                # the sensor writes a new entry
+                backend.history_info = b"\x03\x00" + bytes(14)
+                backend.history_data.append(backend.history_data[0])
+            batches.append(len(entries))
+
+        history = poller.fetch_and_clear_history(_sink)
+        self.assertEqual([2, 1], batches)
+        self.assertEqual(3, len(history))
+        self.assertEqual(0, poller.history_length())
+
+    @staticmethod
+    def _get_backend(poller):
+        """Get the backend from a MiFloraPoller object."""
+        return poller._bt_interface._backend
@@ -0,0 +1,56 @@
+"""Tests for the miflora_recent module."""
+
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from miflora.miflora_poller import MI_LIGHT, MI_MOISTURE, MI_TEMPERATURE, MiFloraPoller
+from miflora.miflora_recent import ReadingBuffer, WindowStats
+
+
+class TestRecent(unittest.TestCase):
+    """Tests for the ReadingBuffer and WindowStats classes."""
+
+    def test_window(self):
+        """Statistics only cover the values in the window."""
+        stats = WindowStats(window=7200, capacity=100, origin=0)
+        for step, value in enumerate([5, 1, 4, 3, 2]):
+            stats.add(step * 1800, value)
+        self.assertEqual((stats.minimum, stats.maximum), (1, 5))
+        self.assertEqual(stats.mean, 3)
+        self.assertEqual(stats.last_change, (7200, -1))
+        # the window ending at 2.5 h starts at 0.5 h
+        stats.expire(9000)
+        self.assertEqual(len(stats), 4)
+        self.assertEqual((stats.minimum, stats.maximum), (1, 4))
+        self.assertEqual(stats.mean, 2.5)
+        self.assertAlmostEqual(stats.trend, 0.4)
+        stats.expire(100000)
+        self.assertEqual(len(stats), 0)
+        self.assertIsNone(stats.minimum)
+        self.assertIsNone(stats.mean)
+        self.assertIsNone(stats.trend)
+
+    def test_capacity(self):
+        """At most `capacity` values are kept."""
+        stats = WindowStats(window=1e9, capacity=3, origin=0)
+        for second, value in enumerate([1, 9, 2, 3, 4]):
+            stats.add(second, value)
+        self.assertEqual(len(stats), 3)
+        self.assertEqual((stats.minimum, stats.maximum, stats.last), (2, 4, 4))
+        self.assertAlmostEqual(stats.trend, 3600.0)
+
+    def test_poller(self):
+        """The poller adds every new reading to the buffer."""
+        recent = ReadingBuffer(window=3600)
+        poller = MiFloraPoller(TEST_MAC, MockBackend, recent=recent)
+        backend = poller._bt_interface._backend  # pylint: disable=protected-access
+        for moisture in (20, 30):
+            backend.moisture = moisture
+            poller.parameter_value(MI_TEMPERATURE, read_cached=False)
+        self.assertEqual(len(recent.readings()), 2)
+        self.assertEqual(recent.stats(MI_MOISTURE).mean, 25)
+        self.assertEqual(recent.stats(MI_MOISTURE).last_change[1], 10)
+        self.assertEqual(len(recent.stats(MI_LIGHT)), 2)
+        with self.assertRaises(KeyError):
+            recent.stats("unknown")
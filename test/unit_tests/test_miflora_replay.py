@@ -0,0 +1,120 @@
+"""Tests for the miflora_replay module."""
+
+import functools
+import os
+import tempfile
+import time
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend, RWExceptionBackend
+
+from btlewrap.base import BluetoothBackendException
+
+from miflora.miflora_poller import (
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    MiFloraPoller,
+)
+from miflora.miflora_replay import RecordingBackend, ReplayBackend, load_recording
+
+
+class TestMifloraReplay(unittest.TestCase):
+    """Tests for recording and replaying the Bluetooth traffic."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".rec")
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _record(self):
+        """Record a session of a poller with a mock sensor."""
+        poller = MiFloraPoller(
+            TEST_MAC,
+            functools.partial(RecordingBackend, backend=MockBackend, path=self.path),
+        )
+        recorder = poller._bt_interface._backend
+        backend = recorder._backend
+        backend.set_version(3, 1, 9)
+        backend.battery_level = 63
+        backend.temperature = 21.3
+        backend.moisture = 42
+        backend.brightness = 1234
+        backend.conductivity = 456
+        values = {
+            key: poller.parameter_value(key)
+            for key in (
+                MI_BATTERY,
+                MI_TEMPERATURE,
+                MI_MOISTURE,
+                MI_LIGHT,
+                MI_CONDUCTIVITY,
+            )
+        }
+        recorder.close()
+        return values
+
+    def test_record_replay(self):
+        """Replaying a recording returns the recorded values."""
+        values = self._record()
+        header, events = load_recording(self.path)
+        self.assertEqual("MockBackend", header["backend"])
+        self.assertEqual("connect", events[0]["o"])
+        self.assertEqual([TEST_MAC], events[0]["a"])
+
+        poller = MiFloraPoller(
+            TEST_MAC, functools.partial(ReplayBackend, path=self.path)
+        )
+        for key, value in values.items():
+            self.assertEqual(value, poller.parameter_value(key))
+        self.assertTrue(poller._bt_interface._backend.finished)
+
+    def test_replay_speed(self):
+        """The playback speed scales the recorded durations."""
+        self._record()
+        _, events = load_recording(self.path)
+        for event in events:
+            event["d"] = 0.05
+        replay = ReplayBackend(path=self.path, speed=10)
+        replay._events = events
+        start = time.time()
+        replay.connect(TEST_MAC)
+        replay.read_handle(events[1]["a"][0])
+        self.assertAlmostEqual(0.01, time.time() - start, delta=0.008)
+
+    def test_divergence(self):
+        """A call that differs from the recording raises an exception."""
+        self._record()
+        replay = ReplayBackend(path=self.path)
+        with self.assertRaises(BluetoothBackendException):
+            replay.connect("00:00:00:00:00:00")
+        replay = ReplayBackend(path=self.path)
+        replay.connect(TEST_MAC)
+        with self.assertRaises(BluetoothBackendException):
+            replay.write_handle(0x99, b"\x00")
+
+    def test_recorded_error(self):
+        """Errors of the recorded backend are replayed."""
+        poller = MiFloraPoller(
+            TEST_MAC,
+            functools.partial(
+                RecordingBackend, backend=RWExceptionBackend, path=self.path
+            ),
+        )
+        with self.assertRaises(BluetoothBackendException):
+            poller.firmware_version()
+        poller._bt_interface._backend.close()
+        replay = MiFloraPoller(
+            TEST_MAC, functools.partial(ReplayBackend, path=self.path)
+        )
+        with self.assertRaises(BluetoothBackendException):
+            replay.firmware_version()
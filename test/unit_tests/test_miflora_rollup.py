@@ -0,0 +1,107 @@
+"""Tests for the miflora_rollup module."""
+
+import os
+import struct
+import tempfile
+import unittest
+
+from miflora.miflora_poller import MI_MOISTURE, MI_TEMPERATURE, HistoryEntry
+from miflora.miflora_rollup import DAILY, HOURLY, RAW, HistoryRollup
+
+MAC = "C4:7C:8D:00:00:01"
+OTHER_MAC = "C4:7C:8D:00:00:02"
+# midnight UTC
+START = 1600041600
+DAYS = 60
+
+
+def _history(offset=START):
+    """Return 60 days of hourly entries, the temperature follows the hour."""
+    entries = []
+    for i in range(DAYS * 24):
+        raw = struct.pack("<IHxHBxBH2x", 3600 * i, 200 + i % 24, 1000, 0, 40, 500)
+        entry = HistoryEntry(raw)
+        entry.compute_wall_time(offset)
+        entries.append(entry)
+    return entries
+
+
+class TestRollup(unittest.TestCase):
+    """Tests for the HistoryRollup."""
+
+    def test_tiers(self):
+        """Old data is only kept aggregated."""
+        rollup = HistoryRollup()
+        now = START + DAYS * 24 * 3600
+        self.assertEqual(rollup.ingest(MAC.lower(), _history(), now=now), DAYS * 24)
+        self.assertEqual(rollup.ingest(MAC, _history()[-10:], now=now), 0)
+
+        resolution, rows = rollup.query(MAC, now - 3600, now=now)
+        self.assertEqual(resolution, RAW)
+        self.assertEqual(
+            rows,
+            [
+                (
+                    now - 3600,
+                    {
+                        "temperature": 22.3,
+                        "moisture": 40,
+                        "light": 1000,
+                        "conductivity": 500,
+                    },
+                )
+            ],
+        )
+        self.assertEqual(len(rollup.query(MAC, 0, resolution=RAW)[1]), 48)
+
+        resolution, rows = rollup.query(MAC, now - 10 * 24 * 3600, now=now)
+        self.assertEqual(resolution, HOURLY)
+        self.assertEqual(len(rows), 240)
+        self.assertEqual(rows[0][1][MI_TEMPERATURE].count, 1)
+        self.assertEqual(len(rollup.query(MAC, 0, resolution=HOURLY)[1]), 30 * 24 + 1)
+
+        resolution, rows = rollup.query(MAC, now - 365 * 24 * 3600, now=now)
+        self.assertEqual(resolution, DAILY)
+        self.assertEqual([row[0] for row in rows], list(range(START, now, 24 * 3600)))
+        temperature = rows[0][1][MI_TEMPERATURE]
+        self.assertEqual(temperature.count, 24)
+        self.assertEqual(temperature.minimum, 20.0)
+        self.assertEqual(temperature.maximum, 22.3)
+        self.assertAlmostEqual(temperature.mean, 21.15)
+        self.assertEqual(rows[0][1][MI_MOISTURE].mean, 40)
+        self.assertEqual(rollup.query(OTHER_MAC, 0), (DAILY, []))
+
+    def test_clock_sync(self):
+        """Entries ingested again are skipped after the device clock was synced."""
+        rollup = HistoryRollup()
+        now = START + 4 * 3600
+        self.assertEqual(rollup.ingest(MAC, _history()[:3], now=now), 3)
+        # the model of the device clock moved by 2 s
+        self.assertEqual(rollup.ingest(MAC, _history(START + 2)[:4], now=now), 1)
+        self.assertEqual(
+            [row[0] for row in rollup.query(MAC, 0, resolution=RAW, now=now)[1]],
+            [START, START + 3600, START + 7200, START + 10802],
+        )
+
+    def test_persistence(self):
+        """The rollup survives a restart and compacts later."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "history")
+            rollup = HistoryRollup(path, retention={HOURLY: 24 * 3600})
+            rollup.ingest(MAC, _history()[:48], now=START + 48 * 3600)
+            # every sensor has its own file
+            rollup.ingest(OTHER_MAC, _history()[:1], now=START + 48 * 3600)
+            self.assertEqual(
+                sorted(os.listdir(path)), ["C47C8D000001.json", "C47C8D000002.json"]
+            )
+            loaded = HistoryRollup(path, retention={HOURLY: 24 * 3600})
+            for resolution in (RAW, HOURLY, DAILY):
+                self.assertEqual(
+                    repr(loaded.query(MAC, 0, resolution=resolution)),
+                    repr(rollup.query(MAC, 0, resolution=resolution)),
+                )
+            self.assertEqual(loaded.ingest(MAC, _history()[:48]), 0)
+            loaded.compact(now=START + 10 * 24 * 3600)
+            self.assertEqual(loaded.query(MAC, 0, resolution=RAW)[1], [])
+            self.assertEqual(loaded.query(MAC, 0, resolution=HOURLY)[1], [])
+            self.assertEqual(len(loaded.query(MAC, 0, resolution=DAILY)[1]), 2)
@@ -0,0 +1,112 @@
+"""Tests for the miflora_sharding module."""
+
+import multiprocessing
+import time
+import unittest
+from queue import Empty
+from threading import Thread
+
+from miflora.miflora_sharding import CoordinatorServer, GatewayClient, ShardCoordinator
+
+SENSORS = ["C4:7C:8D:00:00:%02X" % i for i in range(3)]
+OBSERVATIONS = {
+    "a": [(SENSORS[0], -50), (SENSORS[1], -80)],
+    "b": [(SENSORS[0], -70), (SENSORS[1], -60), (SENSORS[2], -65)],
+}
+AUTHKEY = b"test"
+
+
+def _run_gateway(address, name, results):
+    """Gateway process reporting its observations every 50 ms."""
+    gateway = GatewayClient(address, AUTHKEY, name)
+    results.put(("accept", name, gateway.accept(SENSORS[1], 42)))
+    while True:
+        results.put(("report", name, gateway.report(OBSERVATIONS[name])))
+        time.sleep(0.05)
+
+
+class TestSharding(unittest.TestCase):
+    """Tests for the ShardCoordinator and its server."""
+
+    def test_assign(self):
+        """Sensors go to the best gateway with capacity."""
+        coordinator = ShardCoordinator(capacity=1, gateway_timeout=100)
+        for gateway, observations in OBSERVATIONS.items():
+            coordinator.observe(gateway, observations, now=0)
+        # only b receives the third sensor, so it is placed first
+        self.assertEqual(
+            coordinator.assign(now=1), {"a": [SENSORS[0]], "b": [SENSORS[2]]}
+        )
+        coordinator.capacity = 3
+        self.assertEqual(
+            coordinator.assign(now=1),
+            {"a": [SENSORS[0]], "b": SENSORS[1:]},
+        )
+        # within the hysteresis the sensor stays where it is
+        coordinator.observe("a", [(SENSORS[1], -58)], now=2)
+        self.assertEqual(coordinator.assign(now=2)["b"], SENSORS[1:])
+        coordinator.observe("a", [(SENSORS[1], -50)], now=3)
+        self.assertEqual(coordinator.assign(now=3)["a"], SENSORS[:2])
+        # b stops reporting and its sensors move to a, if a receives them
+        self.assertEqual(coordinator.assign(now=101), {"a": SENSORS[:2]})
+
+    def test_accept(self):
+        """Each reading is only accepted once."""
+        coordinator = ShardCoordinator()
+        self.assertTrue(coordinator.accept(SENSORS[0], 1))
+        self.assertFalse(coordinator.accept(SENSORS[0].lower(), 1))
+        self.assertTrue(coordinator.accept(SENSORS[1], 1))
+
+    def test_processes(self):
+        """Gateways in other processes get their sensors and take over."""
+        coordinator = ShardCoordinator(capacity=3)
+        server = CoordinatorServer(coordinator, ("127.0.0.1", 0), AUTHKEY)
+        Thread(target=server.serve_forever, daemon=True).start()
+        context = multiprocessing.get_context("spawn")
+        # one queue per gateway, killing a process can break its queue
+        results = {name: context.Queue() for name in OBSERVATIONS}
+        gateways = {
+            name: context.Process(
+                target=_run_gateway,
+                args=(server.address, name, results[name]),
+                daemon=True,
+            )
+            for name in OBSERVATIONS
+        }
+        for process in gateways.values():
+            process.start()
+        try:
+            accepted = self._wait(
+                results,
+                lambda latest: latest.get("a") == [SENSORS[0]]
+                and latest.get("b") == SENSORS[1:],
+            )
+            self.assertEqual(sorted(accepted.values()), [False, True])
+            gateways["a"].terminate()
+            del results["a"]
+            self._wait(results, lambda latest: latest.get("b") == SENSORS)
+            self.assertEqual(coordinator.gateways(), ["b"])
+        finally:
+            for process in gateways.values():
+                process.terminate()
+                process.join()
+            server.close()
+
+    def _wait(self, results, condition, timeout=20):
+        """Collect the results of the gateways until the condition holds."""
+        latest = dict()
+        accepted = dict()
+        end = time.monotonic() + timeout
+        while not condition(latest):
+            if time.monotonic() > end:
+                self.fail(f"Gateways did not converge: {latest}")
+            for queue in results.values():
+                try:
+                    kind, name, result = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                if kind == "accept":
+                    accepted[name] = result
+                else:
+                    latest[name] = result
+        return accepted
@@ -0,0 +1,76 @@
+"""Tests for the miflora_transfer module."""
+
+import unittest
+from test import TEST_MAC
+from test.helper import MockBackend
+
+from miflora.miflora_poller import MiFloraPoller
+
+HISTORY_ENTRY = b"\x30\x42\x15\x00\xc1\x00\x00\x00\x00\x00\x00\x1e\x87\x02\x00\x00"
+
+
+class BatchBackend(MockBackend):
+    """Mock backend transferring write/read pairs in batches."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sizes = []
+
+    def write_read_batch(self, write_handle, read_handle, values):
+        """Write all values and read the responses."""
+        self.batch_sizes.append(len(values))
+        responses = []
+        for value in values:
+            self.write_handle(write_handle, value)
+            responses.append(self.read_handle(read_handle))
+        return responses
+
+
+class NoResponseBackend(MockBackend):
+    """Mock backend supporting writes without response."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes_without_response = 0
+
+    def write_handle_no_response(self, handle, value):
+        """Count the writes without response."""
+        self.writes_without_response += 1
+        self.write_handle(handle, value)
+
+
+class TestMifloraTransfer(unittest.TestCase):
+    """Tests for the transfer of the history."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    @staticmethod
+    def _setup_history(poller, length):
+        """Create a history with `length` entries."""
+        backend = poller._bt_interface._backend
+        backend.history_info = length.to_bytes(2, "little") + bytes(14)
+        backend.history_data = [HISTORY_ENTRY] * length
+        backend.local_time = b"\xd8I\x15\x00"
+        return backend
+
+    def test_batches(self):
+        """The history is transferred in batches."""
+        poller = MiFloraPoller(TEST_MAC, BatchBackend, history_batch_size=4)
+        backend = self._setup_history(poller, 10)
+        self.assertEqual(10, len(poller.fetch_history()))
+        self.assertEqual([4, 4, 2], backend.batch_sizes)
+
+    def test_write_without_response(self):
+        """Addresses are written without response if supported."""
+        poller = MiFloraPoller(TEST_MAC, NoResponseBackend)
+        backend = self._setup_history(poller, 3)
+        self.assertEqual(3, len(poller.fetch_history()))
+        self.assertEqual(3, backend.writes_without_response)
+
+    def test_partial_history(self):
+        """Entries read before a failure are kept."""
+        poller = MiFloraPoller(TEST_MAC, MockBackend, history_batch_size=2)
+        backend = self._setup_history(poller, 5)
+        del backend.history_data[3:]
+        self.assertEqual(3, len(poller.fetch_history()))
@@ -0,0 +1,115 @@
+"""Tests for the miflora_wire module."""
+
+import json
+import struct
+import unittest
+from datetime import datetime
+
+from miflora.miflora_decoder import HISTORY_DATA, SENSOR_DATA
+from miflora.miflora_poller import (
+    MI_BATTERY,
+    MI_CONDUCTIVITY,
+    MI_LIGHT,
+    MI_MOISTURE,
+    MI_TEMPERATURE,
+    HistoryEntry,
+)
+from miflora.miflora_wire import WireDecoder, WireEncoder, decode
+
+MACS = ("C4:7C:8D:00:00:01", "C4:7C:8D:00:00:02")
+START = 1600000000
+
+
+def _history(count, time_diff=START):
+    """Return hourly history entries with slowly changing values."""
+    entries = []
+    for i in range(count):
+        temperature = (-15 + i % 40) & 0xFFFF
+        raw = struct.pack(
+            "<IHxHBxBH2x", 3600 * i, temperature, 1000 + i % 3, 0, 30 + i // 50, 400
+        )
+        entry = HistoryEntry(raw)
+        entry.compute_wall_time(time_diff)
+        entries.append(entry)
+    return entries
+
+
+class TestWire(unittest.TestCase):
+    """Tests for the WireEncoder and WireDecoder."""
+
+    def test_history(self):
+        """History entries are restored exactly."""
+        entries = _history(100)
+        entries[5].wall_time = None
+        encoder = WireEncoder()
+        data = encoder.history(MACS[0], entries) + encoder.history(MACS[1], entries)
+        records = decode(data)
+        self.assertEqual(len(records), 200)
+        for record, entry in zip(records, entries * 2):
+            self.assertEqual(record.kind, HISTORY_DATA)
+            self.assertEqual(record.timestamp, entry.device_time)
+            for field in ("device_time", "wall_time", MI_TEMPERATURE, MI_LIGHT):
+                self.assertEqual(record.values[field], getattr(entry, field))
+            self.assertEqual(record.values[MI_MOISTURE], entry.moisture)
+            self.assertEqual(record.values[MI_CONDUCTIVITY], entry.conductivity)
+        self.assertEqual([r.mac for r in records[99:101]], list(MACS))
+
+        as_json = json.dumps(
+            [
+                {
+                    **{
+                        name: value
+                        for name, value in vars(entry).items()
+                        if name != "raw"
+                    },
+                    "wall_time": str(entry.wall_time),
+                    "mac": MACS[0],
+                }
+                for entry in entries
+            ]
+        )
+        # most entries only change the temperature
+        self.assertLess(len(data) / 2, len(as_json) / 20)
+
+    def test_readings(self):
+        """Readings with missing values are restored, also from small chunks."""
+        readings = [
+            {MI_TEMPERATURE: 21.3, MI_MOISTURE: 40, MI_LIGHT: 500, MI_BATTERY: 99},
+            {MI_TEMPERATURE: -2.5, MI_MOISTURE: 41, MI_LIGHT: 500, MI_BATTERY: 99},
+            {MI_TEMPERATURE: -2.5, MI_MOISTURE: 41, MI_CONDUCTIVITY: 300},
+        ]
+        encoder = WireEncoder()
+        data = b"".join(
+            encoder.reading(MACS[i % 2], reading, START + 60.4 * i)
+            for i, reading in enumerate(readings)
+        )
+        decoder = WireDecoder()
+        records = []
+        for i in range(len(data)):
+            records += decoder.feed(data[i : i + 1])
+        decoder.close()
+        self.assertEqual(len(records), 3)
+        for i, (record, reading) in enumerate(zip(records, readings)):
+            self.assertEqual(record.mac, MACS[i % 2])
+            self.assertEqual(record.kind, SENSOR_DATA)
+            self.assertEqual(record.timestamp, round(START + 60.4 * i))
+            self.assertEqual(
+                {k: v for k, v in record.values.items() if v is not None}, reading
+            )
+
+    def test_streams(self):
+        """A reset starts a new stream, broken streams are detected."""
+        encoder = WireEncoder()
+        first = encoder.history(MACS[0], _history(3))
+        encoder.reset()
+        second = encoder.history(MACS[0], _history(3))
+        self.assertEqual(first, second)
+        self.assertEqual(
+            decode(first)[2].values["wall_time"], datetime.fromtimestamp(START + 7200)
+        )
+        with self.assertRaisesRegex(ValueError, "Not a miflora"):
+            decode(b"{}")
+        with self.assertRaisesRegex(ValueError, "version"):
+            decode(b"MFW\x09")
+        with self.assertRaisesRegex(ValueError, "ends within"):
+            decode(first[:-1])
@@ -0,0 +1,89 @@
+"""Tests for the miflora_worker module."""
+
+import functools
+import os
+import time
+import unittest
+from test import HANDLE_DEVICE_TIME, TEST_MAC
+from test.helper import MockBackend
+
+from btlewrap.base import BluetoothBackendException
+
+from miflora.miflora_deadline import BluetoothTimeoutException
+from miflora.miflora_poller import MI_TEMPERATURE, MiFloraPoller
+from miflora.miflora_worker import ProcessBackend, get_worker, stop_workers
+
+
+class WorkerBackend(MockBackend):
+    """Mock backend for the worker process, hanging when reading the device time."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature = 21.5
+
+    def read_handle(self, handle):
+        """Hang on the device time, report the pid (0x99) and backend id (0x98)."""
+        if handle == HANDLE_DEVICE_TIME:
+            time.sleep(60)
+        if handle == 0x99:
+            return os.getpid()
+        if handle == 0x98:
+            return id(self)
+        return super().read_handle(handle)
+
+
+class TestMifloraWorker(unittest.TestCase):
+    """Tests for the ProcessBackend."""
+
+    # access to protected members is fine in testing
+    # pylint: disable = protected-access
+
+    def tearDown(self):
+        """Stop all workers."""
+        stop_workers()
+
+    def test_poll(self):
+        """Read a sensor through the worker process."""
+        backend = functools.partial(ProcessBackend, backend=WorkerBackend)
+        poller = MiFloraPoller(TEST_MAC, backend)
+        self.assertAlmostEqual(21.5, poller.parameter_value(MI_TEMPERATURE))
+        self.assertNotEqual(os.getpid(), self._read_pid(poller))
+
+    def test_one_worker_per_adapter(self):
+        """Pollers on the same adapter share one worker."""
+        backend = functools.partial(ProcessBackend, backend=WorkerBackend)
+        first = MiFloraPoller(TEST_MAC, backend)
+        second = MiFloraPoller("11:22:33:44:55:77", backend)
+        other_adapter = MiFloraPoller(TEST_MAC, backend, adapter="hci1")
+        self.assertEqual(self._read_pid(first), self._read_pid(second))
+        self.assertNotEqual(self._read_pid(first), self._read_pid(other_adapter))
+
+    def test_restart_wedged_worker(self):
+        """A wedged worker is restarted and the next operation works again."""
+        backend = functools.partial(
+            ProcessBackend, backend=WorkerBackend, call_timeout=0.5
+        )
+        poller = MiFloraPoller(TEST_MAC, backend)
+        pid = self._read_pid(poller)
+        with self.assertRaises(BluetoothTimeoutException):
+            with poller._connect() as connection:
+                connection.read_handle(HANDLE_DEVICE_TIME)
+        self.assertEqual(1, get_worker(WorkerBackend, "hci0").restarts)
+        self.assertNotEqual(pid, self._read_pid(poller))
+
+    def test_errors(self):
+        """Errors in the worker are raised as BluetoothBackendException."""
+        backend = functools.partial(ProcessBackend, backend=WorkerBackend)
+        poller = MiFloraPoller(TEST_MAC, backend)
+        with poller._connect() as connection:
+            instance = connection.read_handle(0x98)
+            with self.assertRaises(BluetoothBackendException):
+                connection.read_handle(0x1234)
+            # the session and its backend instance are kept after an error
+            self.assertEqual(instance, connection.read_handle(0x98))
+
+    @staticmethod
+    def _read_pid(poller):
+        """Get the pid of the worker process of a poller."""
+        with poller._connect() as connection:
+            return connection.read_handle(0x99)